@@ -14,3 +14,12 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'carpooling.settings')
 
 application = get_asgi_application()
+
+# Load the routing index at import time. Under `gunicorn --preload` this runs
+# once in the master, and forked workers share the memory-mapped graph.
+from django.conf import settings  # noqa: E402
+
+if settings.GRAPH_PRELOAD:
+    from core.services import graph_index
+
+    graph_index.preload()
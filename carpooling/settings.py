@@ -55,14 +55,18 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # After authentication: reads stick to the primary per user, not just per cookie
+    'core.db_router.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
+    'core.middleware.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'carpooling.urls'
@@ -99,6 +103,32 @@ DATABASES = {
     }
 }
 
+# DATABASE_URL replaces the primary above; DATABASE_REPLICA_URLS is a
+# comma-separated list of read replicas, added as replica1, replica2, ...
+# Safe-method requests read from a replica (see core/db_router.py).
+if os.environ.get('DATABASE_URL'):
+    DATABASES['default'] = dj_database_url.parse(os.environ['DATABASE_URL'])
+DATABASE_REPLICAS = []
+for _url in filter(None, (u.strip() for u in os.environ.get('DATABASE_REPLICA_URLS', '').split(','))):
+    _alias = f'replica{len(DATABASE_REPLICAS) + 1}'
+    DATABASES[_alias] = dj_database_url.parse(_url)
+    DATABASE_REPLICAS.append(_alias)
+DATABASE_ROUTERS = ['core.db_router.PrimaryReplicaRouter']
+# After a write, the same client and user read from the primary for this many seconds
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', '10'))
+# Per-user stickiness lives in the default cache. The local-memory default
+# only covers the process that took the write; point CACHE_BACKEND and
+# CACHE_LOCATION at a shared cache (Redis, memcached) when running replicas.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# The migrations use 64-bit primary keys
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -138,6 +168,85 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = 'media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Metrics
+# Each gunicorn worker dumps its counters here so /metrics can merge them.
+# Leave unset for single-process deployments.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+# Addresses or networks (comma-separated) that may scrape /metrics directly,
+# e.g. the Prometheus server. Requests through nginx need a staff user.
+METRICS_ALLOWED_IPS = [ip.strip() for ip in os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+                       if ip.strip()]
+
+# Routing index
+# Upper bounds on cached BFS distance rows and radius neighbourhoods per process.
+GRAPH_INDEX_MAX_ROWS = int(os.environ.get('GRAPH_INDEX_MAX_ROWS', '1024'))
+GRAPH_INDEX_MAX_NEIGHBOURHOODS = int(os.environ.get('GRAPH_INDEX_MAX_NEIGHBOURHOODS', '4096'))
+# Edited adjacency entries kept on top of the database-loaded graph before
+# they are folded into it (a copy of the whole adjacency).
+GRAPH_INDEX_MAX_OVERLAY = int(os.environ.get('GRAPH_INDEX_MAX_OVERLAY', '4096'))
+# Prebuilt CSR graph written by `manage.py build_graph_snapshot` and
+# memory-mapped by every process; ignored if missing or stale.
+GRAPH_SNAPSHOT_PATH = os.environ.get('GRAPH_SNAPSHOT_PATH', str(BASE_DIR / 'snapshots' / 'graph.csr'))
+# Load the routing index when wsgi.py/asgi.py is imported (before fork
+# under gunicorn --preload) instead of on the first routed request.
+GRAPH_PRELOAD = os.environ.get('GRAPH_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+# Change channels ('graph', 'trip') that keep per-process caches in step
+# across workers: each process polls the change log at least every
+# VERSION_POLL_INTERVAL seconds, sooner with PostgreSQL LISTEN/NOTIFY.
+VERSION_LISTENER = os.environ.get('VERSION_LISTENER', 'true').lower() in ('1', 'true', 'yes')
+VERSION_POLL_INTERVAL = float(os.environ.get('VERSION_POLL_INTERVAL', '1'))
+# Versions are taken when a change is logged, not when it commits, so a
+# slow transaction can commit a version below one already read. Readers
+# look back this many seconds for such late commits; keep it above the
+# longest transaction that publishes a change.
+VERSION_COMMIT_GRACE = float(os.environ.get('VERSION_COMMIT_GRACE', '30'))
+CHANGELOG_RETENTION_DAYS = int(os.environ.get('CHANGELOG_RETENTION_DAYS', '7'))
+
+# Trip matches
+# 'thread' refreshes TripMatch rows on a background thread in each process;
+# 'inline' refreshes them in the request that triggered the change;
+# 'off' leaves them to be refreshed when read.
+MATCH_WORKER = os.environ.get('MATCH_WORKER', 'thread')
+# Rows older than this (seconds) are refreshed again when read.
+MATCH_MAX_AGE = int(os.environ.get('MATCH_MAX_AGE', '60'))
+
+# Pending carpool requests expire this many seconds after creation (0 = never,
+# the default: turning it on expires every older pending request at once).
+# `manage.py expire_requests` (also run by the job workers) marks them EXPIRED.
+CARPOOL_REQUEST_TTL = int(os.environ.get('CARPOOL_REQUEST_TTL', '0'))
+
+# Largest array accepted by the /batch/ endpoints
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '1000'))
+
+# Position updates posted to /api/trips/positions/ are coalesced per trip in
+# memory and written every POSITION_FLUSH_INTERVAL seconds (0 = write
+# immediately), or as soon as POSITION_BUFFER_MAX_TRIPS trips are pending.
+# A crashed process loses at most one interval of updates.
+POSITION_FLUSH_INTERVAL = float(os.environ.get('POSITION_FLUSH_INTERVAL', '2'))
+POSITION_BUFFER_MAX_TRIPS = int(os.environ.get('POSITION_BUFFER_MAX_TRIPS', '10000'))
+
+# Quote tokens returned by matching_requests stay valid this long (seconds)
+QUOTE_MAX_AGE = int(os.environ.get('QUOTE_MAX_AGE', '300'))
+
+# Background jobs (route splicing, settlement), run by `manage.py run_workers`
+# Set JOB_QUEUE_EAGER to run jobs in-process right after they are enqueued.
+JOB_QUEUE_EAGER = os.environ.get('JOB_QUEUE_EAGER', 'False') == 'True'
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BACKOFF = 2  # Seconds, raised to the attempt number
+JOB_STALE_AFTER = 300  # Seconds before a RUNNING job is assumed abandoned
+
+# Per-request profiling
+# When enabled, staff requests carrying PROFILING_HEADER and a random
+# PROFILING_SAMPLE_RATE fraction of all requests are profiled into
+# PROFILING_DIR and listed under Request profiles in the admin.
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'False') == 'True'
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_HEADER = 'X-Profile'
+PROFILING_SAMPLE_INTERVAL = 0.001
+PROFILING_DIR = os.environ.get('PROFILING_DIR', os.path.join(BASE_DIR, 'profiles'))
+
 # Allauth settings
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
@@ -0,0 +1,26 @@
+"""
+Settings for running the test suite without PostgreSQL:
+
+    python manage.py test --settings=carpooling.test_settings
+
+Two local SQLite databases stand in for the primary and a read replica.
+Replica routing is off unless a test turns it on with DATABASE_REPLICAS.
+"""
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'test_primary.sqlite3',
+        # A file rather than shared-cache memory, so threaded tests wait
+        # for each other's write locks instead of failing at once
+        'TEST': {'NAME': BASE_DIR / 'test_default.sqlite3'},
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'test_replica.sqlite3',
+    },
+}
+DATABASE_REPLICAS = []
+GRAPH_PRELOAD = False
+VERSION_LISTENER = False  # Tests call version_channel.poll() themselves
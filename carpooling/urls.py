@@ -16,10 +16,12 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from core.views import home
+from core.views import home, metrics_view, ready_view
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('core.urls')),
     path('accounts/', include('allauth.urls')),
-    path("", some_view)
+    path('metrics', metrics_view, name='metrics'),
+    path('ready', ready_view, name='ready'),
+    path("", home)
 ]
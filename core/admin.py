@@ -1,5 +1,14 @@
+import io
+import os
+import pstats
+
+from django.conf import settings
 from django.contrib import admin
-from .models import Node, Edge, Trip, CarpoolRequest, Offer, Wallet, Transaction
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html, format_html_join
+from .models import Node, Edge, Trip, CarpoolRequest, Offer, Wallet, Transaction, RequestProfile
 
 @admin.register(Node)
 class NodeAdmin(admin.ModelAdmin):
@@ -31,3 +40,58 @@ class WalletAdmin(admin.ModelAdmin):
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ('wallet', 'amount', 'transaction_type', 'trip', 'created_at')
     list_filter = ('transaction_type',)
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'method', 'path', 'status_code', 'duration_ms', 'query_count', 'trigger', 'user')
+    list_filter = ('trigger', 'method', 'view_name')
+    search_fields = ('path', 'view_name')
+    exclude = ('queries',)
+    readonly_fields = ('method', 'path', 'view_name', 'user', 'status_code', 'duration_ms', 'query_count',
+                       'trigger', 'created_at', 'downloads', 'top_functions', 'sql')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/download/<str:kind>/', self.admin_site.admin_view(self.download),
+                 name='core_requestprofile_download'),
+        ] + super().get_urls()
+
+    def download(self, request, pk, kind):
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        filename = {'prof': profile.profile_file, 'collapsed': profile.collapsed_file}.get(kind)
+        if not filename:
+            raise Http404
+        full_path = os.path.join(settings.PROFILING_DIR, filename)
+        if not os.path.exists(full_path):
+            raise Http404('Profile file no longer exists.')
+        return FileResponse(open(full_path, 'rb'), as_attachment=True, filename=filename)
+
+    @admin.display(description='Files')
+    def downloads(self, obj):
+        return format_html(
+            '<a href="{}">{}</a> &middot; <a href="{}">{}</a>',
+            reverse('admin:core_requestprofile_download', args=[obj.pk, 'prof']), obj.profile_file,
+            reverse('admin:core_requestprofile_download', args=[obj.pk, 'collapsed']), obj.collapsed_file,
+        )
+
+    @admin.display(description='Top functions (cumulative)')
+    def top_functions(self, obj):
+        full_path = os.path.join(settings.PROFILING_DIR, obj.profile_file)
+        if not os.path.exists(full_path):
+            return 'Profile file no longer exists.'
+        out = io.StringIO()
+        pstats.Stats(full_path, stream=out).sort_stats('cumulative').print_stats(30)
+        return format_html('<pre>{}</pre>', out.getvalue())
+
+    @admin.display(description='SQL')
+    def sql(self, obj):
+        return format_html('<table>{}</table>', format_html_join(
+            '', '<tr><td>{:.2f} ms</td><td><code>{}</code></td><td>{}</td></tr>',
+            ((q['duration_ms'], q['sql'], q['origin']) for q in obj.queries),
+        ))
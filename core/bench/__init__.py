@@ -0,0 +1 @@
+"""Benchmark helpers: synthetic city generators and latency statistics."""
@@ -0,0 +1,223 @@
+"""
+Seeded synthetic road graphs and trip/request populations.
+
+Every generator returns ``(node_count, edges)`` where ``edges`` is a list of
+directed ``(from_index, to_index)`` pairs over ``range(node_count)``. Roads
+are two-way unless stated otherwise, so most generators emit both
+directions. The same seed always produces the same graph.
+"""
+import math
+import random
+from collections import deque
+
+from django.contrib.auth.models import User
+
+from core.models import Node, Edge, Trip, CarpoolRequest
+from core.services import graph_index, version_channel
+
+BATCH_SIZE = 5000
+
+
+def grid_graph(n, seed=0):
+    """Manhattan-style grid: every node links to its right and lower neighbour."""
+    side = int(math.ceil(math.sqrt(n)))
+    edges = []
+    for i in range(n):
+        row, col = divmod(i, side)
+        right = i + 1
+        down = i + side
+        if col + 1 < side and right < n:
+            edges.append((i, right))
+            edges.append((right, i))
+        if down < n:
+            edges.append((i, down))
+            edges.append((down, i))
+    return n, edges
+
+
+def random_geometric_graph(n, seed=0, avg_degree=6):
+    """
+    Points scattered in the unit square, linked when closer than a radius
+    chosen to give roughly ``avg_degree`` neighbours per node.
+    """
+    rng = random.Random(seed)
+    points = [(rng.random(), rng.random()) for _ in range(n)]
+    radius = math.sqrt(avg_degree / (math.pi * max(n, 1)))
+    cells = {}
+    for i, (x, y) in enumerate(points):
+        cells.setdefault((int(x / radius), int(y / radius)), []).append(i)
+
+    radius_sq = radius * radius
+    edges = []
+    for (cx, cy), members in cells.items():
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for j in cells.get((cx + dx, cy + dy), ()):
+                    for i in members:
+                        if i < j:
+                            xi, yi = points[i]
+                            xj, yj = points[j]
+                            if (xi - xj) ** 2 + (yi - yj) ** 2 <= radius_sq:
+                                edges.append((i, j))
+                                edges.append((j, i))
+    return n, edges
+
+
+def scale_free_road_graph(n, seed=0, links_per_node=2, max_degree=8):
+    """
+    Preferential attachment with a degree cap: a few arterial hubs and many
+    residential streets, without the unbounded hubs of a pure
+    Barabasi-Albert graph that real road networks never have.
+    """
+    rng = random.Random(seed)
+    degree = [0] * n
+    targets = []  # One entry per edge endpoint, so sampling is degree-weighted
+    edges = []
+    for i in range(1, n):
+        chosen = set()
+        for _ in range(min(links_per_node, i)):
+            for _attempt in range(10):
+                if targets:
+                    j = targets[rng.randrange(len(targets))]
+                else:
+                    j = rng.randrange(i)
+                if j not in chosen and degree[j] < max_degree:
+                    break
+            else:
+                j = rng.randrange(i)
+            if j in chosen:
+                continue
+            chosen.add(j)
+            edges.append((i, j))
+            edges.append((j, i))
+            degree[i] += 1
+            degree[j] += 1
+            targets.extend((i, j))
+    return n, edges
+
+
+GENERATORS = {
+    'grid': grid_graph,
+    'geometric': random_geometric_graph,
+    'scalefree': scale_free_road_graph,
+}
+
+
+def adjacency_from_edges(n, edges):
+    adjacency = [[] for _ in range(n)]
+    for u, v in edges:
+        adjacency[u].append(v)
+    return adjacency
+
+
+def load_graph(kind, n, edges):
+    """Insert a generated graph and return the list of Node ids by index."""
+    Node.objects.bulk_create(
+        [Node(name=f'{kind}-{i}') for i in range(n)], batch_size=BATCH_SIZE
+    )
+    ids_by_name = dict(
+        Node.objects.filter(name__startswith=f'{kind}-').values_list('name', 'id')
+    )
+    node_ids = [ids_by_name[f'{kind}-{i}'] for i in range(n)]
+    Edge.objects.bulk_create(
+        [Edge(from_node_id=node_ids[u], to_node_id=node_ids[v]) for u, v in edges],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    # bulk_create skips the Edge signals, so every routing index must reload
+    version_channel.publish('graph', {'op': 'reload'})
+    graph_index.invalidate()
+    return node_ids
+
+
+def _bfs_route(adjacency, start, max_hops, rng):
+    """Walk a BFS tree from ``start`` and return the path to a far node."""
+    parents = {start: None}
+    frontier = deque([(start, 0)])
+    deepest = [start]
+    deepest_dist = 0
+    while frontier:
+        current, dist = frontier.popleft()
+        if dist > deepest_dist:
+            deepest, deepest_dist = [current], dist
+        elif dist == deepest_dist:
+            deepest.append(current)
+        if dist >= max_hops:
+            continue
+        for nxt in adjacency[current]:
+            if nxt not in parents:
+                parents[nxt] = current
+                frontier.append((nxt, dist + 1))
+    end = rng.choice(deepest)
+    route = []
+    while end is not None:
+        route.append(end)
+        end = parents[end]
+    route.reverse()
+    return route
+
+
+def create_population(adjacency, node_ids, trips, requests, seed=0,
+                      route_hops=10, match_ratio=0.5, prefix='bench'):
+    """
+    Create active trips along generated routes and pending requests.
+
+    About ``match_ratio`` of the requests are placed on or next to a trip's
+    route so that matching and detour code paths do real work; the rest are
+    uniformly random and mostly get rejected by the radius check.
+    Returns ``(trip_objects, request_objects)``.
+    """
+    rng = random.Random(seed)
+    n = len(node_ids)
+
+    drivers = [
+        User.objects.create_user(username=f'{prefix}-driver-{i}')
+        for i in range(trips)
+    ]
+    passengers = [
+        User.objects.create_user(username=f'{prefix}-passenger-{i}')
+        for i in range(requests)
+    ]
+
+    trip_routes = []
+    trip_objs = []
+    for driver in drivers:
+        for _attempt in range(20):
+            route = _bfs_route(adjacency, rng.randrange(n), route_hops, rng)
+            if len(route) >= 3:
+                break
+        trip_routes.append(route)
+        route_ids = [node_ids[i] for i in route]
+        trip_objs.append(Trip(
+            driver=driver,
+            start_node_id=route_ids[0],
+            end_node_id=route_ids[-1],
+            current_node_id=route_ids[0],
+            route=route_ids,
+            max_passengers=4,
+            status='ACTIVE',
+        ))
+    Trip.objects.bulk_create(trip_objs, batch_size=BATCH_SIZE)
+
+    request_objs = []
+    for passenger in passengers:
+        if trip_routes and rng.random() < match_ratio:
+            route = rng.choice(trip_routes)
+            i = rng.randrange(len(route) - 1)
+            j = rng.randrange(i + 1, len(route))
+            pickup = rng.choice([route[i]] + adjacency[route[i]])
+            dropoff = rng.choice([route[j]] + adjacency[route[j]])
+        else:
+            pickup = rng.randrange(n)
+            dropoff = rng.randrange(n)
+        if pickup == dropoff:
+            dropoff = (dropoff + 1) % n
+        request_objs.append(CarpoolRequest(
+            passenger=passenger,
+            pickup_node_id=node_ids[pickup],
+            dropoff_node_id=node_ids[dropoff],
+        ))
+    CarpoolRequest.objects.bulk_create(request_objs, batch_size=BATCH_SIZE)
+
+    return list(Trip.objects.filter(driver__in=drivers).select_related('driver')), \
+        list(CarpoolRequest.objects.filter(passenger__in=passengers).select_related('passenger'))
@@ -0,0 +1,222 @@
+"""
+Replay a recorded JSONL log of API calls against the app.
+
+Each log line is one call::
+
+    {"ts": 12.5, "user": "alice", "method": "POST",
+     "path": "/api/trips/", "body": {"start_node": 1, ...}}
+
+``ts`` is seconds (epoch or relative, only differences matter). Paths are
+replayed verbatim, so logs must be replayed against a database restored
+from the snapshot they were recorded on. Calls from the same user are kept
+in order on one worker; different users run concurrently.
+"""
+import json
+import queue
+import re
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db import connections
+
+from core.bench.stats import summarize, histogram
+
+ID_RE = re.compile(r'/\d+(?=/|$)')
+
+
+def endpoint_name(method, path):
+    """Group calls by route, e.g. ``POST /api/trips/{id}/update_node/``."""
+    return f"{method.upper()} {ID_RE.sub('/{id}', path.split('?', 1)[0])}"
+
+
+def load_log(path):
+    events = []
+    with open(path) as fh:
+        for line_no, line in enumerate(fh, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError as exc:
+                raise ValueError(f'{path}:{line_no}: {exc}') from exc
+            event.setdefault('method', 'GET')
+            event.setdefault('ts', 0)
+            events.append(event)
+    events.sort(key=lambda e: e['ts'])
+    return events
+
+
+class InProcessTransport:
+    """Drives the app through the Django test client, one client per user."""
+
+    def __init__(self, create_users=False):
+        self.create_users = create_users
+        self.local = threading.local()
+
+    def _client(self, username):
+        from django.test import Client
+        clients = getattr(self.local, 'clients', None)
+        if clients is None:
+            clients = self.local.clients = {}
+        if username not in clients:
+            client = Client()
+            if username:
+                if self.create_users:
+                    user, _ = User.objects.get_or_create(username=username)
+                else:
+                    user = User.objects.get(username=username)
+                client.force_login(user)
+            clients[username] = client
+        return clients[username]
+
+    def send(self, event):
+        client = self._client(event.get('user'))
+        method = getattr(client, event['method'].lower())
+        body = event.get('body')
+        if body is None:
+            response = method(event['path'])
+        else:
+            response = method(event['path'], data=json.dumps(body), content_type='application/json')
+        return response.status_code
+
+    def close_thread(self):
+        connections.close_all()
+
+
+class HttpTransport:
+    """Drives a running server (e.g. local gunicorn) using DRF token auth."""
+
+    def __init__(self, base_url, create_users=False, timeout=30):
+        import requests
+        from rest_framework.authtoken.models import Token
+
+        self.requests = requests
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.create_users = create_users
+        self.Token = Token
+        self.tokens = {}
+        self.tokens_lock = threading.Lock()
+        self.local = threading.local()
+
+    def _token(self, username):
+        with self.tokens_lock:
+            if username not in self.tokens:
+                if self.create_users:
+                    user, _ = User.objects.get_or_create(username=username)
+                else:
+                    user = User.objects.get(username=username)
+                self.tokens[username] = self.Token.objects.get_or_create(user=user)[0].key
+            return self.tokens[username]
+
+    def send(self, event):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = self.requests.Session()
+        headers = {}
+        if event.get('user'):
+            headers['Authorization'] = f"Token {self._token(event['user'])}"
+        response = session.request(
+            event['method'], self.base_url + event['path'],
+            json=event.get('body'), headers=headers, timeout=self.timeout,
+        )
+        return response.status_code
+
+    def close_thread(self):
+        connections.close_all()
+
+
+class Replayer:
+    """
+    Replays events with ``concurrency`` workers.
+
+    ``speed`` scales the recorded inter-arrival times: 1.0 is real time,
+    2.0 twice as fast, and 0 fires every call as soon as a worker is free.
+    """
+
+    def __init__(self, transport, concurrency=8, speed=1.0):
+        self.transport = transport
+        self.concurrency = max(concurrency, 1)
+        self.speed = speed
+        self.results = defaultdict(list)  # endpoint -> [(latency_ms, status or None)]
+        self.results_lock = threading.Lock()
+
+    def _worker(self, inbox):
+        try:
+            while True:
+                event = inbox.get()
+                if event is None:
+                    return
+                self._wait_until(event['_due'])
+                start = time.perf_counter()
+                try:
+                    status = self.transport.send(event)
+                except Exception:
+                    status = None
+                elapsed = (time.perf_counter() - start) * 1000
+                with self.results_lock:
+                    self.results[endpoint_name(event['method'], event['path'])].append((elapsed, status))
+        finally:
+            self.transport.close_thread()
+
+    def _wait_until(self, due):
+        if due is None:
+            return
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def run(self, events):
+        inboxes = [queue.Queue() for _ in range(self.concurrency)]
+        threads = [threading.Thread(target=self._worker, args=(inbox,), daemon=True) for inbox in inboxes]
+        for thread in threads:
+            thread.start()
+
+        started = time.perf_counter()
+        first_ts = events[0]['ts'] if events else 0
+        for event in events:
+            if self.speed:
+                event['_due'] = started + (event['ts'] - first_ts) / self.speed
+            else:
+                event['_due'] = None
+            inboxes[zlib.crc32(str(event.get('user')).encode()) % self.concurrency].put(event)
+        for inbox in inboxes:
+            inbox.put(None)
+        for thread in threads:
+            thread.join()
+        return self.report(time.perf_counter() - started)
+
+    def report(self, wall_seconds):
+        endpoints = {}
+        total = 0
+        total_errors = 0
+        for name, samples in sorted(self.results.items()):
+            latencies = [latency for latency, _ in samples]
+            statuses = defaultdict(int)
+            errors = 0
+            for _, status in samples:
+                statuses[str(status) if status is not None else 'exception'] += 1
+                if status is None or status >= 400:
+                    errors += 1
+            total += len(samples)
+            total_errors += errors
+            endpoints[name] = {
+                'count': len(samples),
+                'errors': errors,
+                'error_rate': errors / len(samples),
+                'throughput_rps': len(samples) / wall_seconds if wall_seconds else None,
+                'statuses': dict(statuses),
+                'latency_ms': summarize(latencies),
+                'histogram_ms': histogram(latencies),
+            }
+        return {
+            'wall_seconds': wall_seconds,
+            'requests': total,
+            'errors': total_errors,
+            'throughput_rps': total / wall_seconds if wall_seconds else None,
+            'endpoints': endpoints,
+        }
@@ -0,0 +1,45 @@
+import math
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(int(math.ceil(pct / 100.0 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(values):
+    """
+    Reduce a list of samples to the summary we report everywhere:
+    count, min/max/mean and p50/p95/p99.
+    """
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'min': values[0],
+        'max': values[-1],
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+    }
+
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def histogram(values, buckets=LATENCY_BUCKETS_MS):
+    """Cumulative-free bucket counts keyed by upper bound, plus '+Inf'."""
+    counts = {str(bound): 0 for bound in buckets}
+    counts['+Inf'] = 0
+    for value in values:
+        for bound in buckets:
+            if value <= bound:
+                counts[str(bound)] += 1
+                break
+        else:
+            counts['+Inf'] += 1
+    return counts
@@ -0,0 +1,120 @@
+"""
+Primary/replica database routing.
+
+Reads go to a replica only while ``reading_from_replica`` is on, which
+ReplicaRoutingMiddleware does for safe-method requests (GET, HEAD, OPTIONS)
+from clients that have not written recently. Everything else stays on the
+primary: writes, requests that write, background jobs (settlement, route
+splicing), match refreshes outside a request and management commands.
+
+After a successful write request the middleware sets a short-lived cookie
+(REPLICA_STICKY_SECONDS) so that client's next reads also use the primary
+and see its own writes despite replication lag. It also records
+``primary_until:<user id>`` in the cache, so the same user's other
+clients (a second device, a token client without cookies) do too.
+
+One replica is picked per request, so a response never mixes snapshots
+from replicas at different lag. A GET that writes as a side effect (an
+inline match refresh) calls ``use_primary`` before reading its own writes.
+"""
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+_replica = contextvars.ContextVar('replica', default=None)  # Alias reads go to, None for the primary
+
+STICKY_COOKIE = 'primary_until'
+STICKY_CACHE_KEY = 'primary_until:{}'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def replica_alias():
+    """A replica alias to read from, or 'default' when none is configured."""
+    aliases = replicas()
+    return random.choice(aliases) if aliases else 'default'
+
+
+@contextmanager
+def reading_from_replica(enabled=True):
+    """Send reads in this context to one replica, chosen now."""
+    token = _replica.set(replica_alias() if enabled else None)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+def use_primary():
+    """Read from the primary for the rest of the current ``reading_from_replica`` context."""
+    _replica.set(None)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return _replica.get() or 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+
+class ReplicaRoutingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        use_replica = request.method in SAFE_METHODS and bool(replicas()) and not self._sticky(request)
+        with reading_from_replica(use_replica):
+            response = self.get_response(request)
+
+        if request.method not in SAFE_METHODS and response.status_code < 400 and replicas():
+            seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+            until = int(time.time() + seconds)
+            response.set_cookie(STICKY_COOKIE, str(until), max_age=seconds, httponly=True, samesite='Lax')
+            # DRF sets request.user on the underlying request once it authenticates
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                cache.set(STICKY_CACHE_KEY.format(user.pk), until, seconds)
+        return response
+
+    @classmethod
+    def _sticky(cls, request):
+        try:
+            if float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time():
+                return True
+        except ValueError:
+            pass
+        user_id = cls._user_id(request)
+        return user_id is not None and cache.get(STICKY_CACHE_KEY.format(user_id), 0) > time.time()
+
+    @staticmethod
+    def _user_id(request):
+        """
+        The caller's user id, read before routing. API clients authenticate
+        with a token that DRF only reads inside the view, so its owner is
+        looked up here (on the primary) too.
+        """
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return user.pk
+        from rest_framework.authentication import get_authorization_header
+        from rest_framework.authtoken.models import Token
+        auth = get_authorization_header(request).split()
+        if len(auth) != 2 or auth[0].lower() != b'token':
+            return None
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            return None
+        return Token.objects.using('default').filter(key=key).values_list('user_id', flat=True).first()
@@ -0,0 +1,99 @@
+"""Background job handlers. Imported by CoreConfig.ready() to register them."""
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import metrics
+from .models import Trip, Offer, Wallet, Transaction
+from .services import graph_service, match_service, quote_service, version_channel
+from .services.job_queue import handler, PermanentJobError
+
+
+SPLICE_ATTEMPTS = 5  # Route compare-and-set tries before the job is retried later
+
+
+@handler('splice_route')
+def splice_route(payload):
+    """
+    Insert an accepted offer's pickup and dropoff into its trip's route.
+
+    The trip is not locked while the detour is searched. The new route is
+    written only if route_version is still the one it was built from, and
+    rebuilt from the fresh route when another splice got there first.
+    """
+    offer = Offer.objects.select_related('request').get(pk=payload['offer_id'])
+    carpool_req = offer.request
+    pickup_id, dropoff_id = carpool_req.pickup_node_id, carpool_req.dropoff_node_id
+    for _ in range(SPLICE_ATTEMPTS):
+        trip = Trip.objects.get(pk=offer.trip_id)
+        curr_idx = trip.current_route_index()
+        remaining_route = trip.route[curr_idx:]
+
+        # A retried job may find the stops already spliced in
+        if pickup_id in remaining_route and dropoff_id in remaining_route[remaining_route.index(pickup_id):]:
+            return {'trip': trip.pk, 'route': trip.route, 'changed': False}
+
+        # The route priced into the offer is still good unless the trip
+        # route changed or the driver already passed the splice point
+        if quote_service.route_still_valid(trip, offer.route, offer.route_version):
+            route = offer.route
+        else:
+            new_route, _ = graph_service.calculate_best_detour(remaining_route, pickup_id, dropoff_id)
+            if not new_route:
+                raise PermanentJobError('The request can no longer be reached from the trip route.')
+            route = trip.route[:curr_idx] + new_route
+
+        with transaction.atomic():
+            if Trip.objects.filter(pk=trip.pk, route_version=trip.route_version).update(
+                    route=route, route_version=F('route_version') + 1, updated_at=timezone.now()):
+                # update() sends no post_save signal
+                version_channel.publish('trip', {'trips': [trip.pk]})
+                version_channel.poll_on_commit()
+                transaction.on_commit(lambda: match_service.schedule_trip(trip.pk))
+                return {'trip': trip.pk, 'route': route, 'changed': True}
+        metrics.ROUTE_SPLICE_CONFLICTS.inc()
+    raise RuntimeError(f'Route of trip {offer.trip_id} kept changing during the splice.')
+
+
+@handler('settle_trip')
+def settle_trip(payload):
+    """Charge every accepted passenger, pay the driver and complete the trip."""
+    with metrics.SETTLEMENT_LATENCY.time(), transaction.atomic():
+        trip = Trip.objects.select_for_update().get(pk=payload['trip_id'])
+        if trip.status == 'COMPLETED':
+            return {'trip': trip.pk, 'settled_offers': 0}
+
+        accepted_offers = Offer.objects.filter(trip=trip, status='ACCEPTED').select_related('request__passenger')
+        driver_wallet = Wallet.objects.get(user_id=trip.driver_id)
+        settled = 0
+        for offer in accepted_offers:
+            passenger = offer.request.passenger
+            # Debit only if the balance covers the fare, atomically
+            debited = Wallet.objects.filter(user=passenger, balance__gte=offer.fare).update(
+                balance=F('balance') - offer.fare)
+            if not debited:
+                metrics.SETTLEMENTS.inc(outcome='insufficient_balance')
+                raise PermanentJobError(f'Passenger {passenger.username} has insufficient balance.')
+            Wallet.objects.filter(pk=driver_wallet.pk).update(balance=F('balance') + offer.fare)
+
+            # Record transactions
+            Transaction.objects.create(
+                wallet=passenger.wallet, amount=-offer.fare,
+                transaction_type='FARE_PAYMENT', trip=trip
+            )
+            Transaction.objects.create(
+                wallet=driver_wallet, amount=offer.fare,
+                transaction_type='EARNING', trip=trip
+            )
+
+            # Mark request completed
+            req = offer.request
+            req.status = 'COMPLETED'
+            req.save()
+            settled += 1
+            metrics.SETTLED_OFFERS.inc()
+
+        trip.status = 'COMPLETED'
+        trip.save()
+        metrics.SETTLEMENTS.inc(outcome='completed')
+    return {'trip': trip.pk, 'settled_offers': settled}
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.services import archive_service
+
+
+class Command(BaseCommand):
+    help = ('Move completed/cancelled trips (with their offers) and finished requests older than '
+            '--days into the archive tables. Safe to interrupt and run again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, required=True, help='Archive rows created more than this many days ago.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows moved per transaction.')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0 or options['batch_size'] < 1:
+            raise CommandError('--days must be >= 0 and --batch-size >= 1.')
+
+        def progress(totals):
+            self.stdout.write('Archived {trips} trip(s), {offers} offer(s), {requests} request(s) so far'.format(**totals))
+
+        totals = archive_service.archive(options['days'], options['batch_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(
+            'Archived {trips} trip(s), {offers} offer(s), {requests} request(s).'.format(**totals)))
@@ -0,0 +1,256 @@
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from core.bench import generators
+from core.bench.stats import summarize
+from core.middleware import QueryCounter
+from core.models import Offer, Wallet
+from core.services import graph_index, graph_service, job_queue
+from core.views import TripViewSet, OfferViewSet
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark routing and matching on seeded synthetic cities. '
+        'Runs against a throwaway test database and writes a JSON report.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--graphs', nargs='+', default=['grid', 'geometric', 'scalefree'],
+                            choices=sorted(generators.GENERATORS))
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000],
+                            help='Node counts to generate (1k to 500k).')
+        parser.add_argument('--trips', type=int, default=20)
+        parser.add_argument('--requests', type=int, default=100)
+        parser.add_argument('--samples', type=int, default=20,
+                            help='Timed calls per operation.')
+        parser.add_argument('--route-hops', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', default='bench_output.json')
+        parser.add_argument('--noinput', action='store_false', dest='interactive')
+
+    def handle(self, *args, **options):
+        for size in options['sizes']:
+            if size < 2:
+                raise CommandError('Graph sizes must be at least 2 nodes.')
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=not options['interactive'], serialize=False
+        )
+        # Background match refreshes would compete with the timed calls
+        background = override_settings(MATCH_WORKER='off')
+        background.enable()
+        try:
+            runs = []
+            for kind in options['graphs']:
+                for size in options['sizes']:
+                    self.stdout.write(f'Benchmarking {kind} graph with {size} nodes...')
+                    runs.append(self.run_one(kind, size, options))
+                    self.flush_database()
+        finally:
+            background.disable()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'meta': {
+                'timestamp': timezone.now().isoformat(),
+                'seed': options['seed'],
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'trips': options['trips'],
+                'requests': options['requests'],
+                'samples': options['samples'],
+            },
+            'runs': runs,
+        }
+        with open(options['output'], 'w') as fh:
+            json.dump(report, fh, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def flush_database(self):
+        from django.core.management import call_command
+        call_command('flush', verbosity=0, interactive=False)
+
+    def measure(self, name, calls, results):
+        """Time each zero-argument callable and record latency and SQL counts."""
+        latencies = []
+        queries = []
+        for call in calls:
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                start = time.perf_counter()
+                call()
+                elapsed = time.perf_counter() - start
+            latencies.append(elapsed * 1000)
+            queries.append(counter.count)
+        results[name] = {
+            'latency_ms': summarize(latencies),
+            'queries': summarize(queries),
+        }
+        summary = results[name]['latency_ms']
+        if summary['count']:
+            self.stdout.write(
+                f"  {name:<22} p50={summary['p50']:.2f}ms p95={summary['p95']:.2f}ms "
+                f"p99={summary['p99']:.2f}ms queries(p50)={results[name]['queries']['p50']}"
+            )
+
+    def measure_cold_start(self):
+        """Seconds to load the routing index from the database and from a CSR snapshot."""
+        from django.core.management import call_command
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'graph.csr')
+        timings = {}
+        try:
+            with override_settings(GRAPH_SNAPSHOT_PATH=None):
+                graph_index.invalidate()
+                start = time.perf_counter()
+                graph_index.current()
+                timings['database_seconds'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            call_command('build_graph_snapshot', output=path, stdout=io.StringIO())
+            timings['snapshot_build_seconds'] = time.perf_counter() - start
+            timings['snapshot_bytes'] = os.path.getsize(path)
+
+            with override_settings(GRAPH_SNAPSHOT_PATH=path):
+                graph_index.invalidate()
+                start = time.perf_counter()
+                graph_index.current()
+                timings['snapshot_seconds'] = time.perf_counter() - start
+                timings['snapshot_source'] = graph_index.status()['source']
+        finally:
+            graph_index.invalidate()
+            shutil.rmtree(directory, ignore_errors=True)
+        self.stdout.write(
+            f"  {'cold_start':<22} database={timings['database_seconds'] * 1000:.1f}ms "
+            f"snapshot={timings['snapshot_seconds'] * 1000:.1f}ms"
+        )
+        return timings
+
+    def run_one(self, kind, size, options):
+        seed = options['seed']
+        rng = random.Random(seed)
+        samples = options['samples']
+
+        start = time.perf_counter()
+        n, edges = generators.GENERATORS[kind](size, seed=seed)
+        generate_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        node_ids = generators.load_graph(kind, n, edges)
+        adjacency = generators.adjacency_from_edges(n, edges)
+        trips, requests = generators.create_population(
+            adjacency, node_ids, options['trips'], options['requests'],
+            seed=seed, route_hops=options['route_hops'],
+        )
+        load_seconds = time.perf_counter() - start
+
+        # Requests that sit on or next to each trip's route, for the
+        # detour, offer and settlement operations.
+        index_of = {node_id: i for i, node_id in enumerate(node_ids)}
+        candidates = []
+        for trip in trips:
+            near = set()
+            for node_id in trip.route:
+                near.add(node_id)
+                near.update(node_ids[j] for j in adjacency[index_of[node_id]])
+            for req in requests:
+                if req.pickup_node_id in near and req.dropoff_node_id in near:
+                    candidates.append((trip, req))
+                    break
+
+        cold_start = self.measure_cold_start()
+
+        results = {}
+        pairs = [(rng.choice(trips).route[0], rng.choice(trips).route[-1]) for _ in range(samples)]
+        self.measure('get_shortest_path', [
+            (lambda a=a, b=b: graph_service.get_shortest_path(a, b)) for a, b in pairs
+        ], results)
+
+        radius_samples = [(rng.choice(trips), rng.choice(requests)) for _ in range(samples)]
+        self.measure('is_within_radius', [
+            (lambda t=t, r=r: graph_service.is_within_radius(t.route, r.pickup_node_id))
+            for t, r in radius_samples
+        ], results)
+
+        detour_samples = [rng.choice(candidates) for _ in range(samples)] if candidates else []
+        self.measure('calculate_best_detour', [
+            (lambda t=t, r=r: graph_service.calculate_best_detour(
+                t.route, r.pickup_node_id, r.dropoff_node_id))
+            for t, r in detour_samples
+        ], results)
+
+        factory = APIRequestFactory()
+        matching_view = TripViewSet.as_view({'get': 'matching_requests'})
+
+        def matching(trip):
+            request = factory.get(f'/api/trips/{trip.id}/matching_requests/')
+            force_authenticate(request, user=trip.driver)
+            matching_view(request, pk=trip.id).render()
+
+        self.measure('matching_requests', [
+            (lambda t=t: matching(t)) for t in rng.sample(trips, min(samples, len(trips)))
+        ], results)
+
+        create_view = OfferViewSet.as_view({'post': 'create'})
+        created = []
+
+        def create_offer(trip, req):
+            request = factory.post('/api/offers/', {'trip': trip.id, 'request': req.id}, format='json')
+            force_authenticate(request, user=trip.driver)
+            response = create_view(request)
+            response.render()
+            if response.status_code == 201:
+                created.append(response.data['id'])
+
+        self.measure('offer_create', [
+            (lambda t=t, r=r: create_offer(t, r)) for t, r in candidates[:samples]
+        ], results)
+
+        # Settlement needs accepted offers and funded passengers.
+        Offer.objects.filter(id__in=created).update(status='ACCEPTED')
+        Wallet.objects.filter(user__requests__offers__id__in=created).update(balance=Decimal('1000.00'))
+        complete_view = OfferViewSet.as_view({'post': 'complete_trip'})
+
+        def complete(offer):
+            request = factory.post(f'/api/offers/{offer.id}/complete_trip/')
+            force_authenticate(request, user=offer.trip.driver)
+            complete_view(request, pk=offer.id).render()
+
+        offers = Offer.objects.filter(id__in=created).select_related('trip__driver')
+        self.measure('complete_trip', [(lambda o=o: complete(o)) for o in offers], results)
+
+        # complete_trip only enqueues; time the settlement jobs themselves
+        claimed = []
+        job = job_queue.claim('bench')
+        while job is not None:
+            claimed.append(job)
+            job = job_queue.claim('bench')
+        self.measure('settle_trip_job', [(lambda j=j: job_queue.execute(j)) for j in claimed], results)
+
+        return {
+            'graph': kind,
+            'nodes': n,
+            'edges': len(edges),
+            'generate_seconds': generate_seconds,
+            'load_seconds': load_seconds,
+            'cold_start': cold_start,
+            'operations': results,
+        }
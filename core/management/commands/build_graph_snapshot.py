@@ -0,0 +1,44 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.db_router import replica_alias
+from core.models import Edge
+from core.services import graph_snapshot, version_channel
+
+
+class Command(BaseCommand):
+    help = 'Write the Edge table to the binary CSR file that web processes memory-map at startup.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None, help='Defaults to settings.GRAPH_SNAPSHOT_PATH.')
+        parser.add_argument('--if-stale', action='store_true',
+                            help='Do nothing if the existing file is at the current graph version.')
+
+    def handle(self, *args, **options):
+        path = options['output'] or getattr(settings, 'GRAPH_SNAPSHOT_PATH', None)
+        if not path:
+            raise CommandError('No --output given and GRAPH_SNAPSHOT_PATH is not set.')
+
+        alias = replica_alias()
+        # Read the version before the edges; processes loading the file
+        # replay every change logged after it. The settled version, so a
+        # change that commits late is never left below it.
+        version = version_channel.settled_version('graph', using=alias)
+        if options['if_stale']:
+            try:
+                existing = graph_snapshot.load(path)
+            except graph_snapshot.InvalidSnapshot:
+                existing = None
+            if existing is not None and existing.graph_version == version:
+                self.stdout.write(f'{path} is up to date (graph version {version}).')
+                return
+
+        started = time.perf_counter()
+        edges = list(Edge.objects.using(alias).values_list('from_node_id', 'to_node_id').order_by('id'))
+        max_edge_id = Edge.objects.using(alias).order_by('-id').values_list('id', flat=True).first() or 0
+        graph_snapshot.write(path, edges, max_edge_id=max_edge_id, graph_version=version)
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {len(edges)} edges at graph version {version} to {path} '
+            f'in {time.perf_counter() - started:.2f}s.'))
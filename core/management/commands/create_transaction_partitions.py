@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from core.services import ledger_service
+
+
+class Command(BaseCommand):
+    help = ('Create monthly core_transaction partitions ahead of time (PostgreSQL). '
+            'The job workers also run this every minute.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=3, help='Months to cover, starting with the current one.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            self.stdout.write('Transactions are only partitioned on PostgreSQL; nothing to do.')
+            return
+        created = ledger_service.create_partitions(timezone.now().date(), options['months'])
+        for name in created:
+            self.stdout.write(f'Created {name}')
+        self.stdout.write(self.style.SUCCESS(f'{len(created)} partition(s) created.'))
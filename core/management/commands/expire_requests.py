@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.services import archive_service
+
+
+class Command(BaseCommand):
+    help = 'Mark pending carpool requests older than CARPOOL_REQUEST_TTL as expired.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        expired = archive_service.expire_requests(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Expired {expired} request(s).'))
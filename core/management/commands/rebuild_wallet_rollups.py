@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.services import ledger_service
+
+
+class Command(BaseCommand):
+    help = 'Recompute daily and monthly wallet rollups from the transaction ledger.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wallet', type=int, action='append', dest='wallets',
+                            help='Only rebuild this wallet id (repeatable).')
+
+    def handle(self, *args, **options):
+        written = ledger_service.rebuild_rollups(options['wallets'])
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} rollup row(s).'))
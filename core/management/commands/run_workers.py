@@ -0,0 +1,71 @@
+import logging
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from core.services import job_queue, archive_service, ledger_service, version_channel
+
+logger = logging.getLogger(__name__)
+
+# Run every minute by the main thread: requeue jobs abandoned by workers
+# that died elsewhere, expire pending requests that outlived
+# CARPOOL_REQUEST_TTL, and keep transaction partitions ahead of the clock
+# and the change log short
+MAINTENANCE = [
+    ('requeue_stale', lambda: job_queue.requeue_stale()),
+    ('expire_requests', lambda: archive_service.expire_requests()),
+    ('create_partitions', lambda: ledger_service.create_partitions(timezone.now().date(), 3)),
+    ('prune_changes', lambda: version_channel.prune()),
+]
+
+
+class Command(BaseCommand):
+    help = 'Run background job workers (route splicing, settlement) against the database queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='Worker threads in this process.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait between polls when the queue is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Run every due job once and exit instead of polling forever.')
+
+    def handle(self, *args, **options):
+        requeued = job_queue.requeue_stale()
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} abandoned job(s).')
+
+        if options['once']:
+            ran = job_queue.run_pending()
+            self.stdout.write(self.style.SUCCESS(f'Ran {ran} job(s).'))
+            return
+
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+
+        threads = [
+            threading.Thread(target=job_queue.work, args=(stop,),
+                             kwargs={'poll_interval': options['poll_interval']}, daemon=True)
+            for _ in range(max(options['workers'], 1))
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f"Started {len(threads)} worker(s); Ctrl-C to stop.")
+        while not stop.wait(60):
+            self.maintain()
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def maintain():
+        """Run each MAINTENANCE task; a failing one is logged and the rest still run."""
+        for name, task in MAINTENANCE:
+            close_old_connections()  # Drop a connection the database closed since
+            try:
+                task()
+            except Exception:
+                logger.exception('Maintenance task %s failed', name)
+        close_old_connections()
@@ -0,0 +1,272 @@
+"""
+Minimal Prometheus-style metrics.
+
+Recording is lock-free: every thread writes to its own shard of plain
+dicts, and shards are only summed when metrics are rendered or flushed.
+Under multi-worker gunicorn each process periodically dumps its totals to
+``settings.METRICS_DIR`` (one file per pid, replaced atomically), and the
+``/metrics`` view of whichever worker is scraped merges every file. Without
+``METRICS_DIR`` only the scraped process's own values are reported.
+"""
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+_registry = {}
+_shards = []
+_local = threading.local()
+_last_flush = [0.0]
+
+
+def _after_fork():
+    # A forked worker starts from zero: the parent's shards stay with the
+    # parent (which flushes them to its own file), or they would be
+    # reported once per worker
+    global _shards, _local
+    _shards = []
+    _local = threading.local()
+    _last_flush[0] = 0.0
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = {}
+        _shards.append(shard)  # list.append is atomic under the GIL
+    return shard
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry[name] = self
+
+    def _key(self, labels):
+        return (self.name, tuple(str(labels.get(label, '')) for label in self.labelnames))
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = _shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        shard = _shard()
+        key = self._key(labels)
+        state = shard.get(key)
+        if state is None:
+            # Per-bucket (non-cumulative) counts, then sum and count
+            state = shard[key] = [0] * (len(self.buckets) + 3)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        else:
+            state[len(self.buckets)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def _merge(into, key, value):
+    if isinstance(value, list):
+        existing = into.get(key)
+        if existing is None:
+            into[key] = list(value)
+        else:
+            for i, v in enumerate(value):
+                existing[i] += v
+    else:
+        into[key] = into.get(key, 0) + value
+
+
+def collect():
+    """Totals for this process, summed over all thread shards."""
+    totals = {}
+    for shard in list(_shards):
+        for key, value in list(shard.items()):
+            _merge(totals, key, value)
+    return totals
+
+
+def _metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None)
+
+
+def _encode(totals):
+    return [[name, list(labels), value] for (name, labels), value in totals.items()]
+
+
+def _decode(rows):
+    return {(name, tuple(labels)): value for name, labels, value in rows}
+
+
+def flush(force=False):
+    """Write this process's totals to METRICS_DIR if the interval elapsed."""
+    directory = _metrics_dir()
+    if not directory:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush[0] < getattr(settings, 'METRICS_FLUSH_INTERVAL', 5):
+        return
+    _last_flush[0] = now
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(_encode(collect()), fh)
+    os.replace(tmp_path, path)
+
+
+def collect_all():
+    """Totals across every worker that has written to METRICS_DIR."""
+    own = collect()
+    directory = _metrics_dir()
+    if not directory or not os.path.isdir(directory):
+        return own
+    own_file = f'metrics-{os.getpid()}.json'
+    totals = {}
+    for filename in os.listdir(directory):
+        if not filename.endswith('.json') or filename == own_file:
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as fh:
+                rows = _decode(json.load(fh))
+        except (OSError, ValueError):
+            continue
+        for key, value in rows.items():
+            _merge(totals, key, value)
+    for key, value in own.items():
+        _merge(totals, key, value)
+    return totals
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    totals = collect_all()
+    by_name = {}
+    for (name, labels), value in totals.items():
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(_registry):
+        metric = _registry[name]
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for labels, value in sorted(by_name.get(name, ())):
+            if metric.kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(metric.buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(metric.labelnames, labels, [('le', bound)])} {cumulative}")
+                cumulative += value[len(metric.buckets)]
+                lines.append(f"{name}_bucket{_format_labels(metric.labelnames, labels, [('le', '+Inf')])} {cumulative}")
+                lines.append(f'{name}_sum{_format_labels(metric.labelnames, labels)} {value[-2]}')
+                lines.append(f'{name}_count{_format_labels(metric.labelnames, labels)} {value[-1]}')
+            else:
+                lines.append(f'{name}{_format_labels(metric.labelnames, labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics shared by the middleware and the service layer
+
+HTTP_REQUESTS = Counter(
+    'carpool_http_requests_total', 'HTTP requests by view, method and status.',
+    ['view', 'method', 'status'])
+HTTP_LATENCY = Histogram(
+    'carpool_http_request_duration_seconds', 'View latency in seconds.',
+    ['view', 'method'])
+HTTP_QUERIES = Histogram(
+    'carpool_http_request_queries', 'SQL queries executed per request.',
+    ['view', 'method'], buckets=COUNT_BUCKETS)
+
+GRAPH_SEARCHES = Counter(
+    'carpool_graph_searches_total', 'Graph searches run, by function.', ['function'])
+GRAPH_EXPANSIONS = Counter(
+    'carpool_graph_bfs_expansions_total', 'Nodes expanded by BFS searches, by function.', ['function'])
+GRAPH_INDEX_LOAD = Histogram(
+    'carpool_graph_index_load_seconds', 'Time to load the routing index, by source (snapshot, database).',
+    ['source'])
+DETOUR_CANDIDATES = Counter(
+    'carpool_detour_candidates_total', 'Insertion points evaluated by calculate_best_detour.')
+DETOUR_LATENCY = Histogram(
+    'carpool_detour_duration_seconds', 'Time spent in calculate_best_detour.')
+
+FARE_CALCULATIONS = Counter(
+    'carpool_fare_calculations_total', 'Fare calculations, by function.', ['function'])
+FARE_HOPS = Histogram(
+    'carpool_fare_hops', 'Hops covered by a passenger fare.', buckets=COUNT_BUCKETS)
+
+QUOTE_CHECKS = Counter(
+    'carpool_quote_checks_total', 'Quote tokens presented, by outcome (reused, stale, invalid).', ['outcome'])
+
+SETTLEMENTS = Counter(
+    'carpool_settlements_total', 'Trip settlements, by outcome.', ['outcome'])
+SETTLED_OFFERS = Counter(
+    'carpool_settled_offers_total', 'Accepted offers paid out during settlement.')
+SETTLEMENT_LATENCY = Histogram(
+    'carpool_settlement_duration_seconds', 'Time spent settling a trip.')
+
+POSITION_UPDATES = Counter(
+    'carpool_position_updates_total', 'Position updates received, by outcome (buffered, coalesced, rejected).',
+    ['outcome'])
+POSITION_FLUSHES = Counter(
+    'carpool_position_flushes_total', 'Position buffer flushes, by outcome.', ['outcome'])
+POSITION_FLUSH_TRIPS = Histogram(
+    'carpool_position_flush_trips', 'Trips written per position flush.', buckets=COUNT_BUCKETS)
+
+OFFER_ACCEPTS = Counter(
+    'carpool_offer_accepts_total',
+    'Offer acceptances, by outcome (accepted, not_pending, request_taken, expired, full).', ['outcome'])
+ROUTE_SPLICE_CONFLICTS = Counter(
+    'carpool_route_splice_conflicts_total', 'Route splices retried because the trip route changed underneath.')
@@ -0,0 +1,93 @@
+import random
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from . import metrics
+
+
+def is_staff_request(request):
+    """
+    Whether the caller is staff, checked before any view runs. API clients
+    authenticate with a token that DRF only reads inside the view, so the
+    token is checked here too.
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.is_staff
+    from rest_framework.authentication import TokenAuthentication
+    from rest_framework.exceptions import AuthenticationFailed
+    try:
+        authenticated = TokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return authenticated is not None and authenticated[0].is_staff
+
+
+class QueryCounter:
+    """execute_wrapper that only counts, so it works with DEBUG off."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware:
+    """Records per-view latency, status and SQL query counts."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        metrics.HTTP_REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        metrics.HTTP_LATENCY.observe(elapsed, view=view, method=request.method)
+        metrics.HTTP_QUERIES.observe(counter.count, view=view, method=request.method)
+        metrics.flush()
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profiles a request when a staff user sends the PROFILING_HEADER header,
+    or for a PROFILING_SAMPLE_RATE fraction of all requests. Removed from the
+    stack entirely unless PROFILING_ENABLED is set.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.header = 'HTTP_' + settings.PROFILING_HEADER.upper().replace('-', '_')
+        self.sample_rate = settings.PROFILING_SAMPLE_RATE
+
+    def __call__(self, request):
+        trigger = None
+        if self.header in request.META:
+            if is_staff_request(request):
+                trigger = 'HEADER'
+        elif self.sample_rate and random.random() < self.sample_rate:
+            trigger = 'SAMPLE'
+        if trigger is None:
+            return self.get_response(request)
+
+        from .profiling import ProfiledRun
+        with ProfiledRun() as run:
+            response = self.get_response(request)
+        run.save(request, response, trigger)
+        return response
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.16 on 2026-10-19 07:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_request_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='matches_refreshed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='TripMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('route', models.JSONField()),
+                ('detour', models.IntegerField()),
+                ('fare', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('computed_at', models.DateTimeField()),
+                ('request', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='core.carpoolrequest')),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='core.trip')),
+            ],
+            options={
+                'unique_together': {('trip', 'request')},
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.16 on 2026-10-19 07:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_job_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='route_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='route',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='route_version',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tripmatch',
+            name='route_version',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='tripmatch',
+            name='graph_version',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='tripmatch',
+            name='passengers',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+    ]
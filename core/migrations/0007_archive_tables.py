@@ -0,0 +1,77 @@
+# Generated by Django 4.2.16 on 2026-10-19 08:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_quote_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedCarpoolRequest',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('passenger', models.IntegerField(db_index=True)),
+                ('pickup_node', models.IntegerField()),
+                ('dropoff_node', models.IntegerField()),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('ACCEPTED', 'Accepted'), ('COMPLETED', 'Completed'), ('CANCELLED', 'Cancelled'), ('EXPIRED', 'Expired')], max_length=20)),
+                ('created_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedOffer',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('trip', models.BigIntegerField(db_index=True)),
+                ('request', models.BigIntegerField(db_index=True)),
+                ('driver', models.IntegerField(db_index=True)),
+                ('passenger', models.IntegerField(db_index=True)),
+                ('fare', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('detour', models.IntegerField()),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('ACCEPTED', 'Accepted'), ('REJECTED', 'Rejected')], max_length=20)),
+                ('route', models.JSONField(blank=True, null=True)),
+                ('route_version', models.PositiveIntegerField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedTrip',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('driver', models.IntegerField(db_index=True)),
+                ('start_node', models.IntegerField()),
+                ('end_node', models.IntegerField()),
+                ('route', models.JSONField()),
+                ('route_version', models.PositiveIntegerField(default=0)),
+                ('current_node', models.IntegerField(blank=True, null=True)),
+                ('passed_nodes', models.JSONField(default=list)),
+                ('max_passengers', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('SCHEDULED', 'Scheduled'), ('ACTIVE', 'Active'), ('COMPLETED', 'Completed'), ('CANCELLED', 'Cancelled')], max_length=20)),
+                ('created_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='carpoolrequest',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('ACCEPTED', 'Accepted'), ('COMPLETED', 'Completed'), ('CANCELLED', 'Cancelled'), ('EXPIRED', 'Expired')], default='PENDING', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='trip',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='core.trip'),
+        ),
+        migrations.AddIndex(
+            model_name='carpoolrequest',
+            index=models.Index(fields=['status', 'created_at'], name='core_carpoo_status_893b70_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['status', 'created_at'], name='core_trip_status_8fc7c2_idx'),
+        ),
+    ]
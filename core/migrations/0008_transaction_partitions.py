@@ -0,0 +1,121 @@
+# Generated by Django 4.2.16 on 2026-10-19 08:40
+
+from datetime import date
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDay, TruncMonth
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def _next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def partition_transactions(apps, schema_editor):
+    """
+    Rebuild core_transaction as a table range-partitioned by month on
+    created_at. PostgreSQL only; elsewhere the plain table and its
+    (wallet, created_at) index stay as they are. The primary key becomes
+    (id, created_at) as partitioning requires; ids still come from one
+    sequence so they stay unique.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    execute = schema_editor.execute
+    execute('ALTER TABLE core_transaction RENAME TO core_transaction_unpartitioned')
+    execute('CREATE SEQUENCE core_transaction_id_seq_partitioned')
+    execute("""
+        CREATE TABLE core_transaction (
+            id bigint NOT NULL DEFAULT nextval('core_transaction_id_seq_partitioned'),
+            amount numeric(10, 2) NOT NULL,
+            transaction_type varchar(20) NOT NULL,
+            created_at timestamp with time zone NOT NULL,
+            trip_id bigint NULL,
+            wallet_id bigint NOT NULL REFERENCES core_wallet (id) DEFERRABLE INITIALLY DEFERRED,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    execute('CREATE TABLE core_transaction_default PARTITION OF core_transaction DEFAULT')
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT min(created_at) FROM core_transaction_unpartitioned')
+        first = cursor.fetchone()[0]
+    month = (first or timezone.now()).date().replace(day=1)
+    last = _next_month(_next_month(_next_month(timezone.now().date().replace(day=1))))
+    while month < last:
+        end = _next_month(month)
+        execute(f'CREATE TABLE core_transaction_{month:%Y_%m} PARTITION OF core_transaction '
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{end.isoformat()}')")
+        month = end
+
+    execute("""
+        INSERT INTO core_transaction (id, amount, transaction_type, created_at, trip_id, wallet_id)
+        SELECT id, amount, transaction_type, created_at, trip_id, wallet_id FROM core_transaction_unpartitioned
+    """)
+    # Check the deferred wallet FK for the copied rows now: PostgreSQL
+    # refuses CREATE INDEX on a table with pending trigger events
+    execute('SET CONSTRAINTS ALL IMMEDIATE')
+    execute("SELECT setval('core_transaction_id_seq_partitioned', COALESCE(max(id), 0) + 1, false) "
+            'FROM core_transaction')
+    execute('DROP TABLE core_transaction_unpartitioned CASCADE')
+    execute('ALTER SEQUENCE core_transaction_id_seq_partitioned OWNED BY core_transaction.id')
+    execute('CREATE INDEX core_transaction_wallet_time ON core_transaction (wallet_id, created_at)')
+    execute('CREATE INDEX core_transaction_trip_id ON core_transaction (trip_id)')
+
+
+def build_rollups(apps, schema_editor):
+    Transaction = apps.get_model('core', 'Transaction')
+    WalletRollup = apps.get_model('core', 'WalletRollup')
+    rows = []
+    for period, trunc in (('DAY', TruncDay), ('MONTH', TruncMonth)):
+        totals = (Transaction.objects.annotate(period_start=trunc('created_at'))
+                  .values('wallet_id', 'period_start', 'transaction_type')
+                  .annotate(total=Sum('amount'), count=Count('id')))
+        for row in totals:
+            start = row['period_start']
+            rows.append(WalletRollup(
+                wallet_id=row['wallet_id'], period=period, transaction_type=row['transaction_type'],
+                period_start=start.date() if hasattr(start, 'date') else start,
+                total=row['total'], count=row['count']))
+    WalletRollup.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_archive_tables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalletRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('DAY', 'Day'), ('MONTH', 'Month')], max_length=5)),
+                ('period_start', models.DateField()),
+                ('transaction_type', models.CharField(choices=[('TOPUP', 'Top-up'), ('FARE_PAYMENT', 'Fare Payment'), ('EARNING', 'Driver Earning')], max_length=20)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-period_start', 'transaction_type'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet', 'created_at'], name='core_transaction_wallet_time'),
+        ),
+        migrations.AddField(
+            model_name='walletrollup',
+            name='wallet',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='core.wallet'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='walletrollup',
+            unique_together={('wallet', 'period', 'period_start', 'transaction_type')},
+        ),
+        migrations.RunPython(partition_transactions, migrations.RunPython.noop),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
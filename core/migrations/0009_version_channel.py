@@ -0,0 +1,40 @@
+# Generated by Django 4.2.16 on 2026-10-19 11:20
+
+from django.db import migrations, models
+
+
+def create_counters(apps, schema_editor):
+    VersionCounter = apps.get_model('core', 'VersionCounter')
+    for name in ('graph', 'trip'):
+        VersionCounter.objects.using(schema_editor.connection.alias).get_or_create(name=name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_transaction_partitions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionCounter',
+            fields=[
+                ('name', models.CharField(max_length=20, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(max_length=20)),
+                ('version', models.BigIntegerField()),
+                ('payload', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('channel', 'version')},
+            },
+        ),
+        migrations.RunPython(create_counters, migrations.RunPython.noop),
+    ]
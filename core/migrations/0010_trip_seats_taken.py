@@ -0,0 +1,29 @@
+# Generated by Django 4.2.16 on 2026-10-19 12:05
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_accepted_offers(apps, schema_editor):
+    Trip = apps.get_model('core', 'Trip')
+    Offer = apps.get_model('core', 'Offer')
+    accepted = (Offer.objects.filter(trip=OuterRef('pk'), status='ACCEPTED')
+                .values('trip').annotate(count=Count('id')).values('count'))
+    Trip.objects.update(seats_taken=Coalesce(Subquery(accepted), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_version_channel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='seats_taken',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_accepted_offers, migrations.RunPython.noop),
+    ]
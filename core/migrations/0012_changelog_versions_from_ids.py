@@ -0,0 +1,56 @@
+# Generated by Django 4.2.16 on 2026-10-19 16:40
+
+from django.db import migrations, models
+from django.db.models import F, Max, Min
+
+
+def mark_pruned(apps, schema_editor):
+    # Versions become ChangeLog ids. Treat everything before a channel's
+    # oldest kept entry as pruned, so snapshot files written under the old
+    # numbering reload from the database unless their replay is still whole.
+    alias = schema_editor.connection.alias
+    ChangeLog = apps.get_model('core', 'ChangeLog')
+    PrunedVersion = apps.get_model('core', 'PrunedVersion')
+    PrunedVersion.objects.using(alias).all().delete()
+    oldest = ChangeLog.objects.using(alias).order_by().values('channel').annotate(oldest=Min('id'))
+    for row in oldest:
+        PrunedVersion.objects.using(alias).create(name=row['channel'], version=row['oldest'] - 1)
+
+
+def restore_counters(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    ChangeLog = apps.get_model('core', 'ChangeLog')
+    PrunedVersion = apps.get_model('core', 'PrunedVersion')
+    newest = dict(ChangeLog.objects.using(alias).order_by().values_list('channel').annotate(newest=Max('id')))
+    for name in ('graph', 'trip'):
+        PrunedVersion.objects.using(alias).update_or_create(name=name, defaults={'version': newest.get(name, 0)})
+
+
+def versions_from_ids(apps, schema_editor):
+    ChangeLog = apps.get_model('core', 'ChangeLog')
+    ChangeLog.objects.using(schema_editor.connection.alias).update(version=F('id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_trip_updated_at'),
+    ]
+
+    operations = [
+        migrations.RenameModel('VersionCounter', 'PrunedVersion'),
+        migrations.RenameField('PrunedVersion', 'value', 'version'),
+        migrations.AlterUniqueTogether(name='changelog', unique_together=set()),
+        migrations.AlterField(model_name='changelog', name='version', field=models.BigIntegerField(default=0)),
+        migrations.RunPython(migrations.RunPython.noop, versions_from_ids),
+        migrations.RemoveField(model_name='changelog', name='version'),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['channel', 'id'], name='core_change_channel_59415d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['created_at'], name='core_change_created_1da5d6_idx'),
+        ),
+        migrations.RunPython(mark_pruned, restore_counters),
+    ]
@@ -1,5 +1,9 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class Node(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -28,16 +32,52 @@ class Trip(models.Model):
     start_node = models.ForeignKey(Node, related_name='trips_starting', on_delete=models.CASCADE)
     end_node = models.ForeignKey(Node, related_name='trips_ending', on_delete=models.CASCADE)
     route = models.JSONField()  # Ordered list of node IDs
+    route_version = models.PositiveIntegerField(default=0)  # Bumped whenever route changes
     current_node = models.ForeignKey(Node, related_name='current_trips', on_delete=models.SET_NULL, null=True, blank=True)
     passed_nodes = models.JSONField(default=list)  # List of node IDs already passed
     max_passengers = models.PositiveIntegerField()
+    seats_taken = models.PositiveIntegerField(default=0)  # Accepted offers; see core.services.booking_service
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='SCHEDULED')
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)  # Set explicitly by update()/bulk_update() callers too
+    matches_refreshed_at = models.DateTimeField(null=True, blank=True)  # Last TripMatch refresh
+
+    # Fields the trip channel reports changes to (see core.services.version_channel)
+    PUBLISHED_FIELDS = ('route', 'status', 'current_node')
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'])]
 
     def __str__(self):
         return f"Trip by {self.driver} from {self.start_node} to {self.end_node}"
-    def get_occupancy_per_hop(self):      
-        route = self.route
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        trip = super().from_db(db, field_names, values)
+        trip._published_state = trip.published_state()
+        return trip
+
+    def published_state(self):
+        """The PUBLISHED_FIELDS values, or None if some were deferred."""
+        deferred = self.get_deferred_fields()
+        if any(field in deferred or f'{field}_id' in deferred for field in self.PUBLISHED_FIELDS):
+            return None
+        return (self.route, self.status, self.current_node_id)
+
+    def current_route_index(self):
+        """Index of current_node in the route, or 0 if it is unset or off-route."""
+        try:
+            return self.route.index(self.current_node_id)
+        except ValueError:
+            return 0
+
+    def get_occupancy_per_hop(self, route=None, accepted_offers=None):
+        """
+        Passengers on board for each hop of ``route`` (the trip's own route
+        by default). Pass ``accepted_offers`` to reuse an already fetched list.
+        """
+        if route is None:
+            route = self.route
         if not route or len(route) < 2:
             return []
     
@@ -45,11 +85,12 @@ class Trip(models.Model):
         occupancy = [0] * (len(route) - 1)
     
         # Get all accepted offers
-        accepted_offers = self.offers.filter(status='ACCEPTED')
+        if accepted_offers is None:
+            accepted_offers = self.offers.filter(status='ACCEPTED').select_related('request')
     
         for offer in accepted_offers:
-            pickup = offer.request.pickup_node.id
-            dropoff = offer.request.dropoff_node.id
+            pickup = offer.request.pickup_node_id
+            dropoff = offer.request.dropoff_node_id
     
             try:
                 start_idx = route.index(pickup)
@@ -63,12 +104,25 @@ class Trip(models.Model):
     
         return occupancy
 
+def request_expiry_cutoff():
+    """Pending requests created before this have expired, or None if CARPOOL_REQUEST_TTL is 0."""
+    ttl = getattr(settings, 'CARPOOL_REQUEST_TTL', 0)
+    return timezone.now() - timedelta(seconds=ttl) if ttl else None
+
+class CarpoolRequestQuerySet(models.QuerySet):
+    def pending(self):
+        """Pending requests that have not outlived CARPOOL_REQUEST_TTL."""
+        cutoff = request_expiry_cutoff()
+        queryset = self.filter(status='PENDING')
+        return queryset.filter(created_at__gte=cutoff) if cutoff else queryset
+
 class CarpoolRequest(models.Model):
     STATUS_CHOICES = [
         ('PENDING', 'Pending'),
         ('ACCEPTED', 'Accepted'),
         ('COMPLETED', 'Completed'),
         ('CANCELLED', 'Cancelled'),
+        ('EXPIRED', 'Expired'),
     ]
     passenger = models.ForeignKey(User, related_name='requests', on_delete=models.CASCADE)
     pickup_node = models.ForeignKey(Node, related_name='pickups', on_delete=models.CASCADE)
@@ -76,9 +130,21 @@ class CarpoolRequest(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = CarpoolRequestQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
     def __str__(self):
         return f"Request by {self.passenger}: {self.pickup_node} -> {self.dropoff_node}"
 
+    def is_expired(self):
+        """True once the request is EXPIRED or pending past its TTL (before expire_requests ran)."""
+        if self.status == 'EXPIRED':
+            return True
+        cutoff = request_expiry_cutoff()
+        return self.status == 'PENDING' and cutoff is not None and self.created_at < cutoff
+
 class Offer(models.Model):
     STATUS_CHOICES = [
         ('PENDING', 'Pending'),
@@ -90,10 +156,33 @@ class Offer(models.Model):
     fare = models.DecimalField(max_digits=10, decimal_places=2)
     detour = models.IntegerField()  # Number of extra nodes
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
+    route = models.JSONField(null=True, blank=True)  # Trip route with this passenger spliced in
+    route_version = models.PositiveIntegerField(null=True, blank=True)  # Trip.route_version it was computed against
 
     def __str__(self):
         return f"Offer for {self.request} by {self.trip.driver}"
 
+class TripMatch(models.Model):
+    """
+    A pending request that an active trip can serve, precomputed by
+    core.services.match_service so reads never run graph searches.
+    """
+    trip = models.ForeignKey(Trip, related_name='matches', on_delete=models.CASCADE)
+    request = models.ForeignKey(CarpoolRequest, related_name='matches', on_delete=models.CASCADE)
+    route = models.JSONField()  # Full trip route with the passenger spliced in
+    detour = models.IntegerField()  # Number of extra nodes
+    fare = models.DecimalField(max_digits=10, decimal_places=2)
+    route_version = models.PositiveIntegerField()  # Trip.route_version it was computed against
+    graph_version = models.PositiveIntegerField()  # graph_index version it was computed against
+    passengers = models.PositiveIntegerField()  # Accepted offers on the trip at the time
+    computed_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('trip', 'request')
+
+    def __str__(self):
+        return f"Match of {self.request} to trip {self.trip_id}"
+
 class Wallet(models.Model):
     user = models.OneToOneField(User, related_name='wallet', on_delete=models.CASCADE)
     balance = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
@@ -110,17 +199,248 @@ class Transaction(models.Model):
     wallet = models.ForeignKey(Wallet, related_name='transactions', on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPES)
-    trip = models.ForeignKey(Trip, null=True, blank=True, on_delete=models.SET_NULL)
+    # No database constraint: the ledger keeps pointing at trips after
+    # archive_rows moves them to ArchivedTrip.
+    trip = models.ForeignKey(Trip, null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # On PostgreSQL the table is range-partitioned by month on created_at
+    # (migration 0008, `manage.py create_transaction_partitions`).
+    class Meta:
+        indexes = [models.Index(fields=['wallet', 'created_at'], name='core_transaction_wallet_time')]
+
     def __str__(self):
         return f"{self.transaction_type}: {self.amount} ({self.wallet.user.username})"
 
+class WalletRollup(models.Model):
+    """
+    Per-wallet totals for one day or month and transaction type, kept up to
+    date by core.services.ledger_service as transactions are recorded.
+    """
+    PERIOD_CHOICES = [
+        ('DAY', 'Day'),
+        ('MONTH', 'Month'),
+    ]
+    wallet = models.ForeignKey(Wallet, related_name='rollups', on_delete=models.CASCADE)
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES)
+    period_start = models.DateField()
+    transaction_type = models.CharField(max_length=20, choices=Transaction.TRANSACTION_TYPES)
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('wallet', 'period', 'period_start', 'transaction_type')
+        ordering = ['-period_start', 'transaction_type']
+
+    def __str__(self):
+        return f"{self.wallet.user.username} {self.period} {self.period_start} {self.transaction_type}: {self.total}"
+
+# Archive tables, filled by `manage.py archive_rows`. Rows keep their
+# original ids; foreign keys become plain ids so nothing cascades into them.
+class ArchivedTrip(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    driver = models.IntegerField(db_index=True)  # User id
+    start_node = models.IntegerField()
+    end_node = models.IntegerField()
+    route = models.JSONField()
+    route_version = models.PositiveIntegerField(default=0)
+    current_node = models.IntegerField(null=True, blank=True)
+    passed_nodes = models.JSONField(default=list)
+    max_passengers = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=Trip.STATUS_CHOICES)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Archived trip {self.pk}"
+
+class ArchivedCarpoolRequest(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    passenger = models.IntegerField(db_index=True)  # User id
+    pickup_node = models.IntegerField()
+    dropoff_node = models.IntegerField()
+    status = models.CharField(max_length=20, choices=CarpoolRequest.STATUS_CHOICES)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Archived request {self.pk}"
+
+class ArchivedOffer(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    trip = models.BigIntegerField(db_index=True)  # Trip id (hot or archived)
+    request = models.BigIntegerField(db_index=True)  # CarpoolRequest id (hot or archived)
+    driver = models.IntegerField(db_index=True)  # Denormalized so offers can be listed per user
+    passenger = models.IntegerField(db_index=True)
+    fare = models.DecimalField(max_digits=10, decimal_places=2)
+    detour = models.IntegerField()
+    status = models.CharField(max_length=20, choices=Offer.STATUS_CHOICES)
+    route = models.JSONField(null=True, blank=True)
+    route_version = models.PositiveIntegerField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Archived offer {self.pk}"
+
+class Job(models.Model):
+    """A unit of background work run by ``manage.py run_workers``."""
+    STATUS_CHOICES = [
+        ('QUEUED', 'Queued'),
+        ('RUNNING', 'Running'),
+        ('SUCCEEDED', 'Succeeded'),
+        ('FAILED', 'Failed'),
+    ]
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    created_by = models.ForeignKey(User, related_name='jobs', null=True, blank=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='QUEUED')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'])]
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+class PrunedVersion(models.Model):
+    """Highest version pruned from a change channel's log; see core.services.version_channel."""
+    name = models.CharField(max_length=20, primary_key=True)
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} pruned to v{self.version}"
+
+class ChangeLog(models.Model):
+    """One change published on a channel, so other processes can replay it. Its id is its version."""
+    channel = models.CharField(max_length=20)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['channel', 'id']), models.Index(fields=['created_at'])]
+
+    @property
+    def version(self):
+        return self.id
+
+    def __str__(self):
+        return f"{self.channel} v{self.version}: {self.payload}"
+
+class RequestProfile(models.Model):
+    """A profiled request; the profile files live under settings.PROFILING_DIR."""
+    TRIGGER_CHOICES = [
+        ('HEADER', 'Admin header'),
+        ('SAMPLE', 'Sampled'),
+    ]
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    view_name = models.CharField(max_length=200, blank=True)
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
+    status_code = models.PositiveIntegerField()
+    duration_ms = models.FloatField()
+    query_count = models.PositiveIntegerField(default=0)
+    queries = models.JSONField(default=list)  # [{sql, duration_ms, origin}]
+    trigger = models.CharField(max_length=10, choices=TRIGGER_CHOICES)
+    profile_file = models.CharField(max_length=255)  # pstats dump
+    collapsed_file = models.CharField(max_length=255)  # Flamegraph collapsed stacks
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
+
 # Signals to create wallet
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
 
 @receiver(post_save, sender=User)
 def create_user_wallet(sender, instance, created, **kwargs):
     if created:
         Wallet.objects.create(user=instance)
+
+# Transactions are append-only; each one is added to its wallet rollups
+# in the same database transaction that records it.
+@receiver(post_save, sender=Transaction)
+def transaction_recorded(sender, instance, created, **kwargs):
+    from core.services import ledger_service
+    if created:
+        ledger_service.add_to_rollups(instance)
+
+# Signals to keep TripMatch rows fresh. The refresh itself runs on the
+# match worker once the triggering transaction commits.
+@receiver(post_save, sender=Trip)
+def trip_saved(sender, instance, created, update_fields=None, **kwargs):
+    from core.services import match_service, version_channel
+    # Publishing takes the channel's single counter row, so only saves that
+    # change what trip caches hold do it
+    previous, state = getattr(instance, '_published_state', None), instance.published_state()
+    if update_fields is not None and not any(
+            field in update_fields or f'{field}_id' in update_fields for field in Trip.PUBLISHED_FIELDS):
+        changed = False
+    else:
+        changed = created or previous is None or state is None or state != previous
+    if changed:
+        version_channel.publish('trip', {'trips': [instance.pk]})
+        version_channel.poll_on_commit()
+    instance._published_state = state
+    transaction.on_commit(lambda: match_service.schedule_trip(instance.pk))
+
+@receiver(post_save, sender=CarpoolRequest)
+def carpool_request_saved(sender, instance, **kwargs):
+    from core.services import match_service
+    transaction.on_commit(lambda: match_service.schedule_request(instance.pk))
+
+@receiver(post_save, sender=Offer)
+def offer_saved(sender, instance, **kwargs):
+    from core.services import match_service
+    if instance.status == 'ACCEPTED':
+        # Occupancy on the trip changed, so every fare it quotes changes
+        transaction.on_commit(lambda: match_service.schedule_trip(instance.trip_id))
+
+# Node writes bump the graph version too, so clients caching the node
+# list by graph version see them. Deleting a node also deletes its edges,
+# and each of those publishes its own removal.
+@receiver(post_save, sender=Node)
+@receiver(post_delete, sender=Node)
+def node_changed(sender, instance, **kwargs):
+    from core.services import version_channel
+    version_channel.publish('graph', {'op': 'node', 'id': instance.pk})
+    version_channel.poll_on_commit()
+
+# Signals to keep every process's routing index in step with Edge writes.
+# Changes are published in the writing transaction, so a rolled-back edit
+# never reaches an index; this process applies them right after commit.
+@receiver(pre_save, sender=Edge)
+def remember_edge_endpoints(sender, instance, **kwargs):
+    if instance.pk:
+        instance._previous_endpoints = Edge.objects.filter(pk=instance.pk).values_list(
+            'from_node_id', 'to_node_id').first()
+
+@receiver(post_save, sender=Edge)
+def edge_saved(sender, instance, created, **kwargs):
+    from core.services import version_channel
+    previous = getattr(instance, '_previous_endpoints', None)
+    current = (instance.from_node_id, instance.to_node_id)
+    if previous and previous != current:
+        version_channel.publish('graph', {'op': 'remove', 'from': previous[0], 'to': previous[1]})
+    if created or previous != current:
+        version_channel.publish('graph', {'op': 'add', 'from': current[0], 'to': current[1]})
+    version_channel.poll_on_commit()
+
+@receiver(post_delete, sender=Edge)
+def edge_deleted(sender, instance, **kwargs):
+    from core.services import version_channel
+    version_channel.publish('graph', {'op': 'remove', 'from': instance.from_node_id, 'to': instance.to_node_id})
+    version_channel.poll_on_commit()
@@ -0,0 +1,135 @@
+"""
+Opt-in per-request profiling.
+
+A profiled request runs under cProfile while a sampler thread records the
+request thread's stack every PROFILING_SAMPLE_INTERVAL seconds, and every
+SQL statement is captured with the project frame that issued it. The
+pstats dump and a flamegraph-ready collapsed-stack file are written to
+PROFILING_DIR and indexed by a RequestProfile row for the admin.
+"""
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter as StackCounter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+SKIP_ORIGIN_PARTS = (os.sep + 'site-packages' + os.sep, os.sep + 'django' + os.sep,
+                     os.sep + 'rest_framework' + os.sep, 'core' + os.sep + 'profiling.py')
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    filename = os.path.relpath(code.co_filename, settings.BASE_DIR) \
+        if code.co_filename.startswith(str(settings.BASE_DIR)) else os.path.basename(code.co_filename)
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'.replace(';', ':')
+
+
+class StackSampler(threading.Thread):
+    """Samples one thread's stack into collapsed ``a;b;c`` form."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            if labels:
+                self.stacks[';'.join(reversed(labels))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class SQLRecorder:
+    """execute_wrapper that keeps each statement, its time and its origin."""
+
+    def __init__(self):
+        self.queries = []
+        self.base_dir = str(settings.BASE_DIR)
+
+    def _origin(self):
+        for frame in reversed(traceback.extract_stack()[:-3]):
+            if frame.filename.startswith(self.base_dir) and \
+                    not any(part in frame.filename for part in SKIP_ORIGIN_PARTS):
+                return f'{os.path.relpath(frame.filename, self.base_dir)}:{frame.lineno} in {frame.name}'
+        return ''
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'duration_ms': (time.perf_counter() - start) * 1000,
+                'origin': self._origin(),
+            })
+
+
+class ProfiledRun:
+    """Context manager that profiles the enclosed block."""
+
+    def __enter__(self):
+        self.sql = SQLRecorder()
+        self.stack = ExitStack()
+        for connection in connections.all():
+            self.stack.enter_context(connection.execute_wrapper(self.sql))
+        self.sampler = StackSampler(threading.get_ident(), settings.PROFILING_SAMPLE_INTERVAL)
+        self.profiler = cProfile.Profile()
+        self.sampler.start()
+        self.start = time.perf_counter()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+        self.duration_ms = (time.perf_counter() - self.start) * 1000
+        self.sampler.stop()
+        self.stack.close()
+
+    def save(self, request, response, trigger):
+        from core.models import RequestProfile
+
+        directory = settings.PROFILING_DIR
+        os.makedirs(directory, exist_ok=True)
+        stem = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        profile_file = f'{stem}.prof'
+        collapsed_file = f'{stem}.collapsed'
+
+        pstats.Stats(self.profiler).dump_stats(os.path.join(directory, profile_file))
+        with open(os.path.join(directory, collapsed_file), 'w') as fh:
+            for stack, count in self.sampler.stacks.most_common():
+                fh.write(f'{stack} {count}\n')
+
+        match = getattr(request, 'resolver_match', None)
+        user = getattr(request, 'user', None)
+        return RequestProfile.objects.create(
+            method=request.method,
+            path=request.get_full_path()[:500],
+            view_name=match.view_name if match else '',
+            user=user if user is not None and user.is_authenticated else None,
+            status_code=response.status_code,
+            duration_ms=self.duration_ms,
+            query_count=len(self.sql.queries),
+            queries=self.sql.queries,
+            trigger=trigger,
+            profile_file=profile_file,
+            collapsed_file=collapsed_file,
+        )
@@ -1,5 +1,7 @@
+from django.db.models import F
 from rest_framework import serializers
-from .models import Node, Edge, Trip, CarpoolRequest, Offer, Wallet, Transaction
+from .models import (Node, Edge, Trip, CarpoolRequest, Offer, Wallet, Transaction, Job, WalletRollup,
+                     ArchivedTrip, ArchivedCarpoolRequest, ArchivedOffer)
 from django.contrib.auth.models import User
 
 class UserSerializer(serializers.ModelSerializer):
@@ -21,8 +23,25 @@ class TripSerializer(serializers.ModelSerializer):
     driver = UserSerializer(read_only=True)
     class Meta:
         model = Trip
-        fields = '__all__'
-        read_only_fields = ['driver', 'passed_nodes', 'created_at']
+        # matches_refreshed_at is internal bookkeeping of the match worker
+        exclude = ['matches_refreshed_at']
+        read_only_fields = ['driver', 'passed_nodes', 'created_at', 'updated_at', 'route_version', 'seats_taken']
+
+    def update(self, instance, validated_data):
+        # Write only the submitted fields, so seats reserved and routes
+        # spliced since the trip was read are not overwritten
+        fields = [*validated_data, 'updated_at']
+        if 'route' in validated_data and validated_data['route'] != instance.route:
+            # Quotes, offers and splices built on the old route must notice
+            instance.route_version = F('route_version') + 1
+            fields.append('route_version')
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        if validated_data:
+            instance.save(update_fields=fields)
+        if 'route_version' in fields:
+            instance.refresh_from_db(fields=['route_version'])
+        return instance
 
 class CarpoolRequestSerializer(serializers.ModelSerializer):
     passenger = UserSerializer(read_only=True)
@@ -35,7 +54,7 @@ class OfferSerializer(serializers.ModelSerializer):
     class Meta:
         model = Offer
         fields = '__all__'
-        read_only_fields = ['status']
+        read_only_fields = ['status', 'route', 'route_version']
 
 class WalletSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
@@ -47,3 +66,51 @@ class TransactionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Transaction
         fields = '__all__'
+
+class WalletRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = WalletRollup
+        fields = ['period', 'period_start', 'transaction_type', 'total', 'count']
+
+class JobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = ['id', 'kind', 'status', 'attempts', 'max_attempts', 'result', 'error', 'created_at', 'updated_at']
+
+# Items posted to the /batch/ endpoints. Related rows are referenced by id
+# and looked up for the whole batch at once by the view.
+class CarpoolRequestBatchItemSerializer(serializers.Serializer):
+    pickup_node = serializers.IntegerField()
+    dropoff_node = serializers.IntegerField()
+
+class TripBatchItemSerializer(serializers.Serializer):
+    start_node = serializers.IntegerField()
+    end_node = serializers.IntegerField()
+    max_passengers = serializers.IntegerField(min_value=0)
+    status = serializers.ChoiceField(choices=Trip.STATUS_CHOICES, default='SCHEDULED')
+
+class PositionUpdateSerializer(serializers.Serializer):
+    trip = serializers.IntegerField()
+    node_id = serializers.IntegerField()
+    passed_nodes = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+
+class OfferBatchItemSerializer(serializers.Serializer):
+    trip = serializers.IntegerField()
+    request = serializers.IntegerField()
+    quote = serializers.CharField(required=False, allow_blank=True)
+
+# Archived rows are read-only; ``archived_at`` tells them apart from live ones
+class ArchivedTripSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ArchivedTrip
+        fields = '__all__'
+
+class ArchivedCarpoolRequestSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ArchivedCarpoolRequest
+        fields = '__all__'
+
+class ArchivedOfferSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ArchivedOffer
+        fields = '__all__'
@@ -0,0 +1,104 @@
+"""
+Keeping the hot tables small: request expiry and archival.
+
+``expire_requests`` marks pending requests older than CARPOOL_REQUEST_TTL
+as EXPIRED and drops their matches. ``archive`` moves finished trips (with
+their offers) and finished requests older than a cutoff into the Archived*
+tables. Both work in batches, each in its own transaction, so they can be
+interrupted at any point and simply run again.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import (Trip, CarpoolRequest, Offer, TripMatch, ArchivedTrip, ArchivedCarpoolRequest,
+                         ArchivedOffer, request_expiry_cutoff)
+
+FINISHED_TRIP_STATUSES = ('COMPLETED', 'CANCELLED')
+FINISHED_REQUEST_STATUSES = ('COMPLETED', 'CANCELLED', 'EXPIRED')
+
+
+def expire_requests(batch_size=1000):
+    """Mark pending requests past their TTL as EXPIRED. Returns how many expired."""
+    cutoff = request_expiry_cutoff()
+    if cutoff is None:
+        return 0
+    expired = 0
+    while True:
+        ids = list(CarpoolRequest.objects.filter(status='PENDING', created_at__lt=cutoff)
+                   .order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return expired
+        with transaction.atomic():
+            expired += CarpoolRequest.objects.filter(id__in=ids, status='PENDING').update(status='EXPIRED')
+            TripMatch.objects.filter(request_id__in=ids).delete()
+
+
+def _archive_trips(ids):
+    trips = list(Trip.objects.filter(id__in=ids))
+    offers = list(Offer.objects.filter(trip_id__in=ids).select_related('request'))
+    ArchivedTrip.objects.bulk_create([
+        ArchivedTrip(id=t.id, driver=t.driver_id, start_node=t.start_node_id, end_node=t.end_node_id,
+                     route=t.route, route_version=t.route_version, current_node=t.current_node_id,
+                     passed_nodes=t.passed_nodes, max_passengers=t.max_passengers, status=t.status,
+                     created_at=t.created_at)
+        for t in trips
+    ], ignore_conflicts=True)
+    driver_ids = {t.id: t.driver_id for t in trips}
+    ArchivedOffer.objects.bulk_create([
+        ArchivedOffer(id=o.id, trip=o.trip_id, request=o.request_id, driver=driver_ids[o.trip_id],
+                      passenger=o.request.passenger_id, fare=o.fare, detour=o.detour, status=o.status,
+                      route=o.route, route_version=o.route_version)
+        for o in offers
+    ], ignore_conflicts=True)
+    Offer.objects.filter(trip_id__in=ids).delete()
+    Trip.objects.filter(id__in=ids).delete()
+    return len(trips), len(offers)
+
+
+def _archive_requests(ids):
+    requests = list(CarpoolRequest.objects.filter(id__in=ids))
+    ArchivedCarpoolRequest.objects.bulk_create([
+        ArchivedCarpoolRequest(id=r.id, passenger=r.passenger_id, pickup_node=r.pickup_node_id,
+                               dropoff_node=r.dropoff_node_id, status=r.status, created_at=r.created_at)
+        for r in requests
+    ], ignore_conflicts=True)
+    CarpoolRequest.objects.filter(id__in=ids).delete()
+    return len(requests)
+
+
+def archive(days, batch_size=500, progress=None):
+    """
+    Archive finished trips and requests created more than ``days`` ago.
+    Returns ``{'trips': n, 'offers': n, 'requests': n}``. ``progress`` is
+    called with the running totals after every batch.
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    totals = {'trips': 0, 'offers': 0, 'requests': 0}
+
+    trips = Trip.objects.filter(status__in=FINISHED_TRIP_STATUSES, created_at__lt=cutoff).order_by('id')
+    while True:
+        ids = list(trips.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        with transaction.atomic():
+            archived_trips, archived_offers = _archive_trips(ids)
+        totals['trips'] += archived_trips
+        totals['offers'] += archived_offers
+        if progress:
+            progress(totals)
+
+    # A request still referenced by an offer on a live trip stays until
+    # that trip is archived too.
+    requests = CarpoolRequest.objects.filter(
+        status__in=FINISHED_REQUEST_STATUSES, created_at__lt=cutoff, offers__isnull=True).order_by('id')
+    while True:
+        ids = list(requests.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        with transaction.atomic():
+            totals['requests'] += _archive_requests(ids)
+        if progress:
+            progress(totals)
+    return totals
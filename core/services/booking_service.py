@@ -0,0 +1,64 @@
+"""
+Seat reservation without row locks held across application code.
+
+Accepting an offer is three conditional UPDATEs in one short transaction:
+
+* the offer moves PENDING -> ACCEPTED only if it is still pending,
+* its request moves PENDING -> ACCEPTED only if no other offer took it
+  and it has not outlived CARPOOL_REQUEST_TTL,
+* the trip's ``seats_taken`` goes up only while it is below ``max_passengers``.
+
+Each statement checks and writes in the database, so two concurrent
+accepts can never both see a free seat. The trip row is touched last, so
+its row lock is held only for the commit, and bookings on a popular trip
+queue on that single UPDATE instead of on a SELECT ... FOR UPDATE held
+while Python runs. Any failed condition rolls the whole transaction back.
+
+``Trip.seats_taken`` counts accepted offers; it is only ever changed here,
+together with the offer status, so the two cannot drift apart.
+"""
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core import metrics
+from core.models import Trip, CarpoolRequest, Offer
+from core.services import match_service
+
+ERRORS = {
+    'not_pending': 'Offer is no longer pending',
+    'request_taken': 'Request was already accepted',
+    'expired': 'Request has expired',
+    'full': 'Trip is full',
+}
+
+
+def accept(offer):
+    """
+    Accept ``offer`` and reserve its seat. Returns None on success, or one of
+    the ``ERRORS`` keys. ``offer`` and its request are updated in place.
+    """
+    outcome = _accept(offer)
+    metrics.OFFER_ACCEPTS.inc(outcome=outcome or 'accepted')
+    if outcome is None:
+        offer.status = offer.request.status = 'ACCEPTED'
+        # update() sends no post_save signals; the seat count changes every fare
+        transaction.on_commit(lambda: match_service.schedule_trip(offer.trip_id))
+        transaction.on_commit(lambda: match_service.schedule_request(offer.request_id))
+    return outcome
+
+
+def _accept(offer):
+    with transaction.atomic():
+        if not Offer.objects.filter(pk=offer.pk, status='PENDING').update(status='ACCEPTED'):
+            return 'not_pending'
+        if not CarpoolRequest.objects.pending().filter(pk=offer.request_id).update(status='ACCEPTED'):
+            # Still pending (past its TTL) or already marked by expire_requests
+            expired = CarpoolRequest.objects.filter(pk=offer.request_id, status__in=('PENDING', 'EXPIRED')).exists()
+            transaction.set_rollback(True)
+            return 'expired' if expired else 'request_taken'
+        if not Trip.objects.filter(pk=offer.trip_id, seats_taken__lt=F('max_passengers')).update(
+                seats_taken=F('seats_taken') + 1, updated_at=timezone.now()):
+            transaction.set_rollback(True)
+            return 'full'
+    return None
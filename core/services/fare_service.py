@@ -1,10 +1,13 @@
 from decimal import Decimal
+from core import metrics
 
 def calculate_passenger_fare(hops_occupancy, unit_price=10.0, base_fee=5.0):
     """
     Calculate fare for a passenger based on occupancy of hops they are in.
     hops_occupancy: List of integers representing number of passengers in each hop.
     """
+    metrics.FARE_CALCULATIONS.inc(function='calculate_passenger_fare')
+    metrics.FARE_HOPS.observe(len(hops_occupancy))
     total_sum = sum(1.0 / n if n > 0 else 1.0 for n in hops_occupancy)
     fare = (Decimal(str(unit_price)) * Decimal(str(total_sum))) + Decimal(str(base_fee))
     return fare.quantize(Decimal('0.01'))
@@ -15,6 +18,7 @@ def calculate_trip_fare(current_occupancy_per_hop, route_nodes, pickup_node, dro
     This requires knowing which hops in the route the passenger will be in.
     For Phase 1, we can simplify or use the specific formula.
     """
+    metrics.FARE_CALCULATIONS.inc(function='calculate_trip_fare')
     # Find the range of indices in the route for the passenger
     try:
         start_idx = route_nodes.index(pickup_node)
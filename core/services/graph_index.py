@@ -0,0 +1,482 @@
+"""
+In-memory routing index over Node/Edge with incremental repair.
+
+The index holds an adjacency snapshot plus caches derived from it:
+
+* distance rows: BFS distances from a source node to every reachable node,
+  used to rebuild shortest paths without touching the database;
+* radius neighbourhoods: for a target node, every node that can reach it
+  within ``radius`` hops, used by ``is_within_radius``.
+
+Snapshots are immutable once published. An edge insert or delete builds a
+new snapshot that shares every unaffected row and neighbourhood with the
+old one and repairs only the affected ones (dynamic BFS repair), then
+swaps it in with a single assignment. A query that grabbed the old
+snapshot keeps reading a consistent graph until it is done.
+
+Snapshot versions are the global 'graph' version from version_channel.
+Edge writes in any process publish a change there, and every process
+applies it through the same repair when its listener picks it up.
+
+When a prebuilt CSR file (see graph_snapshot and ``manage.py
+build_graph_snapshot``) is available, it is memory-mapped as the base
+adjacency and changes logged since it was written are replayed into small
+overlay dicts. Otherwise the adjacency is loaded from the database into
+plain dicts that serve as the base in the same way. Either way an edit
+copies only the overlay, never the whole graph.
+"""
+import heapq
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.utils import timezone
+
+from core import metrics
+from core.services import graph_snapshot, version_channel
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()  # Serializes writers only; readers never lock
+_current = None
+_load_stats = None  # How the current index was loaded, for /ready
+
+
+def _max_rows():
+    return getattr(settings, 'GRAPH_INDEX_MAX_ROWS', 1024)
+
+
+def _max_neighbourhoods():
+    return getattr(settings, 'GRAPH_INDEX_MAX_NEIGHBOURHOODS', 4096)
+
+
+def _max_overlay():
+    return getattr(settings, 'GRAPH_INDEX_MAX_OVERLAY', 4096)
+
+
+def _bounded_put(cache, key, value, limit):
+    """Insert into a FIFO-bounded dict; racing evictions are harmless."""
+    while len(cache) >= limit:
+        try:
+            cache.pop(next(iter(cache)))
+        except (StopIteration, KeyError, RuntimeError):
+            break
+    cache[key] = value
+
+
+class DictAdjacency:
+    """Adjacency loaded from the database; a snapshot base like CSRGraph."""
+
+    def __init__(self, successors, predecessors):
+        self._successors = successors
+        self._predecessors = predecessors
+
+    def successors(self, node_id):
+        return self._successors.get(node_id, ())
+
+    def predecessors(self, node_id):
+        return self._predecessors.get(node_id, ())
+
+    def merged(self, successors, predecessors):
+        """A new base with overlay entries folded in."""
+        return DictAdjacency({**self._successors, **successors}, {**self._predecessors, **predecessors})
+
+
+class GraphSnapshot:
+    """One immutable version of the graph and its derived caches."""
+
+    def __init__(self, version, successors, predecessors, rows=None, neighbourhoods=None, base=None):
+        self.version = version
+        self._base = base  # CSRGraph or DictAdjacency; the dicts below override it per node
+        self._successors = successors  # node -> tuple of successor ids
+        self._predecessors = predecessors  # node -> tuple of predecessor ids
+        self._rows = rows if rows is not None else {}  # source -> {node: dist}
+        self._neighbourhoods = neighbourhoods if neighbourhoods is not None else {}  # (target, radius) -> {node: dist}
+
+    def successors(self, node_id):
+        found = self._successors.get(node_id)
+        if found is None:
+            return self._base.successors(node_id) if self._base is not None else ()
+        return found
+
+    def predecessors(self, node_id):
+        found = self._predecessors.get(node_id)
+        if found is None:
+            return self._base.predecessors(node_id) if self._base is not None else ()
+        return found
+
+    def has_edge(self, from_id, to_id):
+        return to_id in self.successors(from_id)
+
+    def distances_from(self, source):
+        """Hop distance from ``source`` to every node reachable from it."""
+        row = self._rows.get(source)
+        if row is None:
+            row = self._bfs(source, self.successors, 'distance_row')
+            _bounded_put(self._rows, source, row, _max_rows())
+        return row
+
+    def nodes_reaching(self, target, radius):
+        """Every node that can reach ``target`` within ``radius`` hops, with its distance."""
+        key = (target, radius)
+        ball = self._neighbourhoods.get(key)
+        if ball is None:
+            ball = self._bfs(target, self.predecessors, 'neighbourhood', radius)
+            _bounded_put(self._neighbourhoods, key, ball, _max_neighbourhoods())
+        return ball
+
+    def nodes_reachable(self, source, radius):
+        """Every node ``source`` reaches within ``radius`` hops, with its distance. Not cached."""
+        return self._bfs(source, self.successors, 'reachable', radius)
+
+    def distance(self, start_id, end_id):
+        return self.distances_from(start_id).get(end_id, float('inf'))
+
+    def shortest_path(self, start_id, end_id):
+        """A shortest path as a list of node ids, or None if unreachable."""
+        if start_id == end_id:
+            return [start_id]
+        row = self.distances_from(start_id)
+        if end_id not in row:
+            return None
+        path = [end_id]
+        current = end_id
+        while current != start_id:
+            dist = row[current]
+            for prev in self.predecessors(current):
+                if row.get(prev) == dist - 1:
+                    current = prev
+                    break
+            path.append(current)
+        path.reverse()
+        return path
+
+    @staticmethod
+    def _bfs(source, neighbours, function, limit=None):
+        row = {source: 0}
+        queue = deque([source])
+        while queue:
+            current = queue.popleft()
+            dist = row[current]
+            if limit is not None and dist >= limit:
+                continue
+            for nxt in neighbours(current):
+                if nxt not in row:
+                    row[nxt] = dist + 1
+                    queue.append(nxt)
+        metrics.GRAPH_EXPANSIONS.inc(len(row), function=function)
+        return row
+
+
+def _load(alias):
+    from core.models import Edge
+
+    successors = {}
+    predecessors = {}
+    edges = Edge.objects.using(alias).values_list('from_node_id', 'to_node_id').order_by('id')
+    for from_id, to_id in edges:
+        successors.setdefault(from_id, []).append(to_id)
+        predecessors.setdefault(to_id, []).append(from_id)
+    return (
+        {k: tuple(v) for k, v in successors.items()},
+        {k: tuple(v) for k, v in predecessors.items()},
+    )
+
+
+_export = None  # (version, bytes) from the last export()
+
+
+def export(using='default'):
+    """
+    ``(version, data)``: the Edge table in the graph_snapshot format, for
+    clients that route locally. Built once per graph version per process.
+    The settled version is read before the edges, so the data may already
+    include a few later changes; replaying those from the ChangeLog is a no-op.
+    """
+    global _export
+    from core.models import Edge
+
+    version = version_channel.settled_version('graph', using=using)
+    exported = _export
+    if exported is None or exported[0] != version:
+        edges = Edge.objects.using(using).order_by('id')
+        max_edge_id = edges.reverse().values_list('id', flat=True).first() or 0
+        data = graph_snapshot.dumps(edges.values_list('from_node_id', 'to_node_id'), max_edge_id, version)
+        exported = _export = (version, data)
+    return exported
+
+
+def _load_base():
+    """The CSR file at GRAPH_SNAPSHOT_PATH, or None if there is no usable one."""
+    path = getattr(settings, 'GRAPH_SNAPSHOT_PATH', None)
+    if not path:
+        return None
+    try:
+        return graph_snapshot.load(path)
+    except graph_snapshot.InvalidSnapshot as exc:
+        logger.info('Not using graph snapshot %s: %s', path, exc)
+        return None
+
+
+def _replay(snapshot):
+    """``snapshot`` with every logged change after its version applied, or None if some were pruned."""
+    entries, complete = version_channel.changes('graph', snapshot.version)
+    if not complete:
+        return None
+    for entry in entries:
+        snapshot = _derive(snapshot, entry.version, entry.payload)
+        if snapshot is None:
+            return None
+    return snapshot
+
+
+def _initial_snapshot():
+    global _load_stats
+    from core.db_router import replica_alias
+
+    started = time.perf_counter()
+    snapshot = None
+    base = _load_base()
+    if base is not None:
+        # The file was written at a known graph version; it is usable as
+        # long as every change since then is still in the ChangeLog
+        snapshot = _replay(GraphSnapshot(base.graph_version, {}, {}, base=base))
+        if snapshot is None:
+            logger.warning('Graph snapshot %s is too old to catch up; loading edges from the database',
+                           settings.GRAPH_SNAPSHOT_PATH)
+        source, edges = 'snapshot', base.edge_count
+    if snapshot is None:
+        # Read the version before the edges: changes committed in between
+        # are replayed, and replaying one that is already loaded is a no-op
+        alias = replica_alias()
+        version = version_channel.current_version('graph', using=alias)
+        successors, predecessors = _load(alias)
+        loaded = GraphSnapshot(version, {}, {}, base=DictAdjacency(successors, predecessors))
+        snapshot = _replay(loaded) or loaded
+        source, edges = 'database', sum(len(targets) for targets in successors.values())
+    seconds = time.perf_counter() - started
+    metrics.GRAPH_INDEX_LOAD.observe(seconds, source=source)
+    _load_stats = {'source': source, 'edges': edges, 'load_seconds': seconds, 'loaded_at': timezone.now()}
+    return snapshot
+
+
+_subscribed = False
+
+
+def _subscribe():
+    # Outside _lock: the channel calls back into this module under its own lock
+    global _subscribed
+    if not _subscribed:
+        _subscribed = True
+        version_channel.subscribe('graph', _on_changes, invalidate)
+
+
+def current():
+    """The latest published snapshot, loading it on first use."""
+    version_channel.start()  # Restarts the listener in a forked worker
+    snapshot = _current
+    if snapshot is None:
+        _subscribe()
+        with _lock:
+            snapshot = _current
+            if snapshot is None:
+                snapshot = _publish(_initial_snapshot())
+    return snapshot
+
+
+def status():
+    """None until the index is loaded, then how and when it was loaded."""
+    snapshot = _current
+    if snapshot is None or _load_stats is None:
+        return None
+    return dict(_load_stats, version=snapshot.version)
+
+
+def preload():
+    """
+    Load the index now. Called from wsgi.py/asgi.py so that with gunicorn
+    ``--preload`` the master loads it once before forking workers. Database
+    connections are closed afterwards so workers do not inherit them, and
+    the master's metrics are written out since workers start without them.
+    """
+    from django.db import connections
+
+    try:
+        current()
+    except Exception:
+        logger.exception('Could not preload the routing index; it will load on first use')
+    finally:
+        connections.close_all()
+        metrics.flush(force=True)
+
+
+def warm_async():
+    """Start loading the index in the background if it is not loaded."""
+    from django.db import close_old_connections
+
+    def warm():
+        try:
+            current()
+        except Exception:
+            logger.exception('Could not load the routing index')
+        finally:
+            close_old_connections()
+
+    if _current is None:
+        threading.Thread(target=warm, name='graph-index-warm', daemon=True).start()
+
+
+def _publish(snapshot):
+    global _current
+    _current = snapshot
+    return snapshot
+
+
+def invalidate():
+    """Drop the index in this process; the next query reloads it."""
+    global _current
+    with _lock:
+        _current = None
+
+
+def _after_fork():
+    global _lock
+    _lock = threading.Lock()  # Could have been held by a thread that did not survive the fork
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+# Incremental repair
+
+def _repair_row_after_insert(row, snapshot, from_id, to_id):
+    base = row.get(from_id)
+    if base is None or row.get(to_id, float('inf')) <= base + 1:
+        return row
+    row = dict(row)
+    row[to_id] = base + 1
+    queue = deque([to_id])
+    while queue:
+        current = queue.popleft()
+        dist = row[current] + 1
+        for nxt in snapshot.successors(current):
+            if row.get(nxt, float('inf')) > dist:
+                row[nxt] = dist
+                queue.append(nxt)
+    return row
+
+
+def _repair_row_after_delete(row, snapshot, from_id, to_id):
+    if from_id not in row or row.get(to_id) != row[from_id] + 1:
+        return row  # The edge was not on any shortest path from this source
+
+    # Find nodes that lost every shortest-path parent. FIFO order visits
+    # them level by level, so parents are decided before their children.
+    affected = set()
+    decided = set()
+    queue = deque([to_id])
+    while queue:
+        node = queue.popleft()
+        if node in decided:
+            continue
+        decided.add(node)
+        dist = row[node]
+        if any(p not in affected and row.get(p) == dist - 1 for p in snapshot.predecessors(node)):
+            continue
+        affected.add(node)
+        for nxt in snapshot.successors(node):
+            if row.get(nxt) == dist + 1:
+                queue.append(nxt)
+    if not affected:
+        return row
+
+    row = {node: dist for node, dist in row.items() if node not in affected}
+    heap = []
+    for node in affected:
+        best = min((row[p] + 1 for p in snapshot.predecessors(node) if p in row), default=None)
+        if best is not None:
+            heap.append((best, node))
+    heapq.heapify(heap)
+    while heap:
+        dist, node = heapq.heappop(heap)
+        if node in row:
+            continue
+        row[node] = dist
+        for nxt in snapshot.successors(node):
+            if nxt in affected and nxt not in row:
+                heapq.heappush(heap, (dist + 1, nxt))
+    return row
+
+
+def _bump(old, version):
+    """``old`` relabelled as ``version``, sharing everything."""
+    return GraphSnapshot(version, old._successors, old._predecessors, old._rows, old._neighbourhoods,
+                         base=old._base)
+
+
+def _edit(old, version, from_id, to_id, added):
+    """A snapshot at ``version`` with one edge added or removed, caches repaired."""
+    if old.has_edge(from_id, to_id) == added:
+        # Already reflected (e.g. loaded after the change committed)
+        return _bump(old, version)
+
+    # Only the overlay is copied; it holds the nodes touched since load
+    successors = dict(old._successors)
+    predecessors = dict(old._predecessors)
+    if added:
+        successors[from_id] = tuple(old.successors(from_id)) + (to_id,)
+        predecessors[to_id] = tuple(old.predecessors(to_id)) + (from_id,)
+    else:
+        successors[from_id] = tuple(n for n in old.successors(from_id) if n != to_id)
+        predecessors[to_id] = tuple(n for n in old.predecessors(to_id) if n != from_id)
+    base = old._base
+    if isinstance(base, DictAdjacency) and len(successors) + len(predecessors) > _max_overlay():
+        # Fold a grown overlay into the base once rather than copy it on
+        # every edit. A CSR base is mmapped and shared, so it keeps its
+        # overlay until the snapshot file is rebuilt and reloaded.
+        base = base.merged(successors, predecessors)
+        successors, predecessors = {}, {}
+    new = GraphSnapshot(version, successors, predecessors, base=base)
+
+    repair = _repair_row_after_insert if added else _repair_row_after_delete
+    for source, row in list(old._rows.items()):
+        new._rows[source] = repair(row, new, from_id, to_id)
+
+    # A neighbourhood around t can only change if the edge's head can
+    # already reach t with a hop to spare.
+    for (target, radius), ball in list(old._neighbourhoods.items()):
+        if ball.get(to_id, radius) < radius:
+            ball = GraphSnapshot._bfs(target, new.predecessors, 'neighbourhood', radius)
+        new._neighbourhoods[(target, radius)] = ball
+    return new
+
+
+def _derive(old, version, payload):
+    """Apply one ChangeLog payload; None means the caller must reload."""
+    # A late commit can arrive below the snapshot's version. Edits are
+    # idempotent, so it is applied anyway, and the version never goes back.
+    version = max(version, old.version)
+    op = payload.get('op')
+    if op in ('add', 'remove'):
+        return _edit(old, version, payload['from'], payload['to'], added=op == 'add')
+    if op == 'node':
+        return _bump(old, version)  # Adjacency lives in edges only
+    return None  # 'reload', or something this code does not know
+
+
+def _on_changes(entries):
+    """Version channel subscriber: apply graph changes committed by any process."""
+    global _current
+    with _lock:
+        snapshot = _current
+        if snapshot is None:
+            return  # Nothing loaded yet; the next query loads fresh data
+        for entry in entries:
+            snapshot = _derive(snapshot, entry.version, entry.payload)
+            if snapshot is None:
+                _current = None
+                return
+        _publish(snapshot)
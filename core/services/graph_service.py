@@ -1,68 +1,62 @@
-from core.models import Node, Edge
-from collections import deque
+import time
+from core import metrics
+from core.services import graph_index
 
-def get_shortest_path(start_node_id, end_node_id):
+# All searches run on an in-memory snapshot of the graph (see graph_index),
+# so a call never issues SQL once the index is warm. Pass ``snapshot`` to
+# run several calls against the same graph version.
+
+MATCH_RADIUS = 2  # Hops a pickup or dropoff may be from a trip's remaining route
+
+def get_shortest_path(start_node_id, end_node_id, snapshot=None):
     """BFS to find the shortest path in the directed graph."""
     if start_node_id == end_node_id:
         return [start_node_id]
     
-    queue = deque([[start_node_id]])
-    visited = {start_node_id}
-    
-    while queue:
-        path = queue.popleft()
-        current_node_id = path[-1]
-        
-        edges = Edge.objects.filter(from_node_id=current_node_id)
-        for edge in edges:
-            if edge.to_node_id == end_node_id:
-                return path + [edge.to_node_id]
-            if edge.to_node_id not in visited:
-                visited.add(edge.to_node_id)
-                queue.append(path + [edge.to_node_id])
-    return None
+    metrics.GRAPH_SEARCHES.inc(function='get_shortest_path')
+    snapshot = snapshot or graph_index.current()
+    return snapshot.shortest_path(start_node_id, end_node_id)
+
+def get_shortest_paths(pairs, snapshot=None):
+    """
+    Shortest paths for many (start, end) pairs in one pass. Pairs are grouped
+    by start node so each start's BFS row is computed once and shared by
+    every end. Returns {(start, end): path or None}.
+    """
+    snapshot = snapshot or graph_index.current()
+    ends_by_start = {}
+    for start, end in pairs:
+        ends_by_start.setdefault(start, set()).add(end)
+
+    paths = {}
+    for start, ends in ends_by_start.items():
+        metrics.GRAPH_SEARCHES.inc(function='get_shortest_paths')
+        snapshot.distances_from(start)
+        for end in ends:
+            paths[(start, end)] = snapshot.shortest_path(start, end)
+    return paths
 
-def get_distance(start_node_id, end_node_id, max_dist=None):
+def get_distance(start_node_id, end_node_id, max_dist=None, snapshot=None):
     """Get the shortest distance between two nodes."""
     if start_node_id == end_node_id:
         return 0
     
-    queue = deque([(start_node_id, 0)])
-    visited = {start_node_id}
-    
-    while queue:
-        current_id, dist = queue.popleft()
-        if max_dist is not None and dist >= max_dist:
-            continue
-            
-        edges = Edge.objects.filter(from_node_id=current_id)
-        for edge in edges:
-            if edge.to_node_id == end_node_id:
-                return dist + 1
-            if edge.to_node_id not in visited:
-                visited.add(edge.to_node_id)
-                queue.append((edge.to_node_id, dist + 1))
-    return float('inf')
+    metrics.GRAPH_SEARCHES.inc(function='get_distance')
+    snapshot = snapshot or graph_index.current()
+    dist = snapshot.distance(start_node_id, end_node_id)
+    if max_dist is not None and dist > max_dist:
+        return float('inf')
+    return dist
 
-def is_within_radius(route_node_ids, target_node_id, radius=2):
+def is_within_radius(route_node_ids, target_node_id, radius=MATCH_RADIUS, snapshot=None):
     """Check if target_node is within radius of any node in the route."""
-    # This can be optimized by doing a multi-source BFS from all route nodes
-    queue = deque([(node_id, 0) for node_id in route_node_ids])
-    visited = set(route_node_ids)
-    
-    while queue:
-        current_id, dist = queue.popleft()
-        if current_id == target_node_id:
-            return True
-        if dist < radius:
-            edges = Edge.objects.filter(from_node_id=current_id)
-            for edge in edges:
-                if edge.to_node_id not in visited:
-                    visited.add(edge.to_node_id)
-                    queue.append((edge.to_node_id, dist + 1))
-    return False
+    # Search backwards from the target once instead of forwards from every route node
+    metrics.GRAPH_SEARCHES.inc(function='is_within_radius')
+    snapshot = snapshot or graph_index.current()
+    nearby = snapshot.nodes_reaching(target_node_id, radius)
+    return any(node_id in nearby for node_id in route_node_ids)
 
-def calculate_best_detour(remaining_route, pickup_id, dropoff_id):
+def calculate_best_detour(remaining_route, pickup_id, dropoff_id, snapshot=None):
     """
     Find the best way to insert pickup and dropoff into the remaining route.
     Returns (new_route, detour_length).
@@ -79,21 +73,27 @@ def calculate_best_detour(remaining_route, pickup_id, dropoff_id):
     # i can be from 0 to len(remaining_route)-1.
     # j can be from i to len(remaining_route)-1.
     
-    # Precompute paths for efficiency if needed, but for now we search.
+    # Paths come from distance rows cached in the graph index, so the rows
+    # from each route node are shared by every request matched against it.
     
     n = len(remaining_route)
     original_length = n - 1
+    started = time.perf_counter()
+    candidates = 0
+    snapshot = snapshot or graph_index.current()
+    
+    path_p_to_d = get_shortest_path(pickup_id, dropoff_id, snapshot)
     
     for i in range(n):
-        path_to_p = get_shortest_path(remaining_route[i], pickup_id)
-        if path_to_p is None: continue
+        if path_p_to_d is None: break
         
-        path_p_to_d = get_shortest_path(pickup_id, dropoff_id)
-        if path_p_to_d is None: continue
+        path_to_p = get_shortest_path(remaining_route[i], pickup_id, snapshot)
+        if path_to_p is None: continue
         
         for j in range(i, n):
-            path_d_to_r_j = get_shortest_path(dropoff_id, remaining_route[j])
+            path_d_to_r_j = get_shortest_path(dropoff_id, remaining_route[j], snapshot)
             if path_d_to_r_j is None: continue
+            candidates += 1
             
             # Construct new route:
             # part1: remaining_route[0:i+1]
@@ -120,6 +120,9 @@ def calculate_best_detour(remaining_route, pickup_id, dropoff_id):
                     best_total_length = total_length
                     best_route = deduplicated_route
                     
+    metrics.DETOUR_CANDIDATES.inc(candidates)
+    metrics.DETOUR_LATENCY.observe(time.perf_counter() - started)
+
     if best_route is None:
         return None, None
         
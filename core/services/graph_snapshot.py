@@ -0,0 +1,117 @@
+"""
+Binary CSR (compressed sparse row) snapshot of the Edge table.
+
+Layout, all integers in native byte order:
+
+    header   magic, format, byte order, node slots, edge count,
+             max edge id, graph version (see HEADER)
+    uint32   forward offsets   [node slots + 1]
+    uint32   forward targets   [edge count]
+    uint32   reverse offsets   [node slots + 1]
+    uint32   reverse sources   [edge count]
+
+Node ids index the offset arrays directly, and edges keep Edge.id order
+within each node as the database load does. ``load`` memory-maps the file
+read-only. The arrays are then read through memoryviews, so every process
+that maps the file shares the same physical pages. That is the whole point
+of building it ahead of time: gunicorn workers forked after a ``--preload``,
+or started separately, do not each hold a private copy of the graph.
+
+The same bytes (``dumps``) are served to clients that route locally; the
+header's byte order field tells them how to read the arrays.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b'CPGRAPH\x00'
+FORMAT = 1
+HEADER = struct.Struct('=8sIIQQQQ')
+_BYTE_ORDER = {'little': 1, 'big': 2}[sys.byteorder]
+
+
+class InvalidSnapshot(Exception):
+    """The file is missing, truncated or was written by another format or platform."""
+
+
+def _csr(node_slots, pairs):
+    offsets = array('I', bytes(4 * (node_slots + 1)))
+    for head, _ in pairs:
+        offsets[head + 1] += 1
+    for i in range(node_slots):
+        offsets[i + 1] += offsets[i]
+    values = array('I', bytes(4 * len(pairs)))
+    cursor = array('I', offsets)
+    for head, tail in pairs:
+        values[cursor[head]] = tail
+        cursor[head] += 1
+    return offsets, values
+
+
+def dumps(edges, max_edge_id=0, graph_version=0):
+    """The snapshot of ``edges`` (``(from_id, to_id)`` pairs in Edge.id order) as bytes."""
+    edges = list(edges)
+    node_slots = max((max(u, v) for u, v in edges), default=-1) + 1
+    forward = _csr(node_slots, edges)
+    reverse = _csr(node_slots, [(v, u) for u, v in edges])
+    header = HEADER.pack(MAGIC, FORMAT, _BYTE_ORDER, node_slots, len(edges), max_edge_id, graph_version)
+    return header + b''.join(part.tobytes() for part in forward + reverse)
+
+
+def write(path, edges, max_edge_id=0, graph_version=0):
+    """Write the snapshot of ``edges`` to ``path`` atomically."""
+    data = dumps(edges, max_edge_id, graph_version)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(data)
+    os.replace(tmp_path, path)
+
+
+class CSRGraph:
+    """Read-only adjacency over a snapshot buffer (usually an mmap)."""
+
+    def __init__(self, buffer):
+        if len(buffer) < HEADER.size:
+            raise InvalidSnapshot('File is shorter than the header')
+        magic, fmt, byte_order, node_slots, edge_count, max_edge_id, graph_version = HEADER.unpack_from(buffer)
+        if magic != MAGIC or fmt != FORMAT or byte_order != _BYTE_ORDER:
+            raise InvalidSnapshot('Unknown snapshot format')
+        if len(buffer) != HEADER.size + 4 * (2 * (node_slots + 1) + 2 * edge_count):
+            raise InvalidSnapshot('File size does not match the header')
+
+        self._buffer = buffer
+        self.node_slots = node_slots
+        self.edge_count = edge_count
+        self.max_edge_id = max_edge_id
+        self.graph_version = graph_version
+
+        view = memoryview(buffer)
+        position = HEADER.size
+        arrays = []
+        for count in (node_slots + 1, edge_count, node_slots + 1, edge_count):
+            arrays.append(view[position:position + 4 * count].cast('I'))
+            position += 4 * count
+        self._forward_offsets, self._forward, self._reverse_offsets, self._reverse = arrays
+
+    def successors(self, node_id):
+        if not 0 <= node_id < self.node_slots:
+            return ()
+        return self._forward[self._forward_offsets[node_id]:self._forward_offsets[node_id + 1]]
+
+    def predecessors(self, node_id):
+        if not 0 <= node_id < self.node_slots:
+            return ()
+        return self._reverse[self._reverse_offsets[node_id]:self._reverse_offsets[node_id + 1]]
+
+
+def load(path):
+    """Memory-map the snapshot at ``path``. Raises InvalidSnapshot if it cannot be used."""
+    try:
+        with open(path, 'rb') as fh:
+            buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as exc:  # Missing, unreadable or empty
+        raise InvalidSnapshot(str(exc)) from exc
+    return CSRGraph(buffer)
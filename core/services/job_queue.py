@@ -0,0 +1,174 @@
+"""
+A small job queue stored in the application database.
+
+Jobs are claimed with ``SELECT ... FOR UPDATE SKIP LOCKED`` where the
+backend supports it (PostgreSQL), so concurrent workers never block each
+other. On SQLite a job is claimed with a conditional UPDATE on its status
+instead, and a worker that loses the race simply tries the next job.
+
+Handlers are registered with ``@handler('kind')`` (see core/jobs.py). A
+handler that raises ``PermanentJobError`` fails the job immediately; any
+other exception is retried with exponential backoff until
+``max_attempts`` is reached. Enqueueing with an ``idempotency_key`` that
+already exists returns the existing job instead of creating another, and
+re-arms it if it had failed. The existing job must be for the same kind,
+payload and user; otherwise ``IdempotencyConflict`` is raised.
+"""
+import logging
+import os
+import socket
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError, close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from core.models import Job
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when retrying cannot help."""
+
+
+class IdempotencyConflict(Exception):
+    """The idempotency key already belongs to a different job."""
+
+
+def handler(kind):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind, payload, idempotency_key=None, user=None, max_attempts=None):
+    if kind not in HANDLERS:
+        raise ValueError(f'No job handler registered for {kind!r}')
+    fields = {
+        'kind': kind,
+        'payload': payload,
+        'created_by': user if user is not None and user.is_authenticated else None,
+        'max_attempts': max_attempts or getattr(settings, 'JOB_MAX_ATTEMPTS', 5),
+    }
+    if idempotency_key is None:
+        job = Job.objects.create(**fields)
+    else:
+        try:
+            with transaction.atomic():
+                job, created = Job.objects.get_or_create(idempotency_key=idempotency_key, defaults=fields)
+        except IntegrityError:
+            job, created = Job.objects.get(idempotency_key=idempotency_key), False
+        created_by = fields['created_by']
+        if not created and (job.kind != kind or job.payload != payload
+                            or job.created_by_id != (created_by.pk if created_by else None)):
+            raise IdempotencyConflict('The idempotency key was already used for a different request.')
+        if not created and job.status == 'FAILED':
+            Job.objects.filter(pk=job.pk, status='FAILED').update(
+                status='QUEUED', attempts=0, run_after=timezone.now(), error='')
+            job.refresh_from_db()
+
+    if getattr(settings, 'JOB_QUEUE_EAGER', False):
+        transaction.on_commit(lambda: run_pending(worker_id='eager'))
+    return job
+
+
+def claim(worker_id):
+    """Lock the next due job for ``worker_id`` and return it, or None."""
+    due = Job.objects.filter(status='QUEUED', run_after__lte=timezone.now()).order_by('run_after', 'id')
+    claimed = {
+        'status': 'RUNNING',
+        'locked_by': worker_id,
+        'locked_at': timezone.now(),
+        'attempts': F('attempts') + 1,
+    }
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job = due.select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            Job.objects.filter(pk=job.pk).update(**claimed)
+    else:
+        for job_id in due.values_list('id', flat=True)[:20]:
+            if Job.objects.filter(pk=job_id, status='QUEUED').update(**claimed):
+                break
+        else:
+            return None
+        job = Job(pk=job_id)
+    job.refresh_from_db()
+    return job
+
+
+def _backoff(attempts):
+    base = getattr(settings, 'JOB_RETRY_BACKOFF', 2)
+    return timedelta(seconds=min(base ** attempts, 3600))
+
+
+def execute(job):
+    """Run a claimed job and record its outcome."""
+    func = HANDLERS.get(job.kind)
+    try:
+        if func is None:
+            raise PermanentJobError(f'No job handler registered for {job.kind!r}')
+        result = func(job.payload)
+    except PermanentJobError as exc:
+        Job.objects.filter(pk=job.pk).update(status='FAILED', error=str(exc), locked_by='', locked_at=None)
+        return
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception('Job %s (%s) failed on attempt %s', job.pk, job.kind, job.attempts)
+        if job.attempts >= job.max_attempts:
+            Job.objects.filter(pk=job.pk).update(status='FAILED', error=error, locked_by='', locked_at=None)
+        else:
+            Job.objects.filter(pk=job.pk).update(
+                status='QUEUED', error=error, locked_by='', locked_at=None,
+                run_after=timezone.now() + _backoff(job.attempts))
+        return
+    Job.objects.filter(pk=job.pk).update(status='SUCCEEDED', result=result, error='', locked_by='', locked_at=None)
+
+
+def requeue_stale(timeout=None):
+    """Put back jobs whose worker died mid-run. Returns how many were requeued."""
+    timeout = timeout or getattr(settings, 'JOB_STALE_AFTER', 300)
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    return Job.objects.filter(status='RUNNING', locked_at__lt=cutoff).update(
+        status='QUEUED', locked_by='', locked_at=None)
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def run_pending(worker_id=None, limit=None):
+    """Run due jobs until none are left (or ``limit`` ran). Returns the count."""
+    worker_id = worker_id or default_worker_id()
+    ran = 0
+    while limit is None or ran < limit:
+        job = claim(worker_id)
+        if job is None:
+            break
+        execute(job)
+        ran += 1
+    return ran
+
+
+def work(stop_event, worker_id=None, poll_interval=1.0):
+    """Worker loop: run jobs until ``stop_event`` is set, polling when idle."""
+    worker_id = worker_id or default_worker_id()
+    while not stop_event.is_set():
+        close_old_connections()
+        try:
+            ran = run_pending(worker_id, limit=100)
+        except Exception:
+            logger.exception('Worker %s failed to poll for jobs', worker_id)
+            ran = 0
+        if not ran:
+            stop_event.wait(poll_interval)
+    close_old_connections()
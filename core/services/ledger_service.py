@@ -0,0 +1,109 @@
+"""
+Wallet ledger rollups and Transaction partitions.
+
+Every recorded Transaction is added to two WalletRollup rows (its day and
+its month) by the post_save signal, so summaries read a handful of rollup
+rows instead of aggregating the ledger. Transactions are never updated or
+deleted by the application; if that ever happens, or rows are written with
+bulk_create, run `manage.py rebuild_wallet_rollups`.
+"""
+from datetime import date
+
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDay, TruncMonth
+from django.utils import timezone
+
+from core.models import Transaction, WalletRollup
+
+
+def period_starts(moment):
+    day = timezone.localtime(moment).date()
+    return {'DAY': day, 'MONTH': day.replace(day=1)}
+
+
+def add_to_rollups(txn):
+    for period, start in period_starts(txn.created_at).items():
+        key = {'wallet_id': txn.wallet_id, 'period': period, 'period_start': start,
+               'transaction_type': txn.transaction_type}
+        delta = {'total': F('total') + txn.amount, 'count': F('count') + 1}
+        if WalletRollup.objects.filter(**key).update(**delta):
+            continue
+        try:
+            with transaction.atomic():
+                WalletRollup.objects.create(total=txn.amount, count=1, **key)
+        except IntegrityError:
+            # Another writer created the row first
+            WalletRollup.objects.filter(**key).update(**delta)
+
+
+def rebuild_rollups(wallet_ids=None):
+    """Recompute rollups from the ledger. Returns the number of rows written."""
+    transactions = Transaction.objects.all()
+    rollups = WalletRollup.objects.all()
+    if wallet_ids is not None:
+        transactions = transactions.filter(wallet_id__in=wallet_ids)
+        rollups = rollups.filter(wallet_id__in=wallet_ids)
+
+    rows = []
+    for period, trunc in (('DAY', TruncDay), ('MONTH', TruncMonth)):
+        totals = (transactions.annotate(period_start=trunc('created_at'))
+                  .values('wallet_id', 'period_start', 'transaction_type')
+                  .annotate(total=Sum('amount'), count=Count('id')))
+        for row in totals:
+            start = row['period_start']
+            rows.append(WalletRollup(
+                wallet_id=row['wallet_id'], period=period, transaction_type=row['transaction_type'],
+                period_start=start.date() if hasattr(start, 'date') else start,
+                total=row['total'], count=row['count']))
+    with transaction.atomic():
+        rollups.delete()
+        WalletRollup.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+# Partitions (PostgreSQL only)
+
+PARTITION_LOCK = 0x6c656467  # pg_advisory_xact_lock key shared by every process creating partitions
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month_start):
+    return f'core_transaction_{month_start:%Y_%m}'
+
+
+def create_partitions(start, months):
+    """
+    Create monthly partitions of core_transaction for ``months`` months
+    from the month containing ``start``, moving any rows for those months
+    out of the default partition. Existing partitions are left alone, and
+    concurrent callers (several worker replicas) wait for each other on an
+    advisory lock. Returns the names created; does nothing off PostgreSQL.
+    """
+    if connection.vendor != 'postgresql':
+        return []
+    created = []
+    month_start = start.replace(day=1)
+    for _ in range(months):
+        month_end = _add_months(month_start, 1)
+        name = partition_name(month_start)
+        bounds = [month_start.isoformat(), month_end.isoformat()]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [PARTITION_LOCK])  # Released at commit
+            cursor.execute('SELECT to_regclass(%s)', [name])
+            if cursor.fetchone()[0] is None:
+                # A partition cannot be attached while the default partition
+                # holds rows in its range, so move those rows in first
+                cursor.execute(f'CREATE TABLE IF NOT EXISTS {name} (LIKE core_transaction INCLUDING DEFAULTS)')
+                cursor.execute(f'INSERT INTO {name} SELECT * FROM core_transaction_default '
+                               'WHERE created_at >= %s AND created_at < %s', bounds)
+                cursor.execute('DELETE FROM core_transaction_default WHERE created_at >= %s AND created_at < %s',
+                               bounds)
+                cursor.execute(f'ALTER TABLE core_transaction ATTACH PARTITION {name} '
+                               f"FOR VALUES FROM ('{bounds[0]}') TO ('{bounds[1]}')")
+                created.append(name)
+        month_start = month_end
+    return created
@@ -0,0 +1,173 @@
+"""
+Materialized trip/request matches.
+
+``refresh_trip`` and ``refresh_request`` recompute TripMatch rows with
+occupancy-correct fares. Model signals schedule them when a trip moves,
+a request is created or changes state, or an offer is accepted.
+Scheduled work runs on a per-process background thread (MATCH_WORKER =
+'thread'), immediately in the caller ('inline'), or not at all ('off',
+rows are then only refreshed when read). Scheduling the same trip or
+request several times before the worker gets to it refreshes it once.
+"""
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from core.models import Trip, CarpoolRequest, TripMatch
+from core.services import graph_service, fare_service, graph_index, trip_index
+
+logger = logging.getLogger(__name__)
+
+
+def evaluate(trip, carpool_req, snapshot=None, accepted_offers=None):
+    """
+    Detour and fare for adding ``carpool_req`` to ``trip`` from its current
+    position. Returns ``(full_route, detour, fare)`` or ``(None, None, None)``
+    when the request cannot be served. The fare accounts for the passengers
+    already on board each hop of the new route.
+    """
+    snapshot = snapshot or graph_index.current()
+    curr_idx = trip.current_route_index()
+    remaining_route = trip.route[curr_idx:]
+    pickup_id = carpool_req.pickup_node_id
+    dropoff_id = carpool_req.dropoff_node_id
+
+    if not (graph_service.is_within_radius(remaining_route, pickup_id, snapshot=snapshot) and
+            graph_service.is_within_radius(remaining_route, dropoff_id, snapshot=snapshot)):
+        return None, None, None
+
+    new_route, detour = graph_service.calculate_best_detour(remaining_route, pickup_id, dropoff_id, snapshot)
+    if not new_route:
+        return None, None, None
+
+    full_route = trip.route[:curr_idx] + new_route
+    occupancy = trip.get_occupancy_per_hop(full_route, accepted_offers)[curr_idx:]
+    fare = fare_service.calculate_trip_fare(occupancy, new_route, pickup_id, dropoff_id)
+    return full_route, detour, fare
+
+
+def _accepted_offers(trip):
+    return list(trip.offers.filter(status='ACCEPTED').select_related('request'))
+
+
+def _match(trip, req, route, detour, fare, snapshot, accepted, now):
+    return TripMatch(trip=trip, request=req, route=route, detour=detour, fare=fare,
+                     route_version=trip.route_version, graph_version=snapshot.version,
+                     passengers=len(accepted), computed_at=now)
+
+
+def refresh_trip(trip_id):
+    """Recompute every match for one trip."""
+    try:
+        trip = Trip.objects.get(pk=trip_id)
+    except Trip.DoesNotExist:
+        return
+    now = timezone.now()
+    rows = []
+    if trip.status == 'ACTIVE' and trip.route:
+        snapshot = graph_index.current()
+        accepted = _accepted_offers(trip)
+        pending = CarpoolRequest.objects.pending().exclude(passenger_id=trip.driver_id)
+        for req in pending:
+            route, detour, fare = evaluate(trip, req, snapshot, accepted)
+            if route:
+                rows.append(_match(trip, req, route, detour, fare, snapshot, accepted, now))
+
+    with transaction.atomic():
+        TripMatch.objects.filter(trip=trip).exclude(request__in=[row.request for row in rows]).delete()
+        _upsert(rows)
+        # Not updated_at: a refresh changes nothing clients see of the trip,
+        # so its ETag and Last-Modified stay valid
+        Trip.objects.filter(pk=trip.pk).update(matches_refreshed_at=now)
+
+
+def refresh_request(request_id):
+    """Recompute one request's matches against the active trips near both of its stops."""
+    try:
+        req = CarpoolRequest.objects.get(pk=request_id)
+    except CarpoolRequest.DoesNotExist:
+        return
+    now = timezone.now()
+    rows = []
+    if req.status == 'PENDING' and not req.is_expired():
+        snapshot = graph_index.current()
+        trip_ids = trip_index.candidates(req.pickup_node_id, req.dropoff_node_id)
+        trips = Trip.objects.filter(id__in=trip_ids, status='ACTIVE').exclude(driver_id=req.passenger_id)
+        for trip in trips:
+            accepted = _accepted_offers(trip)
+            route, detour, fare = evaluate(trip, req, snapshot, accepted)
+            if route:
+                rows.append(_match(trip, req, route, detour, fare, snapshot, accepted, now))
+
+    with transaction.atomic():
+        TripMatch.objects.filter(request=req).exclude(trip__in=[row.trip for row in rows]).delete()
+        _upsert(rows)
+
+
+def _upsert(rows):
+    if rows:
+        TripMatch.objects.bulk_create(
+            rows, update_conflicts=True, unique_fields=['trip', 'request'],
+            update_fields=['route', 'detour', 'fare', 'route_version', 'graph_version',
+                           'passengers', 'computed_at'],
+        )
+
+
+def is_stale(trip):
+    if trip.matches_refreshed_at is None:
+        return True
+    age = (timezone.now() - trip.matches_refreshed_at).total_seconds()
+    return age > getattr(settings, 'MATCH_MAX_AGE', 60)
+
+
+# Background worker
+
+_pending = {}  # (kind, id) -> refresh function; dict keeps scheduling order
+_condition = threading.Condition()
+_worker = None
+
+
+def _mode():
+    return getattr(settings, 'MATCH_WORKER', 'thread')
+
+
+def _schedule(key, func):
+    if _mode() == 'off':
+        return
+    if _mode() == 'inline':
+        func(key[1])
+        return
+    global _worker
+    with _condition:
+        _pending[key] = func
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name='match-worker', daemon=True)
+            _worker.start()
+        _condition.notify()
+
+
+def schedule_trip(trip_id):
+    _schedule(('trip', trip_id), refresh_trip)
+
+
+def schedule_request(request_id):
+    _schedule(('request', request_id), refresh_request)
+
+
+def _run():
+    while True:
+        with _condition:
+            while not _pending:
+                _condition.wait()
+            key = next(iter(_pending))
+            func = _pending.pop(key)
+        close_old_connections()
+        try:
+            func(key[1])
+        except Exception:
+            logger.exception('Match refresh failed for %s %s', *key)
+        finally:
+            close_old_connections()
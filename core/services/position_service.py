@@ -0,0 +1,161 @@
+"""
+Coalescing buffer for fleet position updates.
+
+``record`` keeps at most one pending update per trip in process memory:
+the latest current node wins and passed nodes are merged. ``flush`` writes
+every pending trip with one locking read and one ``bulk_update``, then
+schedules their match refreshes (``bulk_update`` sends no signals).
+
+A background thread flushes every POSITION_FLUSH_INTERVAL seconds, the
+buffer is flushed as soon as it holds POSITION_BUFFER_MAX_TRIPS trips,
+and once more when the process exits normally. With an interval of 0
+every update is written before the request returns.
+
+Loss bounds: a process that dies without running its exit handlers loses
+the updates received since its last flush, i.e. at most
+POSITION_FLUSH_INTERVAL seconds of pings for at most
+POSITION_BUFFER_MAX_TRIPS trips. Positions are absolute, so the next ping
+from each vehicle repairs current_node; passed nodes reported only in the
+lost window stay missing until reported again. If a flush fails, its
+updates are merged back into the buffer and retried on the next flush.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from core import metrics
+from core.models import Trip
+from core.services import match_service, version_channel
+
+logger = logging.getLogger(__name__)
+
+_buffer = {}  # trip id -> {'current_node': id, 'passed_nodes': [ids]}
+_lock = threading.Lock()
+_flush_lock = threading.Lock()  # One flush at a time per process
+_flusher = None
+
+
+def _interval():
+    return getattr(settings, 'POSITION_FLUSH_INTERVAL', 2.0)
+
+
+def _max_trips():
+    return getattr(settings, 'POSITION_BUFFER_MAX_TRIPS', 10000)
+
+
+def _merge(pending, trip_id, current_node, passed_nodes):
+    """Fold one update into ``pending``; the caller holds ``_lock``."""
+    update = pending.get(trip_id)
+    if update is None:
+        pending[trip_id] = {'current_node': current_node, 'passed_nodes': list(passed_nodes)}
+        return False
+    update['current_node'] = current_node
+    for node_id in passed_nodes:
+        if node_id not in update['passed_nodes']:
+            update['passed_nodes'].append(node_id)
+    return True
+
+
+def record(trip_id, node_id, passed_nodes=()):
+    """
+    Buffer a position: the trip is now at ``node_id`` having passed
+    ``passed_nodes`` (``node_id`` itself counts as passed, as in update_node).
+    """
+    passed = list(passed_nodes)
+    if node_id not in passed:
+        passed.append(node_id)
+    with _lock:
+        coalesced = _merge(_buffer, trip_id, node_id, passed)
+        size = len(_buffer)
+    metrics.POSITION_UPDATES.inc(outcome='coalesced' if coalesced else 'buffered')
+
+    if _interval() <= 0 or size >= _max_trips():
+        flush()
+    else:
+        _ensure_flusher()
+
+
+def pending_count():
+    with _lock:
+        return len(_buffer)
+
+
+def flush():
+    """Write every buffered update. Returns the number of trips written."""
+    global _buffer
+    with _flush_lock:
+        with _lock:
+            pending, _buffer = _buffer, {}
+        if not pending:
+            return 0
+        try:
+            written = _write(pending)
+        except Exception:
+            with _lock:
+                # Updates that arrived meanwhile are newer than the failed ones
+                for trip_id, update in _buffer.items():
+                    _merge(pending, trip_id, update['current_node'], update['passed_nodes'])
+                _buffer = pending
+            metrics.POSITION_FLUSHES.inc(outcome='failed')
+            raise
+        metrics.POSITION_FLUSHES.inc(outcome='written')
+        metrics.POSITION_FLUSH_TRIPS.observe(written)
+        return written
+
+
+def _write(pending):
+    with transaction.atomic():
+        # Lock in id order so concurrent flushes from other processes
+        # merge passed_nodes instead of overwriting each other
+        trips = list(Trip.objects.select_for_update().filter(id__in=pending).order_by('id')
+                     .only('id', 'current_node', 'passed_nodes'))
+        now = timezone.now()
+        for trip in trips:
+            update = pending[trip.id]
+            trip.current_node_id = update['current_node']
+            trip.passed_nodes = trip.passed_nodes + [
+                node_id for node_id in update['passed_nodes'] if node_id not in trip.passed_nodes]
+            trip.updated_at = now
+        Trip.objects.bulk_update(trips, ['current_node', 'passed_nodes', 'updated_at'], batch_size=500)
+        trip_ids = [trip.id for trip in trips]
+        if trip_ids:
+            version_channel.publish('trip', {'trips': trip_ids})
+            version_channel.poll_on_commit()
+        transaction.on_commit(lambda: [match_service.schedule_trip(trip_id) for trip_id in trip_ids])
+    return len(trips)
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+    with _lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_run, name='position-flusher', daemon=True)
+            _flusher.start()
+
+
+def _run():
+    while True:
+        time.sleep(_interval())
+        close_old_connections()
+        try:
+            flush()
+        except Exception:
+            logger.exception('Position flush failed; updates kept for the next attempt')
+        finally:
+            close_old_connections()
+
+
+@atexit.register
+def _flush_at_exit():
+    if pending_count():
+        try:
+            flush()
+        except Exception:
+            logger.exception('Position flush at exit failed')
@@ -0,0 +1,85 @@
+"""
+Signed, expiring quotes for serving a request with a trip.
+
+A quote carries the spliced route, detour and fare together with the
+versions they were computed against: the trip's route_version, the
+graph_index version and the number of accepted passengers. Offer
+creation and acceptance reuse a quote whose versions still match and
+whose splice point is still ahead of the driver, and only fall back to
+graph searches when something changed.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+
+from core import metrics
+from core.services import graph_index, match_service
+
+SALT = 'core.services.quote_service'
+
+
+def issue(trip_id, request_id, route, detour, fare, route_version, graph_version, passengers):
+    return signing.dumps({
+        'trip': trip_id,
+        'request': request_id,
+        'route': route,
+        'detour': detour,
+        'fare': str(fare),
+        'route_version': route_version,
+        'graph_version': graph_version,
+        'passengers': passengers,
+    }, salt=SALT, compress=True)
+
+
+def issue_for_match(match):
+    return issue(match.trip_id, match.request_id, match.route, match.detour, match.fare,
+                 match.route_version, match.graph_version, match.passengers)
+
+
+def read(token):
+    """The quote's contents, or None if the token is forged, malformed or expired."""
+    if not token:
+        return None
+    try:
+        return signing.loads(token, salt=SALT, max_age=getattr(settings, 'QUOTE_MAX_AGE', 300))
+    except signing.BadSignature:  # Includes SignatureExpired
+        return None
+
+
+def splice_point(old_route, new_route):
+    """Index of the last node the two routes share before they diverge."""
+    shared = 0
+    for old, new in zip(old_route, new_route):
+        if old != new:
+            break
+        shared += 1
+    return shared - 1
+
+
+def route_still_valid(trip, route, route_version):
+    """True if ``route`` was built from the trip's current route and is still ahead of the driver."""
+    return (
+        route is not None
+        and route_version == trip.route_version
+        and trip.current_route_index() <= splice_point(trip.route, route)
+    )
+
+
+def resolve(token, trip, carpool_req):
+    """
+    ``(route, detour, fare)`` for the pairing: taken from ``token`` when it
+    is still valid for the trip's current state, recomputed otherwise.
+    """
+    quote = read(token)
+    if quote is not None:
+        if (quote['trip'] == trip.id and quote['request'] == carpool_req.id
+                and quote['graph_version'] == graph_index.current().version
+                and quote['passengers'] == trip.seats_taken
+                and route_still_valid(trip, quote['route'], quote['route_version'])):
+            metrics.QUOTE_CHECKS.inc(outcome='reused')
+            return quote['route'], quote['detour'], Decimal(quote['fare'])
+        metrics.QUOTE_CHECKS.inc(outcome='stale')
+    elif token:
+        metrics.QUOTE_CHECKS.inc(outcome='invalid')
+    return match_service.evaluate(trip, carpool_req)
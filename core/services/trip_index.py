@@ -0,0 +1,151 @@
+"""
+Reverse index from nodes to the ACTIVE trips that can serve them.
+
+A trip covers a node when some node on its remaining route (from
+current_node on) reaches it within graph_service.MATCH_RADIUS hops, the
+same test match_service.evaluate applies. ``candidates(pickup, dropoff)``
+intersects two index entries, so finding the trips worth evaluating for a
+request costs time in the number of nearby trips, not all active trips.
+
+The index is per process and kept current from the version channel: trip
+saves, position flushes, splices and batch creates publish their trip ids
+on the ``trip`` channel, and only those trips are re-read and re-covered.
+A graph change moves every radius, so it drops the index, which is
+rebuilt on next use.
+"""
+import logging
+import os
+import threading
+
+from core.models import Trip
+from core.services import graph_index, graph_service, version_channel
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_nodes = None  # node -> {trip ids}; None until loaded
+_coverage = {}  # trip id -> frozenset of nodes it covers
+_balls = (None, {})  # (graph version, route node -> nodes it reaches within the radius)
+_subscribed = False
+
+
+def _covered(route, snapshot):
+    """Nodes within the radius of ``route``. Called outside _lock, so the ball cache is swapped, never cleared."""
+    global _balls
+    version, balls = _balls
+    if version != snapshot.version:
+        balls = {}
+        _balls = (snapshot.version, balls)
+    covered = set()
+    for node_id in route:
+        ball = balls.get(node_id)
+        if ball is None:
+            ball = balls[node_id] = frozenset(snapshot.nodes_reachable(node_id, graph_service.MATCH_RADIUS))
+        covered |= ball
+    return frozenset(covered)
+
+
+def _remaining_route(trip):
+    return trip.route[trip.current_route_index():] if trip.route else []
+
+
+def _set(trip_id, covered):
+    """Replace one trip's coverage, touching only the nodes that changed. Caller holds _lock."""
+    old = _coverage.pop(trip_id, frozenset())
+    for node_id in old - covered:
+        trips = _nodes.get(node_id)
+        if trips is not None:
+            trips.discard(trip_id)
+            if not trips:
+                del _nodes[node_id]
+    for node_id in covered - old:
+        _nodes.setdefault(node_id, set()).add(trip_id)
+    if covered:
+        _coverage[trip_id] = covered
+
+
+def _active(trip_ids=None):
+    # From the primary even inside a replica-routed request: the version
+    # channel subscription starts from the primary's version, and a lagging
+    # replica would hide changes the channel then never replays
+    trips = Trip.objects.using('default').filter(status='ACTIVE').only('id', 'route', 'current_node_id')
+    return trips.filter(id__in=trip_ids) if trip_ids is not None else trips
+
+
+def _load():
+    global _nodes
+    snapshot = graph_index.current()
+    coverage = {trip.id: _covered(_remaining_route(trip), snapshot) for trip in _active()}
+    with _lock:
+        _nodes = {}
+        _coverage.clear()
+        for trip_id, covered in coverage.items():
+            _set(trip_id, covered)
+
+
+def _subscribe():
+    # Before loading, so no change committed during the load is missed;
+    # applying one that the load already saw is harmless
+    global _subscribed
+    if not _subscribed:
+        _subscribed = True
+        version_channel.subscribe('trip', _on_changes, invalidate)
+        version_channel.subscribe('graph', _on_graph_changes, invalidate)
+
+
+def _ensure_loaded():
+    if _nodes is None:
+        graph_index.current()  # Subscribes the graph index first, outside any lock
+        _subscribe()
+        _load()
+
+
+def refresh(trip_ids):
+    """Re-read ``trip_ids`` and update their coverage. Trips no longer ACTIVE are dropped."""
+    if _nodes is None:
+        return  # Nothing loaded yet; the next query loads fresh data
+    trip_ids = set(trip_ids)
+    snapshot = graph_index.current()
+    coverage = dict.fromkeys(trip_ids, frozenset())
+    coverage.update((trip.id, _covered(_remaining_route(trip), snapshot)) for trip in _active(trip_ids))
+    with _lock:
+        if _nodes is None:
+            return
+        for trip_id, covered in coverage.items():
+            _set(trip_id, covered)
+
+
+def _on_changes(entries):
+    """Version channel subscriber for the ``trip`` channel."""
+    refresh({trip_id for entry in entries for trip_id in entry.payload.get('trips', ())})
+
+
+def _on_graph_changes(entries):
+    if any(entry.payload.get('op') != 'node' for entry in entries):
+        invalidate()
+
+
+def candidates(pickup_id, dropoff_id):
+    """Ids of ACTIVE trips whose remaining route covers both nodes."""
+    version_channel.start()
+    _ensure_loaded()
+    with _lock:
+        if _nodes is None:
+            return set()
+        return _nodes.get(pickup_id, set()) & _nodes.get(dropoff_id, set())
+
+
+def invalidate():
+    """Drop the index in this process; the next query rebuilds it."""
+    global _nodes
+    with _lock:
+        _nodes = None
+        _coverage.clear()
+
+
+def _after_fork():
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
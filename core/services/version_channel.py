@@ -0,0 +1,270 @@
+"""
+Cross-process change channels for per-process caches.
+
+``publish(channel, payload)`` appends a ChangeLog entry in the caller's
+transaction; the entry's id is the change's version. Ids come from the
+table's sequence, so writers never queue on a shared row, but versions
+have gaps (the sequence is shared by every channel) and can commit out of
+order: a slow transaction may commit a version below one a reader has
+already seen. On PostgreSQL it also sends a NOTIFY, which only goes out on
+commit.
+
+Each process runs one listener thread. It LISTENs on PostgreSQL, or just
+sleeps elsewhere, and wakes at least every VERSION_POLL_INTERVAL seconds.
+It then reads the versions logged above each channel's high-water mark,
+plus those logged in the last VERSION_COMMIT_GRACE seconds that it has
+not dispatched yet (late commits), in one small query. It hands the new
+ChangeLog entries to the subscribers registered with ``subscribe``.
+Subscribers update only what the entries touch, and must not mind an
+entry older than changes already applied. If entries are missing (pruned,
+or the database was reset), a subscriber's ``on_reset`` is called instead,
+and it should drop everything.
+
+A writer does not wait for its own listener. The model signals call
+``poll`` right after commit.
+
+Subscriptions survive a fork (gunicorn ``--preload`` loads the routing
+index in the master), threads do not: the child resets the listener and
+its locks, and the next ``start()``, which subscribers call on every read,
+starts a listener of its own. Until then the child's caches are only as
+fresh as the master's were at the fork, and the first poll catches up.
+
+Channels:
+* ``graph``: ``{'op': 'add' | 'remove', 'from': id, 'to': id}``, ``{'op': 'node', 'id': id}``
+  (a node was created, changed or deleted) or ``{'op': 'reload'}``
+* ``trip``: ``{'trips': [ids]}`` for trips whose route, position or status changed
+"""
+import logging
+import os
+import select
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from core.models import ChangeLog, PrunedVersion
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'carpool_versions'
+
+_subscribers = {}  # channel -> [(on_change, on_reset)]
+_seen = {}  # channel -> (high-water mark, {recent version dispatched: logged at})
+_poll_lock = threading.Lock()
+_start_lock = threading.Lock()
+_listener = None
+
+
+def publish(channel, payload):
+    """Record a change on ``channel`` in the current transaction. Returns its version."""
+    entry = ChangeLog.objects.using('default').create(channel=channel, payload=payload)
+    connection = connections['default']
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFY_CHANNEL, f'{channel}:{entry.id}'])
+    return entry.id
+
+
+def _cutoff():
+    """Versions logged before this have committed or never will."""
+    return timezone.now() - timedelta(seconds=getattr(settings, 'VERSION_COMMIT_GRACE', 30))
+
+
+def current_version(channel, using='default'):
+    """The newest version on ``channel``, 0 if none. Pruning keeps each channel's newest entry."""
+    return (ChangeLog.objects.using(using).filter(channel=channel).order_by('-id')
+            .values_list('id', flat=True).first() or 0)
+
+
+def settled_version(channel, using='default'):
+    """
+    The newest version no late commit can fall below. Record this rather
+    than current_version where the changes after a version are replayed
+    later (snapshot files, graph downloads).
+    """
+    settled = (ChangeLog.objects.using(using).filter(channel=channel, created_at__lt=_cutoff())
+               .order_by('-id').values_list('id', flat=True).first())
+    return settled or pruned_version(channel, using=using)
+
+
+def pruned_version(channel, using='default'):
+    """The highest version pruned from ``channel``'s log."""
+    return PrunedVersion.objects.using(using).filter(name=channel).values_list('version', flat=True).first() or 0
+
+
+def last_change(channel, using='default'):
+    """
+    ``(version, settled, changed_at)`` for ``channel``: the current and
+    settled versions, and when the current one was logged (None if never).
+    One query unless the last change is still within the grace period.
+    """
+    latest = ChangeLog.objects.using(using).filter(channel=channel).order_by('-id').values_list('id', 'created_at').first()
+    if latest is None:
+        return 0, 0, None
+    version, changed_at = latest
+    settled = version if changed_at < _cutoff() else settled_version(channel, using=using)
+    return version, settled, changed_at
+
+
+def changes(channel, since, until=None):
+    """
+    ``(entries, complete)``: ChangeLog entries after version ``since`` (up to
+    ``until``, the current version by default), and whether none after
+    ``since`` were pruned. Versions have gaps, so this goes by the pruned
+    mark, not by counting entries.
+    """
+    if until is None:
+        until = current_version(channel)
+    if until < since:
+        return [], False  # The log was reset
+    entries = list(ChangeLog.objects.using('default')
+                   .filter(channel=channel, id__gt=since, id__lte=until).order_by('id'))
+    return entries, pruned_version(channel) <= since
+
+
+def subscribe(channel, on_change, on_reset=None):
+    """
+    Call ``on_change(entries)`` with new ChangeLog entries for ``channel``,
+    or ``on_reset()`` when some were missed. Starts the listener thread.
+    """
+    with _poll_lock:
+        if channel not in _seen:
+            # Changes visible now are for the subscriber's own load to read;
+            # recent versions below the mark that commit later are not
+            recent = (ChangeLog.objects.using('default').filter(channel=channel, created_at__gte=_cutoff())
+                      .values_list('id', 'created_at'))
+            _seen[channel] = (current_version(channel), dict(recent))
+        _subscribers.setdefault(channel, []).append((on_change, on_reset))
+    start()
+
+
+def poll():
+    """Dispatch changes committed since the last poll. One query when nothing changed."""
+    with _poll_lock:
+        if not _subscribers:
+            return
+        cutoff = _cutoff()
+        query = Q(channel__in=list(_subscribers), created_at__gte=cutoff)
+        for channel in _subscribers:
+            query |= Q(channel=channel, id__gt=_seen[channel][0])
+        logged = {channel: {} for channel in _subscribers}
+        for channel, version, created_at in (ChangeLog.objects.using('default').filter(query)
+                                             .values_list('channel', 'id', 'created_at')):
+            logged[channel][version] = created_at
+
+        for channel, callbacks in _subscribers.items():
+            mark, recent = _seen[channel]
+            new = sorted(logged[channel].keys() - recent.keys())
+            _seen[channel] = (max([mark, *new]),
+                              {version: at for version, at in logged[channel].items() if at >= cutoff})
+            if not new:
+                continue
+            # Late commits land below the mark, but only a reset log drops below it
+            complete = pruned_version(channel) <= mark and (new[-1] > mark or current_version(channel) >= mark)
+            entries = list(ChangeLog.objects.using('default').filter(id__in=new).order_by('id')) if complete else []
+            for on_change, on_reset in callbacks:
+                try:
+                    if complete:
+                        on_change(entries)
+                    elif on_reset is not None:
+                        on_reset()
+                except Exception:
+                    logger.exception('Subscriber for %s changes failed', channel)
+
+
+def poll_on_commit():
+    """Apply this process's own change as soon as its transaction commits."""
+    transaction.on_commit(poll)
+
+
+def prune(older_than=None):
+    """
+    Delete ChangeLog entries older than CHANGELOG_RETENTION_DAYS, except each
+    channel's newest, which holds its current version. Returns how many.
+    """
+    if older_than is None:
+        older_than = timezone.now() - timedelta(days=getattr(settings, 'CHANGELOG_RETENTION_DAYS', 7))
+    stale = ChangeLog.objects.using('default').filter(created_at__lt=older_than)
+    deleted = 0
+    for channel in stale.order_by().values_list('channel', flat=True).distinct():
+        doomed = stale.filter(channel=channel, id__lt=current_version(channel))
+        with transaction.atomic(using='default'):
+            horizon = doomed.order_by('-id').values_list('id', flat=True).first()
+            if horizon is None:
+                continue
+            deleted += doomed.delete()[0]
+            # Readers that have not seen up to here must reload
+            PrunedVersion.objects.using('default').get_or_create(name=channel)
+            PrunedVersion.objects.using('default').filter(name=channel, version__lt=horizon).update(version=horizon)
+    return deleted
+
+
+# Listener thread
+
+def _interval():
+    return getattr(settings, 'VERSION_POLL_INTERVAL', 1.0)
+
+
+def start():
+    """
+    Start this process's listener thread unless it is running. Cheap when it
+    is, so per-process caches call it on every read: a worker forked after
+    ``preload`` inherits the subscriptions but not the thread.
+    """
+    global _listener
+    if _listener is not None and _listener.is_alive():
+        return
+    if not getattr(settings, 'VERSION_LISTENER', True):
+        return
+    # Not _poll_lock: this may be called from a subscriber while poll() holds it
+    with _start_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = threading.Thread(target=_listen, name='version-listener', daemon=True)
+            _listener.start()
+
+
+def _after_fork():
+    # Only the forking thread survives in the child: the listener is gone,
+    # and a lock held by any other thread at the fork would never be released
+    global _poll_lock, _start_lock, _listener
+    _poll_lock = threading.Lock()
+    _start_lock = threading.Lock()
+    _listener = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _wait_for_notify(connection):
+    """Block until a NOTIFY arrives or the poll interval passes (PostgreSQL)."""
+    raw = connection.connection
+    if select.select([raw], [], [], _interval()) != ([], [], []):
+        raw.poll()
+        raw.notifies.clear()
+
+
+def _listen():
+    listening = False
+    while True:
+        connection = connections['default']
+        try:
+            if connection.vendor == 'postgresql':
+                if not listening or connection.connection is None:
+                    connection.ensure_connection()
+                    with connection.cursor() as cursor:
+                        cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+                    listening = True
+                _wait_for_notify(connection)
+            else:
+                time.sleep(_interval())
+                close_old_connections()
+            poll()
+        except Exception:
+            logger.exception('Version listener failed; reconnecting')
+            listening = False
+            connection.close()
+            time.sleep(_interval())
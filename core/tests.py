@@ -1,3 +1,1802 @@
-from django.test import TestCase
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import F
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from . import db_router, jobs, metrics, profiling
+from .bench import replay, stats
+from .management.commands.run_workers import Command as RunWorkersCommand
+from .middleware import ProfilingMiddleware
+from .views import metrics_view
+from .models import (Node, Edge, Trip, CarpoolRequest, Offer, ChangeLog, Job, Wallet, Transaction, WalletRollup,
+                     TripMatch, ArchivedTrip, ArchivedCarpoolRequest, ArchivedOffer)
+from .services import (archive_service, booking_service, graph_index, graph_service, graph_snapshot, job_queue,
+                       ledger_service, match_service, position_service, quote_service, trip_index, version_channel)
+
+
+@override_settings(MATCH_WORKER='off', POSITION_FLUSH_INTERVAL=60, POSITION_BUFFER_MAX_TRIPS=100)
+class PositionBufferTests(TestCase):
+    def setUp(self):
+        position_service._buffer.clear()
+        patcher = mock.patch.object(position_service, '_ensure_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(position_service._buffer.clear)
+
+        self.driver = User.objects.create_user(username='driver')
+        self.nodes = [Node.objects.create(name=f'N{i}') for i in range(5)]
+        for a, b in zip(self.nodes, self.nodes[1:]):
+            Edge.objects.create(from_node=a, to_node=b)
+        self.route = [node.id for node in self.nodes]
+        self.trip = self.make_trip()
+
+    def make_trip(self):
+        return Trip.objects.create(driver=self.driver, start_node=self.nodes[0], end_node=self.nodes[-1],
+                                   route=self.route, current_node=self.nodes[0], max_passengers=2, status='ACTIVE')
+
+    def test_updates_coalesce_until_flushed(self):
+        n = self.route
+        position_service.record(self.trip.id, n[1])
+        position_service.record(self.trip.id, n[3], passed_nodes=[n[2]])
+        self.assertEqual(position_service.pending_count(), 1)
+
+        # Nothing reaches the database before a flush
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.current_node_id, n[0])
+
+        self.assertEqual(position_service.flush(), 1)
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.current_node_id, n[3])
+        self.assertEqual(self.trip.passed_nodes, [n[1], n[2], n[3]])
+        self.assertEqual(position_service.pending_count(), 0)
+
+    def test_flush_writes_many_trips_in_one_update(self):
+        trips = [self.trip] + [self.make_trip() for _ in range(4)]
+        for trip in trips:
+            position_service.record(trip.id, self.route[2])
+        # Savepoint, locking read, bulk update, one trip version published
+        # for all of them (log insert, NOTIFY on PostgreSQL), release
+        with self.assertNumQueries(6 if connection.vendor == 'postgresql' else 5):
+            self.assertEqual(position_service.flush(), 5)
+        self.assertEqual(Trip.objects.filter(current_node_id=self.route[2]).count(), 5)
+
+    def test_flush_merges_with_passed_nodes_already_stored(self):
+        Trip.objects.filter(pk=self.trip.pk).update(passed_nodes=[self.route[1]])
+        position_service.record(self.trip.id, self.route[2])
+        position_service.flush()
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.passed_nodes, [self.route[1], self.route[2]])
+
+    def test_failed_flush_keeps_updates_for_retry(self):
+        n = self.route
+        position_service.record(self.trip.id, n[1])
+        with mock.patch.object(position_service, '_write', side_effect=RuntimeError('db down')):
+            with self.assertRaises(RuntimeError):
+                position_service.flush()
+        position_service.record(self.trip.id, n[2])
+        self.assertEqual(position_service.pending_count(), 1)
+
+        position_service.flush()
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.current_node_id, n[2])
+        self.assertEqual(self.trip.passed_nodes, [n[1], n[2]])
+
+    def test_full_buffer_flushes_immediately(self):
+        with override_settings(POSITION_BUFFER_MAX_TRIPS=2):
+            other = self.make_trip()
+            position_service.record(self.trip.id, self.route[1])
+            self.assertEqual(position_service.pending_count(), 1)
+            position_service.record(other.id, self.route[1])
+        self.assertEqual(position_service.pending_count(), 0)
+        self.assertEqual(Trip.objects.filter(current_node_id=self.route[1]).count(), 2)
+
+    def test_lost_window_is_repaired_by_next_ping(self):
+        # Updates buffered when a process dies are lost; the next ping
+        # carries the absolute position again.
+        position_service.record(self.trip.id, self.route[1])
+        position_service._buffer.clear()
+        position_service.record(self.trip.id, self.route[2])
+        position_service.flush()
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.current_node_id, self.route[2])
+
+    def test_positions_endpoint(self):
+        stranger = User.objects.create_user(username='stranger')
+        foreign = Trip.objects.create(driver=stranger, start_node=self.nodes[0], end_node=self.nodes[-1],
+                                      route=self.route, max_passengers=1, status='ACTIVE')
+        client = APIClient()
+        client.force_authenticate(self.driver)
+        response = client.post('/api/trips/positions/', [
+            {'trip': self.trip.id, 'node_id': self.route[1]},
+            {'trip': self.trip.id, 'node_id': self.route[2]},
+            {'trip': self.trip.id, 'node_id': 999999},
+            {'trip': foreign.id, 'node_id': self.route[1]},
+            {'node_id': self.route[1]},
+        ], format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([('errors' not in item) for item in response.json()], [True, True, False, False, False])
+        self.assertEqual(position_service.pending_count(), 1)
+
+        position_service.flush()
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.current_node_id, self.route[2])
+        self.assertEqual(self.trip.passed_nodes, [self.route[1], self.route[2]])
+
+
+@skipUnless('replica' in settings.DATABASES, 'needs a "replica" database alias (carpooling.test_settings)')
+@override_settings(MATCH_WORKER='off', DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='rider')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # The two databases are independent here, so where a row is
+        # visible from shows which one a query went to
+        self.primary_nodes = [Node.objects.create(name=f'P{i}') for i in range(2)]
+        Node.objects.using('replica').create(name='replica-only')
+
+    def node_names(self, client=None):
+        return {node['name'] for node in (client or self.client).get('/api/nodes/').json()}
+
+    def test_safe_requests_read_from_replica(self):
+        self.assertEqual(self.node_names(), {'replica-only'})
+
+    def test_reads_outside_requests_use_primary(self):
+        self.assertEqual(set(Node.objects.values_list('name', flat=True)), {'P0', 'P1'})
+        with db_router.reading_from_replica():
+            self.assertEqual(set(Node.objects.values_list('name', flat=True)), {'replica-only'})
+
+    def test_writes_go_to_primary_and_make_reads_sticky(self):
+        response = self.client.post('/api/nodes/', {'name': 'new'})
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(db_router.STICKY_COOKIE, response.cookies)
+        self.assertTrue(Node.objects.filter(name='new').exists())
+        self.assertFalse(Node.objects.using('replica').filter(name='new').exists())
+
+        # The writer reads its own write; other clients still use the replica
+        self.assertEqual(self.node_names(), {'P0', 'P1', 'new'})
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user(username='other'))
+        self.assertEqual(self.node_names(other), {'replica-only'})
+
+    def token_client(self, user):
+        token = Token.objects.create(user=user)
+        self.mirror(user, token)  # DRF authenticates the token on the replica
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        return client
+
+    def test_writes_make_the_users_other_clients_sticky(self):
+        device = self.token_client(self.user)
+        stranger = self.token_client(User.objects.create_user(username='stranger'))
+        self.assertEqual(self.node_names(device), {'replica-only'})
+
+        self.assertEqual(self.client.post('/api/nodes/', {'name': 'new'}).status_code, 201)
+        # No cookie on the second device, but it is the same user
+        self.assertEqual(self.node_names(device), {'P0', 'P1', 'new'})
+        self.assertEqual(self.node_names(stranger), {'replica-only'})
+
+        with mock.patch('core.db_router.time.time', return_value=time.time() + settings.REPLICA_STICKY_SECONDS + 1):
+            self.assertEqual(self.node_names(device), {'replica-only'})
+
+    def test_failed_write_is_not_sticky(self):
+        response = self.client.post('/api/requests/', {'pickup_node': 999, 'dropoff_node': 998})
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn(db_router.STICKY_COOKIE, response.cookies)
+        self.assertFalse(CarpoolRequest.objects.exists())
+
+    def test_one_replica_per_request(self):
+        with override_settings(DATABASE_REPLICAS=['replica', 'default']):
+            for _ in range(5):
+                with db_router.reading_from_replica():
+                    seen = {frozenset(Node.objects.values_list('name', flat=True)) for _ in range(10)}
+                self.assertEqual(len(seen), 1)
+
+    def test_use_primary_lasts_until_the_request_ends(self):
+        with db_router.reading_from_replica():
+            db_router.use_primary()
+            self.assertEqual(set(Node.objects.values_list('name', flat=True)), {'P0', 'P1'})
+        with db_router.reading_from_replica():
+            self.assertEqual(set(Node.objects.values_list('name', flat=True)), {'replica-only'})
+
+    def mirror(self, *rows):
+        # Copy rows with their ids, as replication would (bulk_create sends no signals)
+        for row in rows:
+            type(row).objects.using('replica').bulk_create([type(row).objects.get(pk=row.pk)])
+
+    def test_inline_match_refresh_is_read_back_from_primary(self):
+        nodes = self.primary_nodes + [Node.objects.create(name=f'P{i}') for i in range(2, 4)]
+        edges = [Edge.objects.create(from_node=a, to_node=b) for a, b in zip(nodes, nodes[1:])]
+        trip = Trip.objects.create(driver=self.user, start_node=nodes[0], end_node=nodes[-1],
+                                   route=[node.id for node in nodes], current_node=nodes[0],
+                                   max_passengers=2, status='ACTIVE')
+        passenger = User.objects.create_user(username='passenger')
+        CarpoolRequest.objects.create(passenger=passenger, pickup_node=nodes[1], dropoff_node=nodes[2])
+        Node.objects.using('replica').all().delete()
+        self.mirror(self.user, *nodes, *edges, trip)  # The replica has not seen the request yet
+        graph_index.invalidate()
+        self.addCleanup(graph_index.invalidate)
+
+        with override_settings(GRAPH_SNAPSHOT_PATH=None):
+            response = self.client.get(f'/api/trips/{trip.id}/matching_requests/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+
+    def test_graph_loads_from_replica(self):
+        a, b = Node.objects.using('replica').bulk_create([Node(name='RA'), Node(name='RB')])
+        Edge.objects.using('replica').bulk_create([Edge(from_node=a, to_node=b)])
+        graph_index.invalidate()
+        self.addCleanup(graph_index.invalidate)
+        with override_settings(GRAPH_SNAPSHOT_PATH=None):
+            self.assertTrue(graph_index.current().has_edge(a.id, b.id))
+
+
+@override_settings(MATCH_WORKER='off', GRAPH_SNAPSHOT_PATH=None, VERSION_LISTENER=False)
+class VersionChannelTests(TestCase):
+    def setUp(self):
+        self.reset_subscriptions()
+        self.addCleanup(self.reset_subscriptions)
+        self.nodes = [Node.objects.create(name=f'V{i}') for i in range(4)]
+
+    @staticmethod
+    def reset_subscriptions():
+        version_channel._subscribers.clear()
+        version_channel._seen.clear()
+        graph_index._subscribed = False
+        graph_index.invalidate()
+
+    def add_edge(self, a, b):
+        # Commit callbacks never run inside a TestCase, so nothing is applied
+        # locally: the change is only visible through the channel, as it
+        # would be for another worker
+        return Edge.objects.create(from_node=self.nodes[a], to_node=self.nodes[b])
+
+    def test_publish_and_poll(self):
+        received = []
+        version_channel.subscribe('trip', received.extend)
+        first = version_channel.publish('trip', {'trips': [1]})
+        second = version_channel.publish('trip', {'trips': [2, 3]})
+        version_channel.poll()
+        self.assertEqual([entry.version for entry in received], [first, second])
+        self.assertEqual(received[1].payload, {'trips': [2, 3]})
+        self.assertEqual(version_channel.current_version('trip'), second)
+
+        version_channel.poll()  # Nothing new
+        self.assertEqual(len(received), 2)
+
+    def test_missing_entries_reset_subscribers(self):
+        resets = []
+        version_channel.subscribe('trip', lambda entries: None, lambda: resets.append(True))
+        version_channel.publish('trip', {'trips': [1]})
+        newest = version_channel.publish('trip', {'trips': [2]})
+        version_channel.prune(timezone.now() + timedelta(days=1))
+        self.assertEqual(list(ChangeLog.objects.filter(channel='trip').values_list('id', flat=True)), [newest])
+        self.assertEqual(version_channel.current_version('trip'), newest)  # Never goes back
+        version_channel.poll()
+        self.assertEqual(resets, [True])
+
+    def test_gaps_from_other_channels_are_not_missing_entries(self):
+        received = []
+        version_channel.subscribe('trip', received.extend, lambda: received.append('reset'))
+        version_channel.publish('trip', {'trips': [1]})
+        version_channel.publish('graph', {'op': 'node', 'id': self.nodes[0].id})
+        version_channel.publish('trip', {'trips': [2]})
+        version_channel.poll()
+        self.assertEqual([entry.payload for entry in received], [{'trips': [1]}, {'trips': [2]}])
+
+    def test_late_commit_below_the_high_water_mark_is_dispatched(self):
+        received = []
+        version_channel.subscribe('trip', received.extend, lambda: received.append('reset'))
+        # The slow writer takes its version first but commits second
+        late = version_channel.publish('trip', {'trips': [1]})
+        hidden = ChangeLog.objects.filter(pk=late)
+        entry = hidden.get()
+        hidden.delete()
+        version_channel.publish('trip', {'trips': [2]})
+        version_channel.poll()
+        self.assertEqual([entry.payload for entry in received], [{'trips': [2]}])
+
+        entry.save()  # Commits, same id and logged-at time
+        version_channel.poll()
+        self.assertEqual([entry.payload for entry in received], [{'trips': [2]}, {'trips': [1]}])
+        version_channel.poll()
+        self.assertEqual(len(received), 2)
+
+        # Past the grace period a late commit is no longer looked for
+        ChangeLog.objects.filter(pk=late).delete()
+        with override_settings(VERSION_COMMIT_GRACE=0):
+            version_channel.poll()
+            entry.save()
+            version_channel.poll()
+        self.assertEqual(len(received), 2)
+
+    def test_other_workers_edge_changes_are_applied_incrementally(self):
+        self.add_edge(0, 1)
+        self.add_edge(1, 2)
+        ids = [node.id for node in self.nodes]
+        index = graph_index.current()
+        self.assertEqual(index.version, version_channel.current_version('graph'))
+        self.assertEqual(index.distance(ids[0], ids[2]), 2)
+        unrelated = index.nodes_reaching(ids[3], 2)
+
+        self.add_edge(0, 2)
+        Edge.objects.get(from_node=self.nodes[1], to_node=self.nodes[2]).delete()
+        self.assertIs(graph_index.current(), index)  # Not applied before the poll
+        version_channel.poll()
+
+        updated = graph_index.current()
+        self.assertEqual(updated.version, version_channel.current_version('graph'))
+        self.assertEqual(updated.distance(ids[0], ids[2]), 1)
+        self.assertFalse(updated.has_edge(ids[1], ids[2]))
+        # Cache entries the edits cannot affect are carried over, not rebuilt
+        self.assertIs(updated.nodes_reaching(ids[3], 2), unrelated)
+
+    def test_forked_worker_restarts_the_listener(self):
+        stop = threading.Event()
+        listener = threading.Thread(target=stop.wait, daemon=True)
+        listener.start()
+        self.addCleanup(stop.set)
+        with mock.patch.object(version_channel, '_listener', listener):
+            with version_channel._poll_lock:  # As if the master were mid-poll
+                pid = os.fork()
+                if pid == 0:
+                    # Child: no inherited thread, no lock left held by one
+                    ok = version_channel._listener is None and not version_channel._poll_lock.locked()
+                    os._exit(0 if ok else 1)
+            _, code = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(code), 0)
+
+        # Subscriptions outlive the fork; the next read starts a listener again
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        with mock.patch.object(version_channel, '_listener', dead), \
+                mock.patch.object(version_channel.threading, 'Thread') as thread, \
+                override_settings(VERSION_LISTENER=True):
+            graph_index.current()
+        thread.return_value.start.assert_called_once_with()
+
+    def test_trip_saves_publish_only_published_fields(self):
+        driver = User.objects.create_user(username='driver')
+        trip = Trip.objects.create(driver=driver, start_node=self.nodes[0], end_node=self.nodes[2],
+                                   route=[node.id for node in self.nodes[:3]], current_node=self.nodes[0],
+                                   max_passengers=2, status='ACTIVE')
+        start = version_channel.current_version('trip')
+        published = ChangeLog.objects.filter(channel='trip', id__gt=start)
+
+        trip = Trip.objects.get(pk=trip.pk)
+        trip.max_passengers = 3
+        trip.save()
+        trip.save(update_fields=['max_passengers'])
+        Trip.objects.get(pk=trip.pk).save(update_fields=['current_node'])  # Same value
+        self.assertFalse(published.exists())
+
+        trip.current_node = self.nodes[1]
+        trip.save(update_fields=['current_node'])
+        trip.status = 'COMPLETED'
+        trip.save()
+        self.assertEqual(published.count(), 2)
+
+    def test_reload_drops_the_index(self):
+        graph_index.current()
+        version_channel.publish('graph', {'op': 'reload'})
+        version_channel.poll()
+        self.assertIsNone(graph_index._current)
+
+    def test_snapshot_file_catches_up_from_the_log(self):
+        self.add_edge(0, 1)
+        path = os.path.join(tempfile.mkdtemp(), 'graph.csr')
+        version = version_channel.current_version('graph')
+        graph_snapshot.write(path, Edge.objects.values_list('from_node_id', 'to_node_id'), graph_version=version)
+        self.add_edge(1, 2)
+
+        ids = [node.id for node in self.nodes]
+        with override_settings(GRAPH_SNAPSHOT_PATH=path):
+            index = graph_index.current()
+            self.assertEqual(graph_index.status()['source'], 'snapshot')
+            self.assertEqual(index.distance(ids[0], ids[2]), 2)
+            self.assertEqual(index.version, version_channel.current_version('graph'))
+
+            # Once the log no longer reaches back to the file, load from the database
+            self.add_edge(2, 3)
+            version_channel.prune(timezone.now() + timedelta(days=1))
+            graph_index.invalidate()
+            self.assertEqual(graph_index.current().distance(ids[0], ids[2]), 2)
+            self.assertEqual(graph_index.status()['source'], 'database')
+
+
+@override_settings(MATCH_WORKER='off', GRAPH_SNAPSHOT_PATH=None, VERSION_LISTENER=False)
+class SeatReservationTests(TransactionTestCase):
+    def setUp(self):
+        self.driver = User.objects.create_user(username='driver')
+        self.nodes = [Node.objects.create(name=f'S{i}') for i in range(6)]
+        for a, b in zip(self.nodes, self.nodes[1:]):
+            Edge.objects.create(from_node=a, to_node=b)
+        graph_index.invalidate()
+        self.addCleanup(graph_index.invalidate)
+
+    def make_trip(self, seats):
+        return Trip.objects.create(driver=self.driver, start_node=self.nodes[0], end_node=self.nodes[-1],
+                                   route=[node.id for node in self.nodes], current_node=self.nodes[0],
+                                   max_passengers=seats, status='ACTIVE')
+
+    def make_offer(self, trip, carpool_req=None, pickup=1, dropoff=4):
+        if carpool_req is None:
+            passenger = User.objects.create_user(username=f'passenger{CarpoolRequest.objects.count()}')
+            carpool_req = CarpoolRequest.objects.create(passenger=passenger, pickup_node=self.nodes[pickup],
+                                                        dropoff_node=self.nodes[dropoff])
+        return Offer.objects.create(trip=trip, request=carpool_req, fare=10, detour=0)
+
+    def accept_concurrently(self, offers):
+        """Accept every offer at once, one thread each. Returns the outcomes in offer order."""
+        outcomes = [None] * len(offers)
+        barrier = threading.Barrier(len(offers))
+
+        def accept(index, offer):
+            try:
+                barrier.wait()
+                outcomes[index] = booking_service.accept(offer)
+            except Exception as exc:  # Reported by the assertions below
+                outcomes[index] = exc
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=accept, args=item) for item in enumerate(offers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_concurrent_accepts_never_overbook(self):
+        trip = self.make_trip(seats=3)
+        offers = [self.make_offer(trip) for _ in range(12)]
+        outcomes = self.accept_concurrently(offers)
+
+        self.assertEqual(sorted(outcomes, key=str), [None] * 3 + ['full'] * 9)
+        trip.refresh_from_db()
+        self.assertEqual(trip.seats_taken, 3)
+        accepted = Offer.objects.filter(trip=trip, status='ACCEPTED')
+        self.assertEqual(accepted.count(), 3)
+        # Losers are rolled back completely
+        self.assertEqual(CarpoolRequest.objects.filter(status='ACCEPTED').count(), 3)
+        self.assertEqual(set(CarpoolRequest.objects.filter(status='ACCEPTED').values_list('offers', flat=True)),
+                         set(accepted.values_list('id', flat=True)))
+
+    def test_accepts_on_different_trips_all_succeed(self):
+        offers = [self.make_offer(self.make_trip(seats=1)) for _ in range(6)]
+        self.assertEqual(self.accept_concurrently(offers), [None] * 6)
+        self.assertEqual(list(Trip.objects.values_list('seats_taken', flat=True)), [1] * 6)
+
+    def test_request_is_accepted_once_across_trips(self):
+        first = self.make_offer(self.make_trip(seats=2))
+        second = self.make_offer(self.make_trip(seats=2), carpool_req=first.request)
+        outcomes = self.accept_concurrently([first, second])
+
+        self.assertEqual(sorted(outcomes, key=str), [None, 'request_taken'])
+        self.assertEqual(Offer.objects.filter(status='ACCEPTED').count(), 1)
+        self.assertEqual(sum(Trip.objects.values_list('seats_taken', flat=True)), 1)
+
+    def test_accepting_twice_is_rejected(self):
+        offer = self.make_offer(self.make_trip(seats=2))
+        self.assertIsNone(booking_service.accept(offer))
+        self.assertEqual(booking_service.accept(offer), 'not_pending')
+        self.assertEqual(Trip.objects.get(pk=offer.trip_id).seats_taken, 1)
+
+    @override_settings(CARPOOL_REQUEST_TTL=60)
+    def test_expired_requests_cannot_be_accepted(self):
+        trip = self.make_trip(seats=2)
+        stale, marked = self.make_offer(trip), self.make_offer(trip)
+        CarpoolRequest.objects.filter(pk=stale.request_id).update(created_at=timezone.now() - timedelta(minutes=2))
+        CarpoolRequest.objects.filter(pk=marked.request_id).update(status='EXPIRED')
+        self.assertEqual(booking_service.accept(stale), 'expired')
+        self.assertEqual(booking_service.accept(marked), 'expired')
+        self.assertFalse(Offer.objects.filter(status='ACCEPTED').exists())
+        self.assertEqual(Trip.objects.get(pk=trip.pk).seats_taken, 0)
+
+    def test_accept_endpoint_reports_full_trip(self):
+        trip = self.make_trip(seats=1)
+        taken, late = self.make_offer(trip), self.make_offer(trip)
+        booking_service.accept(taken)
+        client = APIClient()
+        client.force_authenticate(late.request.passenger)
+        response = client.post(f'/api/offers/{late.id}/accept/')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {'error': 'Trip is full'})
+
+    def test_splice_retries_when_route_changes_underneath(self):
+        stop = Node.objects.create(name='off-route')
+        Edge.objects.create(from_node=self.nodes[2], to_node=stop)
+        Edge.objects.create(from_node=stop, to_node=self.nodes[3])
+        trip = self.make_trip(seats=2)
+        offer = self.make_offer(trip)
+        CarpoolRequest.objects.filter(pk=offer.request_id).update(pickup_node=stop)
+        booking_service.accept(offer)
+        route_still_valid = quote_service.route_still_valid
+        calls = []
+
+        def concurrent_splice(*args):
+            # Another splice commits between this job's read and its write
+            if not calls:
+                Trip.objects.filter(pk=trip.pk).update(route_version=F('route_version') + 1)
+            calls.append(args)
+            return route_still_valid(*args)
+
+        with mock.patch.object(quote_service, 'route_still_valid', side_effect=concurrent_splice):
+            result = jobs.splice_route({'offer_id': offer.id})
+
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(result['changed'])
+        trip.refresh_from_db()
+        self.assertEqual(trip.route_version, 2)  # One bump from the other splice, one from this job
+        self.assertEqual(trip.route, [node.id for node in self.nodes[:3]] + [stop.id] +
+                         [node.id for node in self.nodes[3:]])
+
+
+@override_settings(MATCH_WORKER='off', GRAPH_SNAPSHOT_PATH=None, VERSION_LISTENER=False)
+class GraphIndexRepairTests(TestCase):
+    """Incrementally repaired snapshots must match a rebuild from the same edges."""
+
+    nodes = range(30)
+
+    def build(self, edges, version=1):
+        successors, predecessors = {}, {}
+        for from_id, to_id in sorted(edges):
+            successors[from_id] = successors.get(from_id, ()) + (to_id,)
+            predecessors[to_id] = predecessors.get(to_id, ()) + (from_id,)
+        return graph_index.GraphSnapshot(version, {}, {}, base=graph_index.DictAdjacency(successors, predecessors))
+
+    def warm(self, snapshot):
+        for node in self.nodes[:8]:
+            snapshot.distances_from(node)
+            for radius in (1, 2, 3):
+                snapshot.nodes_reaching(node, radius)
+
+    def assertMatchesRebuild(self, snapshot, edges):
+        fresh = self.build(edges)
+        for source, row in snapshot._rows.items():
+            self.assertEqual(row, fresh.distances_from(source), f'row from {source}')
+        for (target, radius), ball in snapshot._neighbourhoods.items():
+            self.assertEqual(ball, fresh.nodes_reaching(target, radius), f'ball around {target}/{radius}')
+        for start in self.nodes[:8]:
+            for end in self.nodes:
+                path = snapshot.shortest_path(start, end)
+                if path is None:
+                    self.assertIsNone(fresh.shortest_path(start, end))
+                    continue
+                self.assertEqual(len(path) - 1, fresh.distance(start, end))
+                self.assertEqual(path[0], start)
+                self.assertTrue(all(pair in edges for pair in zip(path, path[1:])))
+
+    def edit_randomly(self, seed, steps=150):
+        rng = random.Random(seed)
+        edges = set()
+        while len(edges) < 60:
+            a, b = rng.sample(self.nodes, 2)
+            edges.add((a, b))
+        snapshot = self.build(edges)
+        self.warm(snapshot)
+        for version in range(2, steps + 2):
+            a, b = rng.sample(self.nodes, 2)
+            added = (a, b) not in edges
+            edges.symmetric_difference_update({(a, b)})
+            snapshot = graph_index._edit(snapshot, version, a, b, added)
+            self.assertEqual(snapshot.version, version)
+            if version % 10 == 0:
+                self.assertMatchesRebuild(snapshot, edges)
+        return snapshot, edges
+
+    def test_edge_inserts_and_deletes_repair_rows_balls_and_paths(self):
+        for seed in range(5):
+            with self.subTest(seed=seed):
+                self.edit_randomly(seed)
+
+    def test_edits_copy_only_the_overlay(self):
+        snapshot = self.build({(0, 1), (1, 2)})
+        edited = graph_index._edit(snapshot, 2, 2, 3, added=True)
+        self.assertIs(edited._base, snapshot._base)
+        self.assertEqual(edited._successors, {2: (3,)})
+        self.assertEqual(edited._predecessors, {3: (2,)})
+        self.assertEqual(snapshot.successors(2), ())  # The old snapshot is untouched
+
+    @override_settings(GRAPH_INDEX_MAX_OVERLAY=6)
+    def test_large_overlays_are_folded_into_the_base(self):
+        snapshot, edges = self.edit_randomly(seed=7, steps=60)
+        self.assertLessEqual(len(snapshot._successors) + len(snapshot._predecessors), 6)
+        self.assertMatchesRebuild(snapshot, edges)
+
+    def test_derive(self):
+        snapshot = self.build({(0, 1), (1, 2)}, version=5)
+        self.warm(snapshot)
+        # A late commit below the snapshot's version is still applied
+        late = graph_index._derive(snapshot, 4, {'op': 'add', 'from': 2, 'to': 0})
+        self.assertEqual(late.version, 5)
+        self.assertTrue(late.has_edge(2, 0))
+
+        node = graph_index._derive(snapshot, 6, {'op': 'node'})
+        self.assertEqual(node.version, 6)
+        self.assertIs(node._rows, snapshot._rows)
+
+        present = graph_index._derive(snapshot, 6, {'op': 'add', 'from': 0, 'to': 1})
+        self.assertEqual(present.version, 6)
+        self.assertIs(present._rows, snapshot._rows)
+
+        removed = graph_index._derive(snapshot, 7, {'op': 'remove', 'from': 1, 'to': 2})
+        self.assertNotIn(2, removed.distances_from(0))
+        self.assertEqual(snapshot.shortest_path(0, 2), [0, 1, 2])
+
+        self.assertIsNone(graph_index._derive(snapshot, 8, {'op': 'reload'}))
+        self.assertIsNone(graph_index._derive(snapshot, 8, {'op': 'unknown'}))
+
+
+class TripIndexTests(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.reset()
+        self.addCleanup(self.reset)
+        self.driver = User.objects.create_user(username='driver')
+        self.passenger = User.objects.create_user(username='passenger')
+        self.nodes = [Node.objects.create(name=f'T{i}') for i in range(10)]
+        for a, b in zip(self.nodes, self.nodes[1:]):
+            Edge.objects.create(from_node=a, to_node=b)
+        self.request = CarpoolRequest.objects.create(passenger=self.passenger, pickup_node=self.nodes[1],
+                                                     dropoff_node=self.nodes[3])
+
+    @staticmethod
+    def reset():
+        version_channel._subscribers.clear()
+        version_channel._seen.clear()
+        graph_index._subscribed = trip_index._subscribed = False
+        graph_index.invalidate()
+        trip_index.invalidate()
+
+    def make_trip(self, first, last, seats=2, driver=None):
+        nodes = self.nodes[first:last + 1]
+        return Trip.objects.create(driver=driver or self.driver, start_node=nodes[0], end_node=nodes[-1],
+                                   route=[node.id for node in nodes], current_node=nodes[0],
+                                   max_passengers=seats, status='ACTIVE')
+
+    def candidates(self):
+        return trip_index.candidates(self.request.pickup_node_id, self.request.dropoff_node_id)
+
+    def test_matches_the_radius_check_of_a_full_scan(self):
+        trips = [self.make_trip(0, 4), self.make_trip(5, 9), self.make_trip(2, 6), self.make_trip(0, 1)]
+        near = {trip.id for trip in trips
+                if all(graph_service.is_within_radius(trip.route, stop)
+                       for stop in (self.request.pickup_node_id, self.request.dropoff_node_id))}
+        self.assertEqual(self.candidates(), near)
+        self.assertEqual(near, {trips[0].id, trips[3].id})
+        # Candidates still need evaluating: the last trip ends before the dropoff
+        served = {trip.id for trip in trips if match_service.evaluate(trip, self.request)[0]}
+        self.assertEqual(served, {trips[0].id})
+
+    def test_follows_trips_through_the_version_channel(self):
+        self.candidates()  # Load before the trips exist
+        trip = self.make_trip(0, 4)
+        self.assertEqual(self.candidates(), set())  # Not applied before the poll
+        version_channel.poll()
+        self.assertEqual(self.candidates(), {trip.id})
+
+        client = APIClient()
+        client.force_authenticate(self.driver)
+        client.post(f'/api/trips/{trip.id}/update_node/', {'node_id': self.nodes[4].id}, format='json')
+        version_channel.poll()
+        self.assertEqual(self.candidates(), set())  # The stops are behind the driver now
+        self.assertEqual(trip_index.candidates(self.nodes[5].id, self.nodes[6].id), {trip.id})
+
+        Trip.objects.filter(pk=trip.pk).update(status='COMPLETED')
+        version_channel.publish('trip', {'trips': [trip.id]})
+        version_channel.poll()
+        self.assertEqual(trip_index._coverage, {})
+
+    def test_loads_from_the_primary_during_replica_reads(self):
+        trip = self.make_trip(0, 4)  # Not on the (empty) replica
+        with override_settings(DATABASE_REPLICAS=['replica']), db_router.reading_from_replica():
+            self.assertEqual(self.candidates(), {trip.id})
+
+    def test_covers_routes_outside_the_lock(self):
+        self.make_trip(0, 4)
+        covered = trip_index._covered
+
+        def unlocked(route, snapshot):
+            self.assertFalse(trip_index._lock.locked())
+            return covered(route, snapshot)
+
+        with mock.patch.object(trip_index, '_covered', side_effect=unlocked) as spy:
+            self.candidates()
+            trip = self.make_trip(5, 9)
+            trip_index.refresh([trip.id])
+        self.assertEqual(spy.call_count, 2)
+
+    def test_graph_change_rebuilds(self):
+        trip = self.make_trip(5, 9)
+        self.assertEqual(self.candidates(), set())
+        Edge.objects.create(from_node=self.nodes[5], to_node=self.nodes[1])
+        Edge.objects.create(from_node=self.nodes[5], to_node=self.nodes[3])
+        version_channel.poll()
+        self.assertEqual(self.candidates(), {trip.id})
+
+    def test_candidate_trips_endpoint(self):
+        alone = self.make_trip(0, 4, seats=3)
+        shared = self.make_trip(0, 4, seats=3)
+        full = self.make_trip(0, 4, seats=1)
+        own = self.make_trip(0, 4, driver=self.passenger)
+        self.make_trip(5, 9)
+        rider = User.objects.create_user(username='rider')
+        for trip in (shared, full):
+            other = CarpoolRequest.objects.create(passenger=rider, pickup_node=self.nodes[1],
+                                                  dropoff_node=self.nodes[3], status='ACCEPTED')
+            Offer.objects.create(trip=trip, request=other, fare=10, detour=0, status='ACCEPTED')
+            Trip.objects.filter(pk=trip.pk).update(seats_taken=1)
+
+        client = APIClient()
+        client.force_authenticate(self.passenger)
+        response = client.get(f'/api/requests/{self.request.id}/candidate_trips/')
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        # Sharing the hops with a passenger already on board halves the fare
+        self.assertEqual([item['trip']['id'] for item in body], [shared.id, alone.id])
+        self.assertLess(float(body[0]['proposed_fare']), float(body[1]['proposed_fare']))
+        self.assertEqual([item['seats_left'] for item in body], [2, 3])
+        self.assertNotIn(own.id, [item['trip']['id'] for item in body])
+        self.assertNotIn(full.id, [item['trip']['id'] for item in body])
+
+        client.force_authenticate(rider)
+        self.assertEqual(client.get(f'/api/requests/{self.request.id}/candidate_trips/').status_code, 403)
+
+
+# No grace period: every change is settled at once
+@override_settings(MATCH_WORKER='off', GRAPH_SNAPSHOT_PATH=None, VERSION_LISTENER=False, VERSION_COMMIT_GRACE=0)
+class ConditionalReadTests(TestCase):
+    def setUp(self):
+        graph_index._export = None  # Versions restart with every test database
+        self.driver = User.objects.create_user(username='driver')
+        self.client = APIClient()
+        self.client.force_authenticate(self.driver)
+        self.nodes = [Node.objects.create(name=f'C{i}') for i in range(4)]
+        for a, b in zip(self.nodes, self.nodes[1:]):
+            Edge.objects.create(from_node=a, to_node=b)
+
+    def revalidate(self, url, response):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_node_list_is_tied_to_the_graph_version(self):
+        first = self.client.get('/api/nodes/')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first['ETag'], f'"graph-{version_channel.current_version("graph")}"')
+        self.assertIn('Last-Modified', first)
+        with self.assertNumQueries(1):  # The newest change, no node rows
+            self.assertEqual(self.revalidate('/api/nodes/', first).status_code, 304)
+
+        Node.objects.create(name='new')
+        second = self.revalidate('/api/nodes/', first)
+        self.assertEqual(second.status_code, 200)
+        self.assertIn('new', [node['name'] for node in second.json()])
+
+    def test_editing_the_route_bumps_route_version(self):
+        trip = Trip.objects.create(driver=self.driver, start_node=self.nodes[0], end_node=self.nodes[-1],
+                                   route=[node.id for node in self.nodes], current_node=self.nodes[0],
+                                   max_passengers=2, status='ACTIVE')
+        url = f'/api/trips/{trip.id}/'
+        self.client.patch(url, {'max_passengers': 3}, format='json')
+        self.assertEqual(Trip.objects.get(pk=trip.pk).route_version, 0)
+
+        response = self.client.patch(url, {'route': [node.id for node in self.nodes[:3]]}, format='json')
+        self.assertEqual(response.json()['route_version'], 1)
+        trip.refresh_from_db()
+        self.assertEqual(trip.route_version, 1)
+        # A route priced against version 0 is no longer accepted
+        self.assertFalse(quote_service.route_still_valid(trip, trip.route, 0))
+
+    def test_trip_detail_changes_with_the_trip(self):
+        trip = Trip.objects.create(driver=self.driver, start_node=self.nodes[0], end_node=self.nodes[-1],
+                                   route=[node.id for node in self.nodes], current_node=self.nodes[0],
+                                   max_passengers=2, status='ACTIVE')
+        url = f'/api/trips/{trip.id}/'
+        first = self.client.get(url)
+        self.assertEqual(self.revalidate(url, first).status_code, 304)
+
+        self.client.post(f'{url}update_node/', {'node_id': self.nodes[1].id}, format='json')
+        second = self.revalidate(url, first)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()['current_node'], self.nodes[1].id)
+        self.assertEqual(self.client.get('/api/trips/nope/').status_code, 404)
+
+    def test_changes_within_the_grace_period_are_not_settled(self):
+        current = version_channel.current_version('graph')
+        with override_settings(VERSION_COMMIT_GRACE=30):
+            first = self.client.get('/api/nodes/')
+            self.assertEqual(first['ETag'], f'"graph-0-{current}"')
+            # A late commit could still land below the recent changes, so
+            # the next ?since stays before them
+            delta = self.client.get('/api/nodes/graph/?since=0').json()
+            self.assertEqual(delta['version'], 0)
+            self.assertEqual(delta['changes'][-1]['version'], current)
+        # Once they settle the tag changes, and cached copies are fetched again
+        self.assertEqual(self.revalidate('/api/nodes/', first).status_code, 200)
+        self.assertEqual(self.client.get('/api/nodes/')['ETag'], f'"graph-{current}"')
+
+    def test_graph_download_and_deltas(self):
+        response = self.client.get('/api/nodes/graph/')
+        self.assertEqual(response.status_code, 200)
+        version = int(response['X-Graph-Version'])
+        graph = graph_snapshot.CSRGraph(response.content)
+        self.assertEqual(graph.graph_version, version)
+        self.assertEqual(list(graph.successors(self.nodes[0].id)), [self.nodes[1].id])
+        self.assertEqual(self.revalidate('/api/nodes/graph/', response).status_code, 304)
+
+        Edge.objects.create(from_node=self.nodes[3], to_node=self.nodes[0])
+        added = version_channel.current_version('graph')
+        delta = self.client.get(f'/api/nodes/graph/?since={version}').json()
+        self.assertEqual(delta, {'version': added, 'changes': [
+            {'op': 'add', 'from': self.nodes[3].id, 'to': self.nodes[0].id, 'version': added}]})
+
+        Edge.objects.create(from_node=self.nodes[0], to_node=self.nodes[2])
+        version_channel.prune(timezone.now() + timedelta(days=1))  # Keeps only the newest
+        self.assertEqual(self.client.get(f'/api/nodes/graph/?since={version}').status_code, 410)
+        self.assertEqual(self.client.get('/api/nodes/graph/?since=x').status_code, 400)
+
+
+@override_settings(MATCH_WORKER='off', GRAPH_SNAPSHOT_PATH=None, VERSION_LISTENER=False, VERSION_COMMIT_GRACE=0)
+class GraphWarmupTests(TestCase):
+    def setUp(self):
+        VersionChannelTests.reset_subscriptions()
+        self.addCleanup(VersionChannelTests.reset_subscriptions)
+        self.nodes = [Node.objects.create(name=f'W{i}') for i in range(3)]
+        Edge.objects.create(from_node=self.nodes[0], to_node=self.nodes[1])
+
+    def test_ready_once_preloaded(self):
+        with mock.patch.object(graph_index, 'warm_async') as warm:
+            response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), {'ready': False})
+        warm.assert_called_once_with()
+
+        with mock.patch('django.db.connections.close_all'):  # Would end the test's transaction
+            graph_index.preload()
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertTrue(body['ready'])
+        self.assertEqual(body['graph']['source'], 'database')
+        self.assertEqual(body['graph']['edges'], 1)
+        self.assertEqual(body['graph']['version'], version_channel.current_version('graph'))
+
+    def build(self, path, *flags):
+        out = io.StringIO()
+        call_command('build_graph_snapshot', '--output', path, *flags, stdout=out)
+        return out.getvalue()
+
+    def test_build_snapshot_if_stale(self):
+        path = os.path.join(tempfile.mkdtemp(), 'graph.csr')
+        self.assertIn('Wrote 1 edges', self.build(path))
+        self.assertEqual(graph_snapshot.load(path).graph_version, version_channel.current_version('graph'))
+
+        with mock.patch.object(graph_snapshot, 'write') as write:
+            self.assertIn('is up to date', self.build(path, '--if-stale'))
+        write.assert_not_called()
+
+        Edge.objects.create(from_node=self.nodes[1], to_node=self.nodes[2])
+        self.assertIn('Wrote 2 edges', self.build(path, '--if-stale'))
+        self.assertEqual(graph_snapshot.load(path).graph_version, version_channel.current_version('graph'))
+
+
+@override_settings(MATCH_WORKER='off', GRAPH_SNAPSHOT_PATH=None, MATCH_MAX_AGE=60)
+class MatchServiceTests(TestCase):
+    def setUp(self):
+        TripIndexTests.reset()
+        self.addCleanup(TripIndexTests.reset)
+        self.driver = User.objects.create_user(username='driver')
+        self.passengers = [User.objects.create_user(username=f'rider{i}') for i in range(3)]
+        # 0 -> 1 -> ... -> 5, and 6 -> 7 far away
+        self.nodes = [Node.objects.create(name=f'M{i}') for i in range(8)]
+        for a, b in [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (6, 7)]:
+            Edge.objects.create(from_node=self.nodes[a], to_node=self.nodes[b])
+        self.trip = Trip.objects.create(driver=self.driver, start_node=self.nodes[0], end_node=self.nodes[5],
+                                        route=[node.id for node in self.nodes[:6]], current_node=self.nodes[0],
+                                        max_passengers=3, status='ACTIVE')
+
+    def make_request(self, passenger, pickup, dropoff):
+        return CarpoolRequest.objects.create(passenger=passenger, pickup_node=self.nodes[pickup],
+                                             dropoff_node=self.nodes[dropoff])
+
+    def matches(self):
+        return {row.request_id: row for row in TripMatch.objects.filter(trip=self.trip)}
+
+    def test_refresh_trip_matches_pending_requests_nearby(self):
+        near = self.make_request(self.passengers[0], 1, 3)
+        far = self.make_request(self.passengers[1], 6, 7)
+        self.make_request(self.driver, 1, 3)  # The driver's own request
+        updated_at = Trip.objects.get(pk=self.trip.pk).updated_at
+
+        match_service.refresh_trip(self.trip.id)
+        self.assertEqual(set(self.matches()), {near.id})
+        self.assertNotIn(far.id, self.matches())
+        row = self.matches()[near.id]
+        self.assertEqual((row.detour, row.fare, row.passengers), (0, Decimal('25.00'), 0))
+        trip = Trip.objects.get(pk=self.trip.pk)
+        self.assertIsNotNone(trip.matches_refreshed_at)
+        self.assertEqual(trip.updated_at, updated_at)  # Clients' cached copies stay valid
+
+        CarpoolRequest.objects.filter(pk=near.pk).update(status='CANCELLED')
+        match_service.refresh_trip(self.trip.id)
+        self.assertEqual(self.matches(), {})
+
+    def test_fares_count_the_passengers_on_board(self):
+        on_board = self.make_request(self.passengers[0], 1, 4)
+        Offer.objects.create(trip=self.trip, request=on_board, fare=0, detour=0, status='ACCEPTED')
+        CarpoolRequest.objects.filter(pk=on_board.pk).update(status='ACCEPTED')
+        shared = self.make_request(self.passengers[1], 1, 3)
+        alone = self.make_request(self.passengers[2], 4, 5)
+
+        match_service.refresh_trip(self.trip.id)
+        matches = self.matches()
+        self.assertEqual((matches[shared.id].fare, matches[shared.id].passengers), (Decimal('15.00'), 1))
+        self.assertEqual(matches[alone.id].fare, Decimal('15.00'))  # One hop, no one else aboard
+
+    def test_refresh_request_only_evaluates_trips_near_its_stops(self):
+        Trip.objects.create(driver=self.passengers[2], start_node=self.nodes[6], end_node=self.nodes[7],
+                            route=[self.nodes[6].id, self.nodes[7].id], current_node=self.nodes[6],
+                            max_passengers=1, status='ACTIVE')
+        req = self.make_request(self.passengers[0], 2, 4)
+        with mock.patch.object(match_service, 'evaluate', wraps=match_service.evaluate) as evaluate:
+            match_service.refresh_request(req.id)
+        self.assertEqual([call.args[0].id for call in evaluate.call_args_list], [self.trip.id])
+        self.assertEqual(list(TripMatch.objects.values_list('trip_id', 'request_id')), [(self.trip.id, req.id)])
+
+        CarpoolRequest.objects.filter(pk=req.pk).update(status='EXPIRED')
+        match_service.refresh_request(req.id)
+        self.assertFalse(TripMatch.objects.exists())
+
+    def test_reads_come_from_trip_match(self):
+        req = self.make_request(self.passengers[0], 1, 3)
+        client = APIClient()
+        client.force_authenticate(self.driver)
+        url = f'/api/trips/{self.trip.id}/matching_requests/'
+
+        # Never refreshed: computed inline once
+        response = client.get(url)
+        self.assertEqual([row['request']['id'] for row in response.json()], [req.id])
+        self.assertIn('quote', response.json()[0])
+
+        # Afterwards reads never search the graph; a stale trip is only scheduled
+        with mock.patch.object(match_service, 'evaluate', side_effect=AssertionError('searched')), \
+                mock.patch.object(match_service, 'schedule_trip') as schedule:
+            self.assertEqual(len(client.get(url).json()), 1)
+            schedule.assert_not_called()
+            Trip.objects.filter(pk=self.trip.pk).update(matches_refreshed_at=timezone.now() - timedelta(minutes=5))
+            self.assertEqual(len(client.get(url).json()), 1)
+            schedule.assert_called_once_with(self.trip.id)
+
+            self.client.force_login(self.driver)
+            response = self.client.get('/api/dashboard/')
+        self.assertEqual([match.request_id for match in response.context['matches']], [req.id])
+
+    def test_refreshes_do_not_change_the_trip_representation(self):
+        client = APIClient()
+        client.force_authenticate(self.driver)
+        url = f'/api/trips/{self.trip.id}/'
+        first = client.get(url)
+        self.assertNotIn('matches_refreshed_at', first.json())
+        match_service.refresh_trip(self.trip.id)
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+    def test_scheduled_refreshes_coalesce(self):
+        self.addCleanup(match_service._pending.clear)
+        with override_settings(MATCH_WORKER='thread'), \
+                mock.patch.object(match_service, '_worker', mock.Mock(is_alive=lambda: True)):
+            for trip_id in (1, 2, 1, 1):
+                match_service.schedule_trip(trip_id)
+            match_service.schedule_request(1)
+            self.assertEqual(list(match_service._pending), [('trip', 1), ('trip', 2), ('request', 1)])
+
+        with override_settings(MATCH_WORKER='inline'), mock.patch.object(match_service, 'refresh_trip') as refresh:
+            match_service.schedule_trip(7)
+        refresh.assert_called_once_with(7)
+        with mock.patch.object(match_service, 'refresh_trip') as refresh:
+            match_service.schedule_trip(7)  # MATCH_WORKER='off'
+        refresh.assert_not_called()
+
+
+@override_settings(MATCH_WORKER='off', GRAPH_SNAPSHOT_PATH=None)
+class QuoteServiceTests(TestCase):
+    def setUp(self):
+        graph_index.invalidate()
+        self.addCleanup(graph_index.invalidate)
+        self.driver = User.objects.create_user(username='driver')
+        self.passenger = User.objects.create_user(username='passenger')
+        # 0 -> 1 -> 2 -> 3 with a side trip 1 -> 4 -> 2
+        self.nodes = [Node.objects.create(name=f'Q{i}') for i in range(5)]
+        for a, b in [(0, 1), (1, 2), (2, 3), (1, 4), (4, 2)]:
+            Edge.objects.create(from_node=self.nodes[a], to_node=self.nodes[b])
+        self.trip = Trip.objects.create(driver=self.driver, start_node=self.nodes[0], end_node=self.nodes[3],
+                                        route=[node.id for node in self.nodes[:4]], current_node=self.nodes[0],
+                                        max_passengers=2, status='ACTIVE')
+        self.request = CarpoolRequest.objects.create(passenger=self.passenger, pickup_node=self.nodes[4],
+                                                     dropoff_node=self.nodes[3])
+        self.route, self.detour, self.fare = match_service.evaluate(self.trip, self.request)
+
+    def quote(self, **changes):
+        fields = dict(trip_id=self.trip.id, request_id=self.request.id, route=self.route, detour=self.detour,
+                      fare=self.fare, route_version=self.trip.route_version,
+                      graph_version=graph_index.current().version, passengers=self.trip.seats_taken)
+        fields.update(changes)
+        return quote_service.issue(**fields)
+
+    def resolve(self, token, outcome):
+        """Resolve ``token``; returns the result and whether it fell back to a full check."""
+        before = self.checks(outcome)
+        with mock.patch.object(match_service, 'evaluate', wraps=match_service.evaluate) as evaluate:
+            result = quote_service.resolve(token, self.trip, self.request)
+        if outcome is not None:
+            self.assertEqual(self.checks(outcome), before + 1, outcome)
+        return result, evaluate.called
+
+    @staticmethod
+    def checks(outcome):
+        return metrics.collect().get((metrics.QUOTE_CHECKS.name, (outcome,)), 0)
+
+    def test_a_current_quote_is_reused(self):
+        self.assertEqual(self.route, [self.nodes[i].id for i in (0, 1, 4, 2, 3)])
+        result, searched = self.resolve(self.quote(), 'reused')
+        self.assertEqual(result, (self.route, self.detour, self.fare))
+        self.assertFalse(searched)
+
+    def test_tampered_or_expired_tokens_are_rechecked(self):
+        token = self.quote(fare='0.01')
+        self.assertEqual(self.resolve(token[:-2] + 'xx', 'invalid'), ((self.route, self.detour, self.fare), True))
+        with mock.patch.object(signing.time, 'time', return_value=signing.time.time() - 301):
+            expired = self.quote(fare='0.01')
+        self.assertEqual(self.resolve(expired, 'invalid'), ((self.route, self.detour, self.fare), True))
+
+    def test_quotes_go_stale_when_their_versions_change(self):
+        version = graph_index.current().version
+        for token in [self.quote(graph_version=version - 1),
+                      self.quote(route_version=self.trip.route_version - 1),
+                      self.quote(passengers=1),
+                      self.quote(request_id=0)]:
+            _, searched = self.resolve(token, 'stale')
+            self.assertTrue(searched)
+
+    def test_quotes_go_stale_once_the_driver_passes_the_splice_point(self):
+        token = self.quote()
+        self.trip.current_node = self.nodes[2]
+        result, searched = self.resolve(token, 'stale')
+        self.assertTrue(searched)
+        self.assertEqual(result, (None, None, None))  # Node 4 is behind the driver now
+
+    def test_no_token_runs_a_full_check(self):
+        result, searched = self.resolve('', None)
+        self.assertEqual(result, (self.route, self.detour, self.fare))
+        self.assertTrue(searched)
+
+
+@override_settings(MATCH_WORKER='off')
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.driver = User.objects.create_user(username='driver')
+        self.passenger = User.objects.create_user(username='passenger')
+        self.nodes = [Node.objects.create(name=f'A{i}') for i in range(3)]
+
+    def finished_trip(self, days_ago=10):
+        trip = Trip.objects.create(driver=self.driver, start_node=self.nodes[0], end_node=self.nodes[2],
+                                   route=[node.id for node in self.nodes], current_node=self.nodes[2],
+                                   max_passengers=2, status='COMPLETED')
+        carpool_req = CarpoolRequest.objects.create(passenger=self.passenger, pickup_node=self.nodes[0],
+                                                    dropoff_node=self.nodes[2], status='COMPLETED')
+        offer = Offer.objects.create(trip=trip, request=carpool_req, fare=10, detour=0, status='ACCEPTED')
+        created_at = timezone.now() - timedelta(days=days_ago)
+        Trip.objects.filter(pk=trip.pk).update(created_at=created_at)
+        CarpoolRequest.objects.filter(pk=carpool_req.pk).update(created_at=created_at)
+        return trip, carpool_req, offer
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def pending_request(self, age):
+        carpool_req = CarpoolRequest.objects.create(passenger=self.passenger, pickup_node=self.nodes[0],
+                                                    dropoff_node=self.nodes[2])
+        CarpoolRequest.objects.filter(pk=carpool_req.pk).update(created_at=self.now - age)
+        return CarpoolRequest.objects.get(pk=carpool_req.pk)
+
+    def test_requests_never_expire_by_default(self):
+        self.now = timezone.now()
+        old = self.pending_request(timedelta(days=365))
+        self.assertEqual(settings.CARPOOL_REQUEST_TTL, 0)
+        self.assertFalse(old.is_expired())
+        self.assertEqual(archive_service.expire_requests(), 0)
+        self.assertEqual(list(CarpoolRequest.objects.pending()), [old])
+
+    @override_settings(CARPOOL_REQUEST_TTL=60)
+    def test_requests_expire_only_past_the_ttl(self):
+        self.now = timezone.now()
+        at_ttl = self.pending_request(timedelta(seconds=60))
+        past_ttl = self.pending_request(timedelta(seconds=60, microseconds=1))
+        with mock.patch('core.models.timezone.now', return_value=self.now):
+            self.assertFalse(at_ttl.is_expired())
+            self.assertTrue(past_ttl.is_expired())
+            self.assertEqual(list(CarpoolRequest.objects.pending()), [at_ttl])
+            self.assertEqual(archive_service.expire_requests(), 1)
+        self.assertEqual(CarpoolRequest.objects.get(pk=at_ttl.pk).status, 'PENDING')
+        self.assertEqual(CarpoolRequest.objects.get(pk=past_ttl.pk).status, 'EXPIRED')
+
+    def test_an_interrupted_archive_resumes_where_it_stopped(self):
+        for _ in range(3):
+            self.finished_trip()
+        archive_trips = archive_service._archive_trips
+        calls = []
+
+        def crash_on_second_batch(ids):
+            calls.append(ids)
+            moved = archive_trips(ids)
+            if len(calls) == 2:
+                raise RuntimeError('killed')
+            return moved
+
+        with mock.patch.object(archive_service, '_archive_trips', side_effect=crash_on_second_batch):
+            with self.assertRaises(RuntimeError):
+                archive_service.archive(days=1, batch_size=1)
+        # The first batch is committed, the second rolled back whole
+        self.assertEqual((ArchivedTrip.objects.count(), ArchivedOffer.objects.count(), Trip.objects.count()),
+                         (1, 1, 2))
+
+        totals = archive_service.archive(days=1, batch_size=1)
+        self.assertEqual(totals, {'trips': 2, 'offers': 2, 'requests': 3})
+        self.assertEqual((Trip.objects.count(), Offer.objects.count(), CarpoolRequest.objects.count()), (0, 0, 0))
+        self.assertEqual((ArchivedTrip.objects.count(), ArchivedOffer.objects.count(),
+                          ArchivedCarpoolRequest.objects.count()), (3, 3, 3))
+        self.assertEqual(archive_service.archive(days=1), {'trips': 0, 'offers': 0, 'requests': 0})
+
+    def test_recent_and_unfinished_rows_stay(self):
+        recent, _, _ = self.finished_trip(days_ago=0)
+        old, _, _ = self.finished_trip()
+        Trip.objects.filter(pk=old.pk).update(status='ACTIVE')
+        self.assertEqual(archive_service.archive(days=1), {'trips': 0, 'offers': 0, 'requests': 0})
+
+    def test_include_archived_list_and_retrieve(self):
+        archived, carpool_req, offer = self.finished_trip()
+        live, _, _ = self.finished_trip(days_ago=0)
+        archive_service.archive(days=1)
+        driver, passenger = self.client_for(self.driver), self.client_for(self.passenger)
+
+        ids = [trip['id'] for trip in driver.get('/api/trips/').json()]
+        self.assertIn(live.id, ids)
+        self.assertNotIn(archived.id, ids)
+        ids = [trip['id'] for trip in driver.get('/api/trips/?include_archived=1').json()]
+        self.assertIn(archived.id, ids)
+
+        self.assertEqual(driver.get(f'/api/trips/{archived.id}/').status_code, 404)
+        response = driver.get(f'/api/trips/{archived.id}/?include_archived=1')
+        self.assertEqual((response.status_code, response.json()['id']), (200, archived.id))
+        self.assertEqual(passenger.get(f'/api/requests/{carpool_req.id}/?include_archived=true').json()['id'],
+                         carpool_req.id)
+        self.assertIn(offer.id, [row['id'] for row in passenger.get('/api/offers/?include_archived=1').json()])
+        # Archived rows are only read back for their own users
+        self.assertEqual(passenger.get(f'/api/trips/{archived.id}/?include_archived=1').status_code, 404)
+
+    def test_transactions_still_point_at_archived_trips(self):
+        trip, _, _ = self.finished_trip()
+        Transaction.objects.create(wallet=Wallet.objects.get(user=self.passenger), amount=-10,
+                                   transaction_type='FARE_PAYMENT', trip=trip)
+        archive_service.archive(days=1)
+
+        transaction_row = Transaction.objects.get()
+        self.assertEqual(transaction_row.trip_id, trip.id)
+        self.assertTrue(ArchivedTrip.objects.filter(pk=transaction_row.trip_id).exists())
+        with self.assertRaises(Trip.DoesNotExist):
+            transaction_row.trip
+        response = self.client_for(self.passenger).get('/api/transactions/')
+        self.assertEqual([row['trip'] for row in response.json()], [trip.id])
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.wallets = [Wallet.objects.get(user=User.objects.create_user(username=f'ledger{i}')) for i in range(2)]
+        moments = [datetime(2026, 1, 31, 23, 59, tzinfo=dt_timezone.utc), datetime(2026, 2, 1, tzinfo=dt_timezone.utc),
+                   datetime(2026, 2, 1, 12, tzinfo=dt_timezone.utc), datetime(2026, 3, 15, tzinfo=dt_timezone.utc)]
+        amounts = [Decimal('12.50'), Decimal('-3.25'), Decimal('7.00')]
+        for i, moment in enumerate(moments * 3):
+            with mock.patch('django.utils.timezone.now', return_value=moment):
+                Transaction.objects.create(wallet=self.wallets[i % 2], amount=amounts[i % 3],
+                                           transaction_type=('TOPUP', 'FARE_PAYMENT', 'EARNING')[i % 3])
+
+    @staticmethod
+    def rollups():
+        return {(r.wallet_id, r.period, r.period_start, r.transaction_type): (r.total, r.count)
+                for r in WalletRollup.objects.all()}
+
+    @staticmethod
+    def raw_sums():
+        sums = defaultdict(lambda: [Decimal(0), 0])
+        for txn in Transaction.objects.all():
+            day = timezone.localtime(txn.created_at).date()
+            for period, start in (('DAY', day), ('MONTH', day.replace(day=1))):
+                entry = sums[(txn.wallet_id, period, start, txn.transaction_type)]
+                entry[0] += txn.amount
+                entry[1] += 1
+        return {key: tuple(value) for key, value in sums.items()}
+
+    def test_rollups_recorded_with_each_transaction_match_the_ledger(self):
+        self.assertEqual(self.rollups(), self.raw_sums())
+        # A minute before midnight UTC still belongs to January
+        january = (self.wallets[0].id, 'MONTH', date(2026, 1, 1), 'TOPUP')
+        self.assertEqual(self.rollups()[january], (Decimal('12.50'), 1))
+
+    def test_rebuild_matches_the_incremental_rollups(self):
+        incremental = self.rollups()
+        WalletRollup.objects.filter(wallet=self.wallets[0]).update(total=0, count=0)
+        ledger_service.rebuild_rollups(wallet_ids=[self.wallets[0].id])
+        self.assertEqual(self.rollups(), incremental)
+
+        WalletRollup.objects.all().delete()
+        self.assertEqual(ledger_service.rebuild_rollups(), len(incremental))
+        self.assertEqual(self.rollups(), self.raw_sums())
+
+    def test_summary_reports_the_rollups(self):
+        client = APIClient()
+        client.force_authenticate(self.wallets[0].user)
+        months = client.get('/api/transactions/summary/?since=2026-02-10').json()
+        expected = {key[2:]: value for key, value in self.raw_sums().items()
+                    if key[0] == self.wallets[0].id and key[1] == 'MONTH' and key[2] >= date(2026, 2, 1)}
+        self.assertEqual({(date.fromisoformat(row['period_start']), row['transaction_type']):
+                          (Decimal(row['total']), row['count']) for row in months}, expected)
+        self.assertEqual(client.get('/api/transactions/summary/?period=WEEK').status_code, 400)
+
+    @skipUnless(connection.vendor == 'postgresql', 'transactions are only partitioned on PostgreSQL')
+    def test_new_partitions_take_their_rows_from_the_default_partition(self):
+        def partition(txn):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT tableoid::regclass::text FROM core_transaction WHERE id = %s', [txn.pk])
+                return cursor.fetchone()[0]
+
+        with mock.patch('django.utils.timezone.now', return_value=datetime(2099, 2, 3, tzinfo=dt_timezone.utc)):
+            txn = Transaction.objects.create(wallet=self.wallets[0], amount=1, transaction_type='TOPUP')
+        self.assertEqual(partition(txn), 'core_transaction_default')
+        self.assertEqual(ledger_service.create_partitions(date(2099, 1, 20), 2),
+                         ['core_transaction_2099_01', 'core_transaction_2099_02'])
+        self.assertEqual(partition(txn), 'core_transaction_2099_02')
+        self.assertEqual(ledger_service.create_partitions(date(2099, 1, 20), 2), [])
+        self.assertEqual(Transaction.objects.filter(pk=txn.pk).count(), 1)
+
+
+@override_settings(MATCH_WORKER='off', GRAPH_SNAPSHOT_PATH=None)
+class BatchEndpointTests(TestCase):
+    def setUp(self):
+        graph_index.invalidate()
+        self.addCleanup(graph_index.invalidate)
+        self.driver = User.objects.create_user(username='driver')
+        self.passenger = User.objects.create_user(username='passenger')
+        # 0 -> 1 -> 2 -> 3, and 4 unreachable
+        self.nodes = [Node.objects.create(name=f'B{i}') for i in range(5)]
+        for a, b in zip(self.nodes[:4], self.nodes[1:4]):
+            Edge.objects.create(from_node=a, to_node=b)
+        self.ids = [node.id for node in self.nodes]
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def post(self, user, url, items):
+        return self.client_for(user).post(url, items, format='json')
+
+    def test_trip_batch_reports_each_item(self):
+        n = self.ids
+        response = self.post(self.driver, '/api/trips/batch/', [
+            {'start_node': n[0], 'end_node': n[3], 'max_passengers': 2},
+            {'start_node': 999999, 'end_node': n[3], 'max_passengers': 2},
+            'not an object',
+            {'start_node': n[0], 'end_node': n[4], 'max_passengers': 2},
+            {'start_node': n[0], 'end_node': n[3], 'max_passengers': -1},
+        ])
+        self.assertEqual(response.status_code, 207)
+        results = response.json()
+        self.assertEqual([result['index'] for result in results], [0, 1, 2, 3, 4])
+        self.assertEqual(results[0]['data']['route'], n[:4])
+        self.assertEqual(results[1]['errors'], {'start_node': ['Invalid pk "999999" - object does not exist.']})
+        self.assertIn('non_field_errors', results[2]['errors'])
+        self.assertEqual(results[3]['errors'], ['No path found between selected nodes.'])
+        self.assertIn('max_passengers', results[4]['errors'])
+        self.assertEqual(list(Trip.objects.values_list('id', flat=True)), [results[0]['data']['id']])
+
+        response = self.post(self.driver, '/api/trips/batch/', [
+            {'start_node': n[1], 'end_node': n[3], 'max_passengers': 1, 'status': 'ACTIVE'}])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()[0]['data']['status'], 'ACTIVE')
+
+    def test_request_batch_reports_each_item(self):
+        n = self.ids
+        response = self.post(self.passenger, '/api/requests/batch/', [
+            {'pickup_node': n[1], 'dropoff_node': n[2]},
+            {'pickup_node': n[1], 'dropoff_node': n[1]},
+            {'pickup_node': n[1], 'dropoff_node': 999999},
+            [n[1], n[2]],
+        ])
+        self.assertEqual(response.status_code, 207)
+        results = response.json()
+        self.assertEqual(results[0]['data']['passenger']['id'], self.passenger.id)
+        self.assertEqual(results[1]['errors'], ['Pickup and dropoff cannot be the same.'])
+        self.assertEqual(results[2]['errors'], {'dropoff_node': ['Invalid pk "999999" - object does not exist.']})
+        self.assertIn('non_field_errors', results[3]['errors'])
+        self.assertEqual(CarpoolRequest.objects.count(), 1)
+
+        response = self.post(self.passenger, '/api/requests/batch/', [{'pickup_node': n[2], 'dropoff_node': n[3]}])
+        self.assertEqual(response.status_code, 201)
+
+    @override_settings(BATCH_MAX_ITEMS=2)
+    def test_batches_must_be_a_non_empty_array_within_the_limit(self):
+        item = {'pickup_node': self.ids[1], 'dropoff_node': self.ids[2]}
+        for body, error in [([item] * 3, 'At most 2 items per batch'),
+                            ([], 'Expected a non-empty JSON array'),
+                            (item, 'Expected a non-empty JSON array')]:
+            response = self.post(self.passenger, '/api/requests/batch/', body)
+            self.assertEqual((response.status_code, response.json()), (400, {'error': error}))
+        self.assertFalse(CarpoolRequest.objects.exists())
+
+    def test_offer_batch_items_go_through_the_single_create_checks(self):
+        n = self.nodes
+        trip = Trip.objects.create(driver=self.driver, start_node=n[0], end_node=n[3], route=self.ids[:4],
+                                   current_node=n[0], max_passengers=2, status='ACTIVE')
+        carpool_req = CarpoolRequest.objects.create(passenger=self.passenger, pickup_node=n[1], dropoff_node=n[2])
+        own = CarpoolRequest.objects.create(passenger=self.driver, pickup_node=n[1], dropoff_node=n[2])
+        route, detour, fare = match_service.evaluate(trip, carpool_req)
+        token = quote_service.issue(trip.id, carpool_req.id, route, detour, fare, trip.route_version,
+                                    graph_index.current().version, trip.seats_taken)
+
+        with mock.patch.object(quote_service, 'resolve', wraps=quote_service.resolve) as resolve:
+            response = self.post(self.driver, '/api/offers/batch/', [
+                {'trip': trip.id, 'request': carpool_req.id, 'quote': token},
+                {'trip': trip.id, 'request': carpool_req.id},
+                {'trip': trip.id, 'request': own.id},
+                {'trip': 999999, 'request': carpool_req.id},
+                {'trip': 'x', 'request': carpool_req.id},
+            ])
+        self.assertEqual(response.status_code, 207)
+        results = response.json()
+        resolve.assert_called_once_with(token, trip, carpool_req)
+        offer = Offer.objects.get()
+        self.assertEqual((results[0]['data']['id'], offer.route, offer.detour, offer.fare, offer.route_version),
+                         (offer.id, route, detour, fare, trip.route_version))
+        self.assertEqual(results[3]['errors'], ['Not found.'])
+        self.assertIn('trip', results[4]['errors'])
+
+        # The batch reports the same errors a single create does
+        single = self.client_for(self.driver)
+        for item, result in [({'trip': trip.id, 'request': carpool_req.id}, results[1]),
+                             ({'trip': trip.id, 'request': own.id}, results[2])]:
+            response = single.post('/api/offers/', item, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual([response.json()['error']], result['errors'])
+        self.assertEqual(Offer.objects.count(), 1)
+
+
+@override_settings(MATCH_WORKER='off', GRAPH_SNAPSHOT_PATH=None, VERSION_LISTENER=False, JOB_QUEUE_EAGER=False)
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.driver = User.objects.create_user(username='driver')
+        self.passenger = User.objects.create_user(username='passenger')
+        self.nodes = [Node.objects.create(name=f'J{i}') for i in range(4)]
+        for a, b in zip(self.nodes, self.nodes[1:]):
+            Edge.objects.create(from_node=a, to_node=b)
+        self.trip = Trip.objects.create(driver=self.driver, start_node=self.nodes[0], end_node=self.nodes[-1],
+                                        route=[node.id for node in self.nodes], current_node=self.nodes[0],
+                                        max_passengers=2, status='ACTIVE')
+        self.request = CarpoolRequest.objects.create(passenger=self.passenger, pickup_node=self.nodes[1],
+                                                     dropoff_node=self.nodes[2])
+        self.offer = Offer.objects.create(trip=self.trip, request=self.request, fare=10, detour=0)
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def test_client_keys_are_scoped_by_user_and_kind(self):
+        accepted = self.client_for(self.passenger).post(
+            f'/api/offers/{self.offer.id}/accept/', HTTP_IDEMPOTENCY_KEY='abc')
+        completed = self.client_for(self.driver).post(
+            f'/api/offers/{self.offer.id}/complete_trip/', HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual((accepted.status_code, completed.status_code), (202, 202))
+        self.assertEqual(accepted.json()['job']['kind'], 'splice_route')
+        self.assertEqual(completed.json()['job']['kind'], 'settle_trip')
+        self.assertEqual(Job.objects.filter(created_by=self.driver, kind='settle_trip').count(), 1)
+
+    def test_reusing_a_key_for_another_job_is_refused(self):
+        job = job_queue.enqueue('settle_trip', {'trip_id': self.trip.id}, idempotency_key='k', user=self.driver)
+        self.assertEqual(job_queue.enqueue('settle_trip', {'trip_id': self.trip.id}, idempotency_key='k',
+                                           user=self.driver), job)
+        for kind, payload, user in [('splice_route', {'trip_id': self.trip.id}, self.driver),
+                                    ('settle_trip', {'trip_id': 0}, self.driver),
+                                    ('settle_trip', {'trip_id': self.trip.id}, self.passenger)]:
+            with self.assertRaises(job_queue.IdempotencyConflict):
+                job_queue.enqueue(kind, payload, idempotency_key='k', user=user)
+
+    def test_claim_takes_due_jobs_once_in_order(self):
+        later = Job.objects.create(kind='settle_trip', run_after=timezone.now() + timedelta(minutes=5))
+        first = Job.objects.create(kind='settle_trip', run_after=timezone.now() - timedelta(seconds=2))
+        second = Job.objects.create(kind='settle_trip', run_after=timezone.now() - timedelta(seconds=1))
+        running = Job.objects.create(kind='settle_trip', status='RUNNING', run_after=first.run_after)
+
+        claimed = job_queue.claim('w1')
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts, claimed.locked_by),
+                         (first.pk, 'RUNNING', 1, 'w1'))
+        self.assertEqual(job_queue.claim('w2').pk, second.pk)
+        self.assertIsNone(job_queue.claim('w3'))  # later is not due and running is taken
+        later.refresh_from_db()
+        running.refresh_from_db()
+        self.assertEqual((later.status, running.locked_by), ('QUEUED', ''))
+
+    @override_settings(JOB_RETRY_BACKOFF=2)
+    def test_failures_back_off_until_max_attempts(self):
+        flaky = mock.Mock(side_effect=RuntimeError('boom'))
+        with mock.patch.dict(job_queue.HANDLERS, {'flaky': flaky}), self.assertLogs(job_queue.logger, 'ERROR'):
+            job = job_queue.enqueue('flaky', {}, max_attempts=3)
+            for attempt in (1, 2):
+                before = timezone.now()
+                job_queue.execute(job_queue.claim('w'))
+                job.refresh_from_db()
+                self.assertEqual((job.status, job.attempts, job.locked_by), ('QUEUED', attempt, ''))
+                self.assertIn('boom', job.error)
+                self.assertGreaterEqual(job.run_after, before + timedelta(seconds=2 ** attempt))
+                self.assertIsNone(job_queue.claim('w'))  # Not due until the backoff passes
+                Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            job_queue.execute(job_queue.claim('w'))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), ('FAILED', 3))
+            self.assertEqual(flaky.call_count, 3)
+
+            permanent = job_queue.enqueue('flaky', {'n': 1})
+            flaky.side_effect = job_queue.PermanentJobError('no')
+            job_queue.execute(job_queue.claim('w'))
+            permanent.refresh_from_db()
+            self.assertEqual((permanent.status, permanent.attempts, permanent.error), ('FAILED', 1, 'no'))
+
+    @override_settings(JOB_STALE_AFTER=300)
+    def test_requeue_stale_puts_back_abandoned_jobs(self):
+        stale = Job.objects.create(kind='settle_trip', status='RUNNING', locked_by='dead',
+                                   locked_at=timezone.now() - timedelta(minutes=10))
+        fresh = Job.objects.create(kind='settle_trip', status='RUNNING', locked_by='alive',
+                                   locked_at=timezone.now())
+        self.assertEqual(job_queue.requeue_stale(), 1)
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.status, stale.locked_by, stale.locked_at), ('QUEUED', '', None))
+        self.assertEqual((fresh.status, fresh.locked_by), ('RUNNING', 'alive'))
+
+    def test_re_enqueue_re_arms_a_failed_job(self):
+        payload = {'trip_id': self.trip.id}
+        job = job_queue.enqueue('settle_trip', payload, idempotency_key='k', user=self.driver)
+        Job.objects.filter(pk=job.pk).update(status='FAILED', attempts=5, error='boom')
+        again = job_queue.enqueue('settle_trip', payload, idempotency_key='k', user=self.driver)
+        self.assertEqual((again.pk, again.status, again.attempts, again.error), (job.pk, 'QUEUED', 0, ''))
+
+        Job.objects.filter(pk=job.pk).update(status='SUCCEEDED', attempts=1)
+        done = job_queue.enqueue('settle_trip', payload, idempotency_key='k', user=self.driver)
+        self.assertEqual((done.status, done.attempts), ('SUCCEEDED', 1))
+
+    def test_settle_trip_rolls_back_when_a_passenger_cannot_pay(self):
+        poor = User.objects.create_user(username='poor')
+        poor_request = CarpoolRequest.objects.create(passenger=poor, pickup_node=self.nodes[1],
+                                                     dropoff_node=self.nodes[3])
+        Offer.objects.create(trip=self.trip, request=poor_request, fare=10, detour=0, status='ACCEPTED')
+        Offer.objects.filter(pk=self.offer.pk).update(status='ACCEPTED')
+        Wallet.objects.filter(user=self.passenger).update(balance=50)
+        Wallet.objects.filter(user=poor).update(balance=5)
+
+        job = job_queue.enqueue('settle_trip', {'trip_id': self.trip.id})
+        job_queue.execute(job_queue.claim('w'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'FAILED')
+        self.assertIn('poor has insufficient balance', job.error)
+
+        balances = dict(Wallet.objects.values_list('user__username', 'balance'))
+        self.assertEqual((balances['passenger'], balances['poor'], balances['driver']), (50, 5, 0))
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(WalletRollup.objects.exists())
+        self.trip.refresh_from_db()
+        self.request.refresh_from_db()
+        self.assertEqual((self.trip.status, self.request.status), ('ACTIVE', 'PENDING'))
+
+
+    def test_maintenance_goes_on_after_a_failing_task(self):
+        stale = Job.objects.create(kind='settle_trip', status='RUNNING', locked_at=timezone.now() - timedelta(hours=1))
+        with mock.patch.object(archive_service, 'expire_requests', side_effect=RuntimeError('connection lost')), \
+                mock.patch.object(version_channel, 'prune') as prune, \
+                mock.patch('core.management.commands.run_workers.close_old_connections') as close, \
+                self.assertLogs('core.management.commands.run_workers', 'ERROR') as logs:
+            RunWorkersCommand.maintain()
+        self.assertEqual(close.call_count, 5)  # Before each task and at the end
+        self.assertIn('Maintenance task expire_requests failed', logs.output[0])
+        prune.assert_called_once_with()
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, 'QUEUED')
+
+@skipUnless(connection.features.has_select_for_update_skip_locked, 'needs SELECT ... SKIP LOCKED (PostgreSQL)')
+class JobClaimLockingTests(TransactionTestCase):
+    def test_claim_skips_a_job_locked_by_another_worker(self):
+        first = Job.objects.create(kind='settle_trip', run_after=timezone.now() - timedelta(seconds=1))
+        second = Job.objects.create(kind='settle_trip')
+        locked, release = threading.Event(), threading.Event()
+
+        def hold():
+            with transaction.atomic():
+                list(Job.objects.select_for_update().filter(pk=first.pk))
+                locked.set()
+                release.wait(5)
+            connection.close()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        try:
+            self.assertTrue(locked.wait(5))
+            self.assertEqual(job_queue.claim('w').pk, second.pk)
+        finally:
+            release.set()
+            thread.join()
+
+@skipUnless(connection.vendor == 'postgresql', 'transactions are only partitioned on PostgreSQL')
+class PartitionRaceTests(TransactionTestCase):
+    def test_concurrent_workers_create_each_partition_once(self):
+        barrier = threading.Barrier(2)
+        created, errors = [], []
+
+        def create():
+            try:
+                barrier.wait(5)
+                created.extend(ledger_service.create_partitions(date(2098, 1, 1), 2))
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=create) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(created), ['core_transaction_2098_01', 'core_transaction_2098_02'])
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0)
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        self.middleware = ProfilingMiddleware(lambda request: HttpResponse('ok'))
+        patcher = mock.patch.object(profiling, 'ProfiledRun')
+        self.run = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def profiled(self, user=None, token=None):
+        headers = {'HTTP_X_PROFILE': '1'}
+        if token:
+            headers['HTTP_AUTHORIZATION'] = f'Token {token}'
+        request = RequestFactory().get('/api/nodes/', **headers)
+        request.user = user or AnonymousUser()
+        self.run.reset_mock()
+        self.middleware(request)
+        return self.run.called
+
+    def test_header_is_ignored_for_anonymous_and_non_staff_callers(self):
+        user = User.objects.create_user(username='rider')
+        self.assertFalse(self.profiled())
+        self.assertFalse(self.profiled(token='not-a-token'))
+        self.assertFalse(self.profiled(user=user))
+        self.assertFalse(self.profiled(token=Token.objects.create(user=user).key))
+
+    def test_header_profiles_staff_by_session_or_token(self):
+        staff = User.objects.create_user(username='staff', is_staff=True)
+        self.assertTrue(self.profiled(user=staff))
+        self.assertTrue(self.profiled(token=Token.objects.create(user=staff).key))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.counter = metrics.Counter('test_events_total', 'Test events.', ['kind'])
+        self.histogram = metrics.Histogram('test_duration_seconds', 'Test durations.', buckets=(0.1, 1))
+        self.addCleanup(metrics._registry.pop, self.counter.name)
+        self.addCleanup(metrics._registry.pop, self.histogram.name)
+        self.addCleanup(self.forget)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def forget(self):
+        for shard in metrics._shards:
+            for key in [key for key in shard if key[0] in (self.counter.name, self.histogram.name)]:
+                del shard[key]
+
+    def own(self, metric, *labels):
+        return metrics.collect().get((metric.name, labels))
+
+    def test_threads_record_into_shards_that_collect_sums(self):
+        threads = [threading.Thread(target=lambda: [self.counter.inc(kind='a') for _ in range(100)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.counter.inc(5, kind='b')
+        self.assertEqual(self.own(self.counter, 'a'), 400)
+        self.assertEqual(self.own(self.counter, 'b'), 5)
+
+    def test_histograms_render_cumulative_buckets(self):
+        for value in (0.05, 0.5, 0.7, 3):
+            self.histogram.observe(value)
+        self.counter.inc(kind='say "hi"\n')
+        lines = metrics.render().splitlines()
+        for line in ['# TYPE test_duration_seconds histogram',
+                     'test_duration_seconds_bucket{le="0.1"} 1',
+                     'test_duration_seconds_bucket{le="1"} 3',
+                     'test_duration_seconds_bucket{le="+Inf"} 4',
+                     'test_duration_seconds_sum 4.25',
+                     'test_duration_seconds_count 4',
+                     'test_events_total{kind="say \\"hi\\"\\n"} 1']:
+            self.assertIn(line, lines)
+
+    def test_flush_and_merge_other_workers(self):
+        with override_settings(METRICS_DIR=self.directory, METRICS_FLUSH_INTERVAL=60):
+            self.counter.inc(2, kind='a')
+            metrics.flush(force=True)
+            own_file = os.path.join(self.directory, f'metrics-{os.getpid()}.json')
+            self.assertTrue(os.path.exists(own_file))
+            with open(os.path.join(self.directory, 'metrics-1.json'), 'w') as fh:
+                json.dump([['test_events_total', ['a'], 3], ['test_duration_seconds', [], [1, 0, 0, 0.05, 1]]], fh)
+            with open(os.path.join(self.directory, 'metrics-2.json'), 'w') as fh:
+                fh.write('{not json')
+            totals = metrics.collect_all()
+            # The own file is skipped in favour of the live values
+            self.assertEqual(totals[('test_events_total', ('a',))], self.own(self.counter, 'a') + 3)
+            self.assertEqual(totals[('test_duration_seconds', ())][-1], 1)
+
+            self.counter.inc(kind='a')
+            metrics.flush()  # Within METRICS_FLUSH_INTERVAL of the last write
+            with open(own_file) as fh:
+                written = metrics._decode(json.load(fh))
+            self.assertEqual(written[('test_events_total', ('a',))], self.own(self.counter, 'a') - 1)
+
+    def test_forked_workers_do_not_report_the_parents_values(self):
+        self.histogram.observe(0.5)
+        with override_settings(METRICS_DIR=self.directory):
+            pids = []
+            for _ in range(3):
+                pid = os.fork()
+                if pid == 0:
+                    # Child: starts with empty shards and flushes them
+                    code = 0 if self.own(self.histogram) is None else 1
+                    try:
+                        metrics.flush(force=True)
+                    finally:
+                        os._exit(code)
+                pids.append(pid)
+            for pid in pids:
+                _, code = os.waitpid(pid, 0)
+                self.assertEqual(os.waitstatus_to_exitcode(code), 0)
+            self.assertEqual(len(os.listdir(self.directory)), 3)
+            self.assertEqual(metrics.collect_all()[('test_duration_seconds', ())][-1], 1)
+
+
+class MetricsEndpointTests(TestCase):
+    def scrape(self, address='127.0.0.1', user=None, token=None, **headers):
+        if token:
+            headers['HTTP_AUTHORIZATION'] = f'Token {token}'
+        request = RequestFactory().get('/metrics', REMOTE_ADDR=address, **headers)
+        request.user = user or AnonymousUser()
+        return metrics_view(request).status_code
+
+    def test_only_allowed_addresses_scrape_anonymously(self):
+        self.assertEqual(self.scrape('127.0.0.1'), 200)
+        self.assertEqual(self.scrape('::1'), 200)
+        self.assertEqual(self.scrape('10.0.0.5'), 403)
+        # Through the proxy REMOTE_ADDR is the proxy's own address
+        self.assertEqual(self.scrape('127.0.0.1', HTTP_X_FORWARDED_FOR='203.0.113.9'), 403)
+        with override_settings(METRICS_ALLOWED_IPS=['10.0.0.0/8']):
+            self.assertEqual(self.scrape('10.0.0.5'), 200)
+            self.assertEqual(self.scrape('127.0.0.1'), 403)
+
+    def test_staff_users_scrape_from_anywhere(self):
+        staff = User.objects.create_user(username='staff', is_staff=True)
+        user = User.objects.create_user(username='rider')
+        self.assertEqual(self.scrape('10.0.0.5', user=staff), 200)
+        self.assertEqual(self.scrape('10.0.0.5', token=Token.objects.create(user=staff).key,
+                                     HTTP_X_FORWARDED_FOR='203.0.113.9'), 200)
+        self.assertEqual(self.scrape('10.0.0.5', user=user), 403)
+        self.assertEqual(self.scrape('10.0.0.5', token=Token.objects.create(user=user).key), 403)
+
+
+class BenchStatsTests(TestCase):
+    def test_percentile_is_nearest_rank(self):
+        values = list(range(1, 11))
+        self.assertEqual(stats.percentile(values, 50), 5)
+        self.assertEqual(stats.percentile(values, 95), 10)
+        self.assertEqual(stats.percentile(values, 10), 1)
+        self.assertEqual(stats.percentile(values, 0), 1)
+        self.assertEqual(stats.percentile([7], 99), 7)
+        self.assertIsNone(stats.percentile([], 50))
+
+    def test_summarize(self):
+        self.assertEqual(stats.summarize([4, 1, 3, 2]),
+                         {'count': 4, 'min': 1, 'max': 4, 'mean': 2.5, 'p50': 2, 'p95': 4, 'p99': 4})
+        self.assertEqual(stats.summarize([]), {'count': 0})
+
+    def test_histogram_bounds_are_inclusive(self):
+        counts = stats.histogram([0.5, 1, 1.5, 10, 11, 20000], buckets=(1, 10))
+        self.assertEqual(counts, {'1': 2, '10': 2, '+Inf': 2})
+
+
+@override_settings(MATCH_WORKER='off', GRAPH_SNAPSHOT_PATH=None, VERSION_LISTENER=False)
+class ReplayTests(TransactionTestCase):
+    # Workers replay on threads of their own, so the data has to be committed
+    def write_log(self, lines):
+        path = os.path.join(tempfile.mkdtemp(), 'calls.jsonl')
+        with open(path, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_endpoint_names_group_ids(self):
+        self.assertEqual(replay.endpoint_name('post', '/api/trips/12/update_node/?x=1'),
+                         'POST /api/trips/{id}/update_node/')
+        self.assertEqual(replay.endpoint_name('GET', '/api/nodes/3'), 'GET /api/nodes/{id}')
+
+    def test_replays_a_recorded_log(self):
+        node = Node.objects.create(name='start')
+        path = self.write_log([
+            json.dumps({'ts': 3, 'user': 'bob', 'method': 'GET', 'path': '/api/trips/999/'}),
+            json.dumps({'ts': 1, 'user': 'alice', 'method': 'POST', 'path': '/api/nodes/', 'body': {'name': 'new'}}),
+            '',
+            json.dumps({'ts': 2, 'user': 'alice', 'path': f'/api/nodes/{node.id}/'}),
+            json.dumps({'ts': 2, 'path': '/api/nodes/'}),
+        ])
+        events = replay.load_log(path)
+        self.assertEqual([event['ts'] for event in events], [1, 2, 2, 3])
+        self.assertEqual(events[1]['method'], 'GET')
+
+        output = os.path.join(os.path.dirname(path), 'report.json')
+        out = io.StringIO()
+        call_command('replay', path, '--speed', '0', '--concurrency', '2', '--create-users',
+                     '--output', output, stdout=out)
+        self.assertIn('Total: 4 requests, 2 errors', out.getvalue())
+        with open(output) as fh:
+            report = json.load(fh)
+        endpoints = report['endpoints']
+        self.assertEqual(set(endpoints), {'POST /api/nodes/', 'GET /api/nodes/{id}/', 'GET /api/nodes/',
+                                          'GET /api/trips/{id}/'})
+        self.assertEqual(endpoints['POST /api/nodes/']['statuses'], {'201': 1})
+        self.assertEqual(endpoints['GET /api/nodes/{id}/']['statuses'], {'200': 1})
+        self.assertEqual(endpoints['GET /api/trips/{id}/']['statuses'], {'404': 1})
+        self.assertEqual(endpoints['GET /api/nodes/']['errors'], 1)  # Anonymous
+        self.assertEqual(endpoints['POST /api/nodes/']['latency_ms']['count'], 1)
+        self.assertTrue(Node.objects.filter(name='new').exists())
+
+    def test_unknown_users_and_bad_lines_fail(self):
+        path = self.write_log([json.dumps({'ts': 0, 'user': 'nobody', 'path': '/api/nodes/'})])
+        report = replay.Replayer(replay.InProcessTransport(), concurrency=1, speed=0).run(replay.load_log(path))
+        self.assertEqual(report['endpoints']['GET /api/nodes/']['statuses'], {'exception': 1})
+
+        path = self.write_log([json.dumps({'ts': 0, 'path': '/api/nodes/'}), '{not json'])
+        with self.assertRaisesRegex(CommandError, r'calls\.jsonl:2:'):
+            call_command('replay', path, stdout=io.StringIO())
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import (NodeViewSet, TripViewSet, CarpoolRequestViewSet, 
-                    OfferViewSet, driver_dashboard, WalletViewSet, TransactionViewSet)
+                    OfferViewSet, driver_dashboard, WalletViewSet, TransactionViewSet, JobViewSet)
 
 router = DefaultRouter()
 router.register(r'nodes', NodeViewSet)
@@ -10,6 +10,7 @@ router.register(r'requests', CarpoolRequestViewSet)
 router.register(r'offers', OfferViewSet)
 router.register(r'wallets', WalletViewSet)
 router.register(r'transactions', TransactionViewSet)
+router.register(r'jobs', JobViewSet)
 
 urlpatterns = [
     path('dashboard/', driver_dashboard, name='driver_dashboard'),
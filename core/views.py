@@ -1,25 +1,252 @@
+import hashlib
+import ipaddress
+from datetime import datetime, time
 from decimal import Decimal
 from rest_framework import viewsets, status, decorators, serializers
 from rest_framework.response import Response
-from .models import Node, Edge, Trip, CarpoolRequest, Offer, Wallet, Transaction
+from .models import (Node, Edge, Trip, CarpoolRequest, Offer, Wallet, Transaction, TripMatch, Job, WalletRollup,
+                     ArchivedTrip, ArchivedCarpoolRequest, ArchivedOffer)
 from .serializers import (NodeSerializer, TripSerializer, CarpoolRequestSerializer, 
-                           OfferSerializer, WalletSerializer, TransactionSerializer)
-from .services import graph_service, fare_service
+                           OfferSerializer, WalletSerializer, TransactionSerializer, JobSerializer,
+                           WalletRollupSerializer, CarpoolRequestBatchItemSerializer, TripBatchItemSerializer,
+                           OfferBatchItemSerializer, PositionUpdateSerializer,
+                           ArchivedTripSerializer, ArchivedCarpoolRequestSerializer, ArchivedOfferSerializer)
+from .services import (graph_service, graph_index, match_service, job_queue, quote_service, position_service,
+                       version_channel, booking_service, trip_index)
+from . import db_router, metrics
+from .middleware import is_staff_request
 from django.shortcuts import get_object_or_404, render, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import AuthenticationForm
-from django.http import HttpResponse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.http import HttpResponse, Http404, JsonResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_date
+from django.utils.http import http_date
 
 def home(request):
     return HttpResponse("🚀 Node-Based Carpooling System is Running!")
-class NodeViewSet(viewsets.ModelViewSet):
+
+def _allowed_scraper(request):
+    """
+    True for a direct request from METRICS_ALLOWED_IPS. Requests through a
+    proxy (X-Forwarded-For set) carry the proxy's address, so they never
+    match; they need a staff user.
+    """
+    if 'HTTP_X_FORWARDED_FOR' in request.META:
+        return False
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False)
+               for network in getattr(settings, 'METRICS_ALLOWED_IPS', ()))
+
+def metrics_view(request):
+    """Prometheus scrape endpoint, for METRICS_ALLOWED_IPS and staff users only."""
+    if not (_allowed_scraper(request) or is_staff_request(request)):
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def ready_view(request):
+    """Readiness probe: 200 once the routing index is loaded, 503 (and start loading) before."""
+    stats = graph_index.status()
+    if stats is None:
+        graph_index.warm_async()
+        return JsonResponse({'ready': False}, status=503)
+    return JsonResponse({'ready': True, 'graph': stats})
+
+class ArchiveReadThroughMixin:
+    """
+    With ``?include_archived=1``, list appends the user's archived rows and
+    retrieve falls back to the archive table for ids no longer in the hot one.
+    """
+    archive_serializer_class = None
+
+    def get_archive_queryset(self):
+        raise NotImplementedError
+
+    def include_archived(self):
+        return self.request.query_params.get('include_archived', '').lower() in ('1', 'true', 'yes')
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        if self.include_archived():
+            archived = self.archive_serializer_class(self.get_archive_queryset(), many=True).data
+            response.data = list(response.data) + list(archived)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            if not self.include_archived():
+                raise
+        archived = get_object_or_404(self.get_archive_queryset(), pk=kwargs['pk'])
+        return Response(self.archive_serializer_class(archived).data)
+
+def _conditional(request, etag, last_modified, build):
+    """
+    ``build()``'s response, or 304 Not Modified without calling it when the
+    client's If-None-Match or If-Modified-Since still holds. Either way the
+    response carries the validators, and clients must revalidate before reuse.
+    """
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = build()
+    if response.status_code in (200, 304):
+        response['ETag'] = etag
+        if timestamp is not None:
+            response['Last-Modified'] = http_date(timestamp)
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+class ConditionalReadMixin:
+    """
+    ETag and Last-Modified on list and retrieve. ``get_validators()`` returns
+    ``(etag, last_modified)`` from a version the data is tied to, or None to
+    serve the action unconditionally.
+    """
+    def get_validators(self):
+        raise NotImplementedError
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional_read(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional_read(super().retrieve, request, *args, **kwargs)
+
+    def _conditional_read(self, handler, request, *args, **kwargs):
+        validators = self.get_validators()
+        if validators is None:
+            return handler(request, *args, **kwargs)
+        return _conditional(request, *validators, lambda: handler(request, *args, **kwargs))
+
+def _idempotency_key(request, kind, object_id):
+    """
+    The job idempotency key for ``kind`` on ``object_id``. A client's
+    Idempotency-Key is namespaced by job kind and user, so it can never
+    resolve to another user's job or to a job of another kind.
+    """
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        return f'{kind}:{object_id}'
+    if len(key) > 100:
+        key = hashlib.sha256(key.encode()).hexdigest()
+    return f'{kind}:{request.user.id}:{key}'
+
+def _batch_items(request, item_serializer_class):
+    """
+    Validate the array posted to a /batch/ endpoint. Returns
+    ``(results, valid, error_response)``: ``results`` has one slot per item,
+    already filled in for invalid ones, and ``valid`` is a list of
+    ``(index, validated_data)``.
+    """
+    items = request.data
+    if not isinstance(items, list) or not items:
+        return None, None, Response({'error': 'Expected a non-empty JSON array'}, status=status.HTTP_400_BAD_REQUEST)
+    limit = getattr(settings, 'BATCH_MAX_ITEMS', 1000)
+    if len(items) > limit:
+        return None, None, Response({'error': f'At most {limit} items per batch'}, status=status.HTTP_400_BAD_REQUEST)
+
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        serializer = item_serializer_class(data=item)
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            results[index] = {'index': index, 'errors': serializer.errors}
+    return results, valid, None
+
+def _batch_response(results):
+    """201 if every item was created, 207 with per-item results otherwise."""
+    failed = any('errors' in result for result in results)
+    return Response(results, status=status.HTTP_207_MULTI_STATUS if failed else status.HTTP_201_CREATED)
+
+def _missing_nodes(data, fields, nodes):
+    return {field: [f'Invalid pk "{data[field]}" - object does not exist.']
+            for field in fields if data[field] not in nodes}
+
+class NodeViewSet(ConditionalReadMixin, viewsets.ModelViewSet):
     queryset = Node.objects.all()
     serializer_class = NodeSerializer
 
-class TripViewSet(viewsets.ModelViewSet):
+    def graph_version(self):
+        # From the database the nodes are read from, so a replica never
+        # tags older rows with a newer version
+        return version_channel.last_change('graph', using=self.get_queryset().db)
+
+    @staticmethod
+    def graph_etag(version, settled):
+        # Changes once more when the latest change settles, so a response
+        # cached before a late commit landed is fetched again
+        return f'"graph-{version}"' if settled == version else f'"graph-{settled}-{version}"'
+
+    def get_validators(self):
+        version, settled, changed_at = self.graph_version()
+        return self.graph_etag(version, settled), changed_at
+
+    @decorators.action(detail=False, methods=['get'])
+    def graph(self, request):
+        """
+        The routing graph for clients that route locally. Without ``?since``
+        it is the whole adjacency in the graph_snapshot CSR format. With
+        ``?since=<version>`` it is the graph changes logged after that version as
+        JSON, or 410 once some of them are pruned and a full download is due.
+        """
+        since = request.query_params.get('since')
+        if since is None:
+            alias = self.get_queryset().db
+            version, settled, changed_at = version_channel.last_change('graph', using=alias)
+
+            def download():
+                exported_version, data = graph_index.export(using=alias)
+                response = HttpResponse(data, content_type='application/octet-stream')
+                response['X-Graph-Version'] = exported_version
+                return response
+
+            return _conditional(request, self.graph_etag(version, settled), changed_at, download)
+
+        try:
+            since = int(since)
+        except ValueError:
+            return Response({'error': 'since must be a graph version'}, status=status.HTTP_400_BAD_REQUEST)
+        entries, complete = version_channel.changes('graph', since)
+        # The next ?since: settled, so a change that commits late is still
+        # after it. Changes above it come again then; applying one twice is a no-op.
+        version = max(since, version_channel.settled_version('graph'))
+        if not complete:
+            return Response({'error': 'Changes since that version are no longer kept; download the full graph',
+                             'version': version}, status=status.HTTP_410_GONE)
+        return Response({'version': version,
+                         'changes': [dict(entry.payload, version=entry.version) for entry in entries]})
+
+class TripViewSet(ConditionalReadMixin, ArchiveReadThroughMixin, viewsets.ModelViewSet):
     queryset = Trip.objects.all()
     serializer_class = TripSerializer
+    archive_serializer_class = ArchivedTripSerializer
+
+    def get_validators(self):
+        # Trip details only; updated_at changes with every write to the row
+        if self.action != 'retrieve':
+            return None
+        pk = self.kwargs['pk']
+        try:
+            updated_at = self.get_queryset().filter(pk=pk).values_list('updated_at', flat=True).first()
+        except (TypeError, ValueError):
+            updated_at = None
+        if updated_at is None:
+            return None  # Not found, or archived
+        return f'"trip-{pk}-{updated_at.timestamp():.6f}"', updated_at
+
+    def get_archive_queryset(self):
+        return ArchivedTrip.objects.filter(driver=self.request.user.id)
 
     def perform_create(self, serializer):
         start_node = serializer.validated_data['start_node']
@@ -32,6 +259,46 @@ class TripViewSet(viewsets.ModelViewSet):
             
         serializer.save(driver=self.request.user, route=route, current_node=start_node)
 
+    @decorators.action(detail=False, methods=['post'], url_path='batch')
+    def batch(self, request):
+        """Create many trips; routes come from one graph pass grouped by start node."""
+        results, valid, error = _batch_items(request, TripBatchItemSerializer)
+        if error:
+            return error
+        nodes = Node.objects.in_bulk({data[f] for _, data in valid for f in ('start_node', 'end_node')})
+        pending = []
+        for index, data in valid:
+            missing = _missing_nodes(data, ('start_node', 'end_node'), nodes)
+            if missing:
+                results[index] = {'index': index, 'errors': missing}
+            else:
+                pending.append((index, data))
+
+        paths = graph_service.get_shortest_paths([(data['start_node'], data['end_node']) for _, data in pending])
+        created = []
+        for index, data in pending:
+            route = paths[(data['start_node'], data['end_node'])]
+            if not route:
+                results[index] = {'index': index, 'errors': ['No path found between selected nodes.']}
+                continue
+            start_node = nodes[data['start_node']]
+            created.append((index, Trip(driver=request.user, start_node=start_node, end_node=nodes[data['end_node']],
+                                        route=route, current_node=start_node,
+                                        max_passengers=data['max_passengers'], status=data['status'])))
+
+        trips = [trip for _, trip in created]
+        with transaction.atomic():
+            Trip.objects.bulk_create(trips)
+            # bulk_create skips the post_save signal that publishes the trips
+            # and schedules their match refreshes
+            if trips:
+                version_channel.publish('trip', {'trips': [trip.pk for trip in trips]})
+                version_channel.poll_on_commit()
+            transaction.on_commit(lambda: [match_service.schedule_trip(trip.pk) for trip in trips])
+        for index, trip in created:
+            results[index] = {'index': index, 'data': TripSerializer(trip).data}
+        return _batch_response(results)
+
     @decorators.action(detail=True, methods=['post'])
     def update_node(self, request, pk=None):
         trip = self.get_object()
@@ -47,55 +314,70 @@ class TripViewSet(viewsets.ModelViewSet):
         trip.current_node = node
         if node_id not in trip.passed_nodes:
             trip.passed_nodes.append(node_id)
-        trip.save()
+        trip.save(update_fields=['current_node', 'passed_nodes', 'updated_at'])
         return Response(TripSerializer(trip).data)
 
+    @decorators.action(detail=False, methods=['post'])
+    def positions(self, request):
+        """
+        Batched position pings for the driver's trips. Updates are buffered
+        and written in bulk (see position_service), so the response is 202.
+        """
+        results, valid, error = _batch_items(request, PositionUpdateSerializer)
+        if error:
+            return error
+        routes = dict(Trip.objects.filter(driver=request.user, id__in={data['trip'] for _, data in valid})
+                      .values_list('id', 'route'))
+        for index, data in valid:
+            route = routes.get(data['trip'])
+            if route is None:
+                results[index] = {'index': index, 'errors': ['Trip not found.']}
+            elif data['node_id'] not in route or any(node_id not in route for node_id in data['passed_nodes']):
+                results[index] = {'index': index, 'errors': ['Node not in trip route']}
+            else:
+                position_service.record(data['trip'], data['node_id'], data['passed_nodes'])
+                results[index] = {'index': index, 'accepted': True}
+        rejected = sum('errors' in result for result in results)
+        if rejected:
+            metrics.POSITION_UPDATES.inc(rejected, outcome='rejected')
+        return Response(results, status=status.HTTP_202_ACCEPTED)
+
     @decorators.action(detail=True, methods=['get'])
     def matching_requests(self, request, pk=None):
         trip = self.get_object()
         if trip.status != 'ACTIVE':
             return Response({'error': 'Trip is not active'}, status=status.HTTP_400_BAD_REQUEST)
-        # Remaining route: nodes from current_node onwards
-        try:
-            curr_idx = trip.route.index(trip.current_node.id)
-            remaining_route = trip.route[curr_idx:]
-        except (ValueError, AttributeError):
-            remaining_route = trip.route
-            
-        # Filter pending requests
-        pending_requests = CarpoolRequest.objects.filter(status='PENDING')
+
+        # Matches are precomputed by the match worker; only compute inline
+        # if this trip has never been refreshed, and then read the result
+        # back from the primary, as a replica may not have it yet.
+        if trip.matches_refreshed_at is None:
+            db_router.use_primary()
+            match_service.refresh_trip(trip.id)
+        elif match_service.is_stale(trip):
+            match_service.schedule_trip(trip.id)
+
+        rows = TripMatch.objects.filter(
+            trip=trip, request__in=CarpoolRequest.objects.pending()).select_related('request__passenger')
         matches = []
-        
-        for req in pending_requests:
-            # Check if pickup and dropoff within 2 nodes of remaining route
-            if graph_service.is_within_radius(remaining_route, req.pickup_node.id) and \
-               graph_service.is_within_radius(remaining_route, req.dropoff_node.id):
-                
-                # Calculate detour and fare
-                new_route, detour = graph_service.calculate_best_detour(remaining_route, req.pickup_node.id, req.dropoff_node.id)
-                if new_route:
-                    # For fare, we'd need occupancy. For now assume basic.
-                    # occupancy = trip.get_occupancy_per_hop(new_route) # TODO
-                    occupancy = trip.get_occupancy_per_hop()
-
-                    fare = fare_service.calculate_trip_fare(
-                        occupancy,
-                        new_route,
-                        req.pickup_node.id,
-                        req.dropoff_node.id
-                    )
-                    
-                    matches.append({
-                        'request': CarpoolRequestSerializer(req).data,
-                        'detour': detour,
-                        'proposed_fare': fare
-                    })
+        for row in rows:
+            matches.append({
+                'request': CarpoolRequestSerializer(row.request).data,
+                'detour': row.detour,
+                'proposed_fare': row.fare,
+                'computed_at': row.computed_at,
+                'quote': quote_service.issue_for_match(row),
+            })
                     
         return Response(matches)
 
-class CarpoolRequestViewSet(viewsets.ModelViewSet):
+class CarpoolRequestViewSet(ArchiveReadThroughMixin, viewsets.ModelViewSet):
     queryset = CarpoolRequest.objects.all()
     serializer_class = CarpoolRequestSerializer
+    archive_serializer_class = ArchivedCarpoolRequestSerializer
+
+    def get_archive_queryset(self):
+        return ArchivedCarpoolRequest.objects.filter(passenger=self.request.user.id)
 
     def perform_create(self, serializer):
         pickup = serializer.validated_data['pickup_node']
@@ -106,15 +388,81 @@ class CarpoolRequestViewSet(viewsets.ModelViewSet):
 
         serializer.save(passenger=self.request.user)
 
+    @decorators.action(detail=False, methods=['post'], url_path='batch')
+    def batch(self, request):
+        """Create many requests in one transaction."""
+        results, valid, error = _batch_items(request, CarpoolRequestBatchItemSerializer)
+        if error:
+            return error
+        nodes = Node.objects.in_bulk({data[f] for _, data in valid for f in ('pickup_node', 'dropoff_node')})
+        created = []
+        for index, data in valid:
+            missing = _missing_nodes(data, ('pickup_node', 'dropoff_node'), nodes)
+            if missing:
+                results[index] = {'index': index, 'errors': missing}
+            elif data['pickup_node'] == data['dropoff_node']:
+                results[index] = {'index': index, 'errors': ['Pickup and dropoff cannot be the same.']}
+            else:
+                created.append((index, CarpoolRequest(passenger=request.user, pickup_node=nodes[data['pickup_node']],
+                                                      dropoff_node=nodes[data['dropoff_node']])))
+
+        carpool_requests = [req for _, req in created]
+        with transaction.atomic():
+            CarpoolRequest.objects.bulk_create(carpool_requests)
+            # bulk_create skips the post_save signal that schedules match refreshes
+            transaction.on_commit(lambda: [match_service.schedule_request(req.pk) for req in carpool_requests])
+        for index, req in created:
+            results[index] = {'index': index, 'data': CarpoolRequestSerializer(req).data}
+        return _batch_response(results)
+
+    @decorators.action(detail=True, methods=['get'])
+    def candidate_trips(self, request, pk=None):
+        """
+        Active trips that can serve this request with their detour and fare,
+        cheapest first. Only trips the reverse index places near both stops
+        are evaluated (see trip_index).
+        """
+        carpool_req = self.get_object()
+        if carpool_req.passenger != request.user:
+            return Response({'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
+        if carpool_req.status != 'PENDING' or carpool_req.is_expired():
+            return Response({'error': 'Request is not pending'}, status=status.HTTP_400_BAD_REQUEST)
+
+        trip_ids = trip_index.candidates(carpool_req.pickup_node_id, carpool_req.dropoff_node_id)
+        trips = (Trip.objects.filter(id__in=trip_ids, status='ACTIVE', seats_taken__lt=F('max_passengers'))
+                 .exclude(driver=request.user).select_related('driver'))
+        accepted = {}
+        for offer in Offer.objects.filter(trip__in=trips, status='ACCEPTED').select_related('request'):
+            accepted.setdefault(offer.trip_id, []).append(offer)
+
+        snapshot = graph_index.current()
+        candidates = []
+        for trip in trips:
+            route, detour, fare = match_service.evaluate(trip, carpool_req, snapshot, accepted.get(trip.id, []))
+            if route:
+                candidates.append({
+                    'trip': TripSerializer(trip).data,
+                    'detour': detour,
+                    'proposed_fare': fare,
+                    'seats_left': trip.max_passengers - trip.seats_taken,
+                })
+        candidates.sort(key=lambda item: (item['proposed_fare'], item['detour'], item['trip']['id']))
+        return Response(candidates)
+
     @decorators.action(detail=True, methods=['get'])
     def offers(self, request, pk=None):
         carpool_req = self.get_object()
         offers = Offer.objects.filter(request=carpool_req)
         return Response(OfferSerializer(offers, many=True).data)
 
-class OfferViewSet(viewsets.ModelViewSet):
+class OfferViewSet(ArchiveReadThroughMixin, viewsets.ModelViewSet):
     queryset = Offer.objects.all()
     serializer_class = OfferSerializer
+    archive_serializer_class = ArchivedOfferSerializer
+
+    def get_archive_queryset(self):
+        user_id = self.request.user.id
+        return ArchivedOffer.objects.filter(Q(driver=user_id) | Q(passenger=user_id))
 
     def create(self, request, *args, **kwargs):
         # Driver offers to accept a request
@@ -123,50 +471,71 @@ class OfferViewSet(viewsets.ModelViewSet):
         
         trip = get_object_or_404(Trip, id=trip_id, driver=request.user)
         carpool_req = get_object_or_404(CarpoolRequest, id=request_id)
-        existing_offer = Offer.objects.filter(trip=trip, request=carpool_req).exists()
-
-        if existing_offer:
+        offer, error = self._build_offer(
+            trip, carpool_req, request.data.get('quote'),
+            exists=Offer.objects.filter(trip=trip, request=carpool_req).exists(),
+        )
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+        offer.save()
+        return Response(OfferSerializer(offer).data, status=status.HTTP_201_CREATED)
 
-            return Response(
-                {'error': 'Offer already exists for this request'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        if carpool_req.passenger == request.user:
-            return Response(
-                {'error': 'Cannot accept your own request'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        # Calculate detour and fare again for confirmation
-        # (Usually you'd pass these from the matching_requests endpoint for consistency)
-        curr_idx = trip.route.index(trip.current_node.id)
-        remaining_route = trip.route[curr_idx:]
-        new_route, detour = graph_service.calculate_best_detour(remaining_route, carpool_req.pickup_node.id, carpool_req.dropoff_node.id)
-        
+    @staticmethod
+    def _build_offer(trip, carpool_req, quote, exists):
+        """
+        An unsaved Offer from the trip's driver for ``carpool_req``, or an
+        error message. ``exists`` is looked up by the caller so a batch can
+        fetch it for every item at once.
+        """
+        if exists:
+            return None, 'Offer already exists for this request'
+        if carpool_req.passenger_id == trip.driver_id:
+            return None, 'Cannot accept your own request'
+        if carpool_req.is_expired():
+            return None, 'Request has expired'
+        # Reuse the quote from matching_requests if nothing changed since,
+        # otherwise calculate detour and fare again
+        new_route, detour, fare = quote_service.resolve(quote, trip, carpool_req)
         if not new_route:
-            return Response({'error': 'Cannot fulfill request'}, status=status.HTTP_400_BAD_REQUEST)
-            
-        occupancy = trip.get_occupancy_per_hop()
+            return None, 'Cannot fulfill request'
+        # Only a hint: the seat is reserved when the passenger accepts
+        if trip.seats_taken >= trip.max_passengers:
+            return None, 'Trip is full'
+        return Offer(trip=trip, request=carpool_req, detour=detour, fare=fare,
+                     route=new_route, route_version=trip.route_version), None
 
-        fare = fare_service.calculate_trip_fare(
-            occupancy,
-            new_route,
-            carpool_req.pickup_node.id,
-            carpool_req.dropoff_node.id
-        )
-        accepted_offers = Offer.objects.filter(trip=trip, status='ACCEPTED').count()
+    @decorators.action(detail=False, methods=['post'], url_path='batch')
+    def batch(self, request):
+        """Offer the driver's trips to many requests in one transaction."""
+        results, valid, error = _batch_items(request, OfferBatchItemSerializer)
+        if error:
+            return error
+        trip_ids = {data['trip'] for _, data in valid}
+        request_ids = {data['request'] for _, data in valid}
+        trips = Trip.objects.filter(driver=request.user).in_bulk(trip_ids)
+        carpool_requests = CarpoolRequest.objects.in_bulk(request_ids)
+        existing = set(Offer.objects.filter(trip_id__in=trip_ids, request_id__in=request_ids)
+                       .values_list('trip_id', 'request_id'))
 
-        if accepted_offers >= trip.max_passengers:
-            return Response(
-                {'error': 'Trip is full'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        offer = Offer.objects.create(
-            trip=trip,
-            request=carpool_req,
-            detour=detour,
-            fare=fare
-        )
-        return Response(OfferSerializer(offer).data, status=status.HTTP_201_CREATED)
+        created = []
+        for index, data in valid:
+            trip, carpool_req = trips.get(data['trip']), carpool_requests.get(data['request'])
+            if trip is None or carpool_req is None:
+                results[index] = {'index': index, 'errors': ['Not found.']}
+                continue
+            key = (trip.id, carpool_req.id)
+            offer, message = self._build_offer(trip, carpool_req, data.get('quote'), exists=key in existing)
+            if message:
+                results[index] = {'index': index, 'errors': [message]}
+                continue
+            existing.add(key)  # A repeated pair later in the batch is a duplicate
+            created.append((index, offer))
+
+        with transaction.atomic():
+            Offer.objects.bulk_create([offer for _, offer in created])
+        for index, offer in created:
+            results[index] = {'index': index, 'data': OfferSerializer(offer).data}
+        return _batch_response(results)
 
     @decorators.action(detail=True, methods=['post'])
     def accept(self, request, pk=None):
@@ -174,26 +543,25 @@ class OfferViewSet(viewsets.ModelViewSet):
         
         if offer.request.passenger != request.user:
             return Response({'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
-            
-        # Accept offer: update statuses and trip route
-        offer.status = 'ACCEPTED'
-        offer.save()
         if offer.status == 'ACCEPTED':
             return Response({'error': 'Offer already accepted'}, status=status.HTTP_400_BAD_REQUEST)
-        carpool_req = offer.request
-        carpool_req.status = 'ACCEPTED'
-        carpool_req.save()
-        
-        # Update trip route
-        trip = offer.trip
-        curr_idx = trip.route.index(trip.current_node.id)
-        remaining_route = trip.route[curr_idx:]
-        new_route, _ = graph_service.calculate_best_detour(remaining_route, carpool_req.pickup_node.id, carpool_req.dropoff_node.id)
-        
-        trip.route = trip.route[:curr_idx] + new_route
-        trip.save()
-        
-        return Response(OfferSerializer(offer).data)
+
+        # Accept offer: reserve the seat now, splice the trip route in the background
+        try:
+            with transaction.atomic():
+                outcome = booking_service.accept(offer)
+                if outcome:
+                    return Response({'error': booking_service.ERRORS[outcome]}, status=status.HTTP_409_CONFLICT)
+                job = job_queue.enqueue(
+                    'splice_route', {'offer_id': offer.id},
+                    idempotency_key=_idempotency_key(request, 'splice_route', offer.id),
+                    user=request.user,
+                )
+        except job_queue.IdempotencyConflict as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_409_CONFLICT)
+        data = OfferSerializer(offer).data
+        data['job'] = JobSerializer(job).data
+        return Response(data, status=status.HTTP_202_ACCEPTED)
 
     @decorators.action(detail=True, methods=['post'])
     def complete_trip(self, request, pk=None):
@@ -205,51 +573,16 @@ class OfferViewSet(viewsets.ModelViewSet):
         if trip.status == 'COMPLETED':
             return Response({'error': 'Trip already completed'}, status=status.HTTP_400_BAD_REQUEST)
             
-        # Complete trip and process payments
-        from django.db import transaction as db_transaction
-        
-        with db_transaction.atomic():
-            accepted_offers = Offer.objects.filter(trip=trip, status='ACCEPTED')
-            driver_wallet = trip.driver.wallet
-            
-            for offer in accepted_offers:
-                passenger_wallet = offer.request.passenger.wallet
-                
-                if passenger_wallet.balance < offer.fare:
-                    return Response({'error': f'Passenger {offer.request.passenger.username} has insufficient balance.'}, 
-                                    status=status.HTTP_400_BAD_REQUEST)
-                
-                # Transfer funds
-                from django.db.models import F
-
-                passenger_wallet.balance = F('balance') - offer.fare
-                passenger_wallet.save()
-
-                driver_wallet.balance = F('balance') + offer.fare
-                driver_wallet.save()
-
-                passenger_wallet.refresh_from_db()
-                driver_wallet.refresh_from_db()
-                
-                # Record transactions
-                Transaction.objects.create(
-                    wallet=passenger_wallet, amount=-offer.fare, 
-                    transaction_type='FARE_PAYMENT', trip=trip
-                )
-                Transaction.objects.create(
-                    wallet=driver_wallet, amount=offer.fare, 
-                    transaction_type='EARNING', trip=trip
-                )
-                
-                # Mark request completed
-                req = offer.request
-                req.status = 'COMPLETED'
-                req.save()
-            
-            trip.status = 'COMPLETED'
-            trip.save()
-            
-        return Response(TripSerializer(trip).data)
+        # Complete trip and process payments in the background (see core/jobs.py)
+        try:
+            job = job_queue.enqueue(
+                'settle_trip', {'trip_id': trip.id},
+                idempotency_key=_idempotency_key(request, 'settle_trip', trip.id),
+                user=request.user,
+            )
+        except job_queue.IdempotencyConflict as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_409_CONFLICT)
+        return Response({'trip': trip.id, 'job': JobSerializer(job).data}, status=status.HTTP_202_ACCEPTED)
 
 class WalletViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Wallet.objects.all()
@@ -283,7 +616,40 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = TransactionSerializer
 
     def get_queryset(self):
-        return self.queryset.filter(wallet__user=self.request.user)
+        queryset = self.queryset.filter(wallet__user=self.request.user).order_by('-created_at')
+        # Bounding created_at lets PostgreSQL skip older partitions
+        since = self._since()
+        if since:
+            queryset = queryset.filter(created_at__gte=timezone.make_aware(datetime.combine(since, time.min)))
+        return queryset
+
+    def _since(self):
+        value = self.request.query_params.get('since')
+        if not value:
+            return None
+        since = parse_date(value)
+        if since is None:
+            raise serializers.ValidationError({'since': 'Expected a date as YYYY-MM-DD.'})
+        return since
+
+    @decorators.action(detail=False, methods=['get'])
+    def summary(self, request):
+        """Totals per day or month (``?period=DAY|MONTH``, default MONTH) from the wallet rollups."""
+        period = request.query_params.get('period', 'MONTH').upper()
+        if period not in dict(WalletRollup.PERIOD_CHOICES):
+            return Response({'error': 'period must be DAY or MONTH'}, status=status.HTTP_400_BAD_REQUEST)
+        rollups = WalletRollup.objects.filter(wallet__user=request.user, period=period)
+        since = self._since()
+        if since:
+            rollups = rollups.filter(period_start__gte=since.replace(day=1) if period == 'MONTH' else since)
+        return Response(WalletRollupSerializer(rollups, many=True).data)
+
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+
+    def get_queryset(self):
+        return self.queryset.filter(created_by=self.request.user)
 
 # SSR Views
 @login_required
@@ -291,30 +657,16 @@ def driver_dashboard(request):
     trips = Trip.objects.filter(driver=request.user)
     active_trips = trips.filter(status='ACTIVE')
     
-    # Simple demo logic to show requests for the first active trip
-    matches = []
-    if active_trips.exists():
-        trip = active_trips.first()
-        try:
-            curr_idx = trip.route.index(trip.current_node.id)
-            remaining_route = trip.route[curr_idx:]
-        except (ValueError, AttributeError):
-            return Response({'error': 'Invalid current node'}, status=status.HTTP_400_BAD_REQUEST)
-            
-        pending_requests = CarpoolRequest.objects.filter(status='PENDING')
-        for req in pending_requests:
-            if graph_service.is_within_radius(remaining_route, req.pickup_node.id) and \
-               graph_service.is_within_radius(remaining_route, req.dropoff_node.id):
-                
-                new_route, detour = graph_service.calculate_best_detour(remaining_route, req.pickup_node.id, req.dropoff_node.id)
-                if new_route:
-                    fare = fare_service.calculate_trip_fare([], new_route, req.pickup_node.id, req.dropoff_node.id)
-                    matches.append({
-                        'request': req,
-                        'detour': detour,
-                        'fare': fare,
-                        'trip_id': trip.id
-                    })
+    # Matches are read from the TripMatch table kept fresh by the match worker
+    for trip in active_trips:
+        if trip.matches_refreshed_at is None:
+            db_router.use_primary()  # Read the inline refresh back from where it was written
+            match_service.refresh_trip(trip.id)
+        elif match_service.is_stale(trip):
+            match_service.schedule_trip(trip.id)
+    matches = TripMatch.objects.filter(
+        trip__in=active_trips, request__in=CarpoolRequest.objects.pending()
+    ).select_related('request__passenger', 'request__pickup_node', 'request__dropoff_node')
                     
     context = {
         'trips': trips,